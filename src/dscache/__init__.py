@@ -18,4 +18,4 @@ Copyright 2010 VendAsta Technologies Inc.
 """
 
 from .dscache import *
-from .vacuum import Vacuum
+from .vacuum import Vacuum, VacuumCoordinator
@@ -0,0 +1,68 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import hashlib
+import math
+import struct
+
+class BloomFilter:
+    """ A fixed-size Bloom filter of strings: a string that was added is always reported as present, and one that
+    was not is reported as present with a small probability.
+
+    The bit positions of a string are derived from its md5 digest by double hashing, so filters with the same size
+    and number of hashes agree on them across processes and can be merged.
+    """
+
+    def __init__(self, size, hashes, bits=None):
+        """ Initializes a filter of size bits, with hashes bit positions per string. """
+        self.size = size
+        self.hashes = hashes
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, capacity, error_rate):
+        """ Creates an empty filter sized to hold capacity strings with the given false positive rate. """
+        size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(size / capacity * math.log(2))))
+        return cls(size, hashes)
+
+    def _positions(self, item):
+        """ Returns the bit positions of a string. """
+        h1, h2 = struct.unpack('!QQ', hashlib.md5(item.encode('utf-8')).digest())
+        h2 |= 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        """ Adds a string to the filter. """
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def is_compatible(self, other):
+        """ Returns True if other has the same size and number of hashes, so the two can be merged. """
+        return self.size == other.size and self.hashes == other.hashes
+
+    def update(self, other):
+        """ Adds every string of a compatible filter to this one. """
+        if not self.is_compatible(other):
+            raise ValueError('cannot merge Bloom filters of different sizes')
+        merged = int.from_bytes(self.bits, 'big') | int.from_bytes(other.bits, 'big')
+        self.bits = bytearray(merged.to_bytes(len(self.bits), 'big'))
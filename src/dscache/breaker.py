@@ -0,0 +1,120 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import threading
+import time as time_pkg
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_WINDOW = 10
+DEFAULT_COOLDOWN = 30
+DEFAULT_SLOW_SECONDS = 1
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """ An in-process circuit breaker.
+
+    The breaker opens once failure_threshold calls have failed, or taken over slow_seconds, within window seconds.
+    While it is open, allow() returns False, so callers skip the call. After cooldown seconds it is half-open:
+    allow() lets a single probe call through (another one if no outcome was recorded for cooldown seconds), and the
+    probe's outcome closes the breaker or opens it for another cooldown. A slow_seconds of None only counts failures.
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, window=DEFAULT_WINDOW, cooldown=DEFAULT_COOLDOWN,
+                 slow_seconds=DEFAULT_SLOW_SECONDS):
+        """ Initializes the breaker, closed. """
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.slow_seconds = slow_seconds
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Closes the breaker and resets the counters. """
+        with self._lock:
+            self.state = CLOSED
+            # times of the recent failures, while closed
+            self._failures = collections.deque()
+            self._opened_at = None
+            self._probe_started = None
+            self.trips = 0
+            self.short_circuits = 0
+
+    def allow(self):
+        """ Returns True if a call may go ahead, False if it should be short-circuited. """
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time_pkg.time()
+            if self.state == OPEN and now >= self._opened_at + self.cooldown:
+                self.state = HALF_OPEN
+                self._probe_started = None
+            if self.state == HALF_OPEN and (self._probe_started is None or
+                                            now >= self._probe_started + self.cooldown):
+                self._probe_started = now
+                return True
+            self.short_circuits += 1
+            return False
+
+    def is_closed(self):
+        """ Returns True if calls are going ahead normally, rather than being short-circuited or probed. """
+        return self.state == CLOSED
+
+    def record_call(self, seconds):
+        """ Records the outcome of a call that took seconds and did not fail otherwise. """
+        if self.slow_seconds is not None and seconds > self.slow_seconds:
+            self.record_failure()
+            return
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self._failures.clear()
+
+    def record_failure(self):
+        """ Records a failed call. """
+        with self._lock:
+            now = time_pkg.time()
+            if self.state == HALF_OPEN:
+                self._trip(now)
+            elif self.state == CLOSED:
+                self._failures.append(now)
+                while self._failures and self._failures[0] < now - self.window:
+                    self._failures.popleft()
+                if len(self._failures) >= self.failure_threshold:
+                    self._trip(now)
+
+    def get_stats(self):
+        """ Returns a dictionary of counters for this breaker. """
+        with self._lock:
+            return {
+                'state': self.state,
+                'trips': self.trips,
+                'short_circuits': self.short_circuits,
+            }
+
+    def _trip(self, now):
+        """ Opens the breaker; the caller must hold the lock. """
+        self.state = OPEN
+        self._opened_at = now
+        self._failures.clear()
+        self.trips += 1
@@ -0,0 +1,47 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import zlib
+
+# codec name -> (compress, decompress); the name is recorded on each compressed entity
+_COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
+def register_compressor(name, compress, decompress):
+    """ Registers a compression codec. compress and decompress each take and return bytes.
+
+    Entities record the codec name they were written with, so a codec must stay registered
+    (under the same name) for as long as entities compressed with it may be read.
+    """
+    _COMPRESSORS[name] = (compress, decompress)
+
+def compress(data, codec):
+    """ Compresses bytes with the named codec. """
+    try:
+        return _COMPRESSORS[codec][0](data)
+    except KeyError:
+        raise ValueError('unknown compression codec "%s"' % codec)
+
+def decompress(data, codec):
+    """ Decompresses bytes with the named codec. """
+    try:
+        return _COMPRESSORS[codec][1](data)
+    except KeyError:
+        raise ValueError('unknown compression codec "%s"' % codec)
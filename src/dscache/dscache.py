@@ -17,28 +17,545 @@ Copyright 2010 VendAsta Technologies Inc.
    limitations under the License.
 """
 
+import collections
 import datetime
+import functools
 import hashlib
 import json
 import logging
+import math
 import pickle
+import random
+import re
+import struct
 import time as time_pkg
 
+from google.appengine.api import memcache
 from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import ndb
+from google.appengine.ext.ndb import eventloop
 
-from .models import _DSCache
+from . import compression, serializers
+from .bloom import BloomFilter
+from .breaker import OPEN, CircuitBreaker
+from .local import LocalCache, entity_size
+from .models import _DSCache, _DSCacheBloom, _DSCacheChunk, _DSCacheGeneration
+from .stats import Stats
 
 MAX_STR_LENGTH = 500
 MAX_KEY_SIZE = 500
+# datastore limits the number of entities per batch get/put/delete
+MAX_BATCH_SIZE = 500
+# default cap on in-flight batch RPCs issued by a single *_multi call
+MAX_CONCURRENT_RPCS = 8
+# incr()/decr() values are unsigned 64-bit integers
+COUNTER_MODULUS = 2 ** 64
+DEFAULT_COUNTER_SHARDS = 20
+# text and serialized values at least this long (in bytes) are compressed in the compact format; see
+# set_value_on_entity()
+MIN_COMPRESS_LEN = 4096
+# codec used to compress values, or None to disable compression
+COMPRESSION_CODEC = 'zlib'
+# values whose encoded form is longer than this (in bytes) are split across _DSCacheChunk entities,
+# as a datastore entity is limited to 1MB
+MAX_VALUE_SIZE = 900 * 1024
+CHUNK_SIZE = 900 * 1024
+# chunks put per RPC, keeping each request well below the datastore's size limit
+CHUNKS_PER_PUT = 4
+# how long a get_or_compute() lease lasts if its holder never releases it
+LEASE_SECONDS = 10
+# how long get_or_compute() callers without the lease (or a stale value) wait for the holder to store a value
+LEASE_WAIT_SECONDS = 2
+LEASE_POLL_SECONDS = 0.1
+# low bits of a new entity version that are random, so that writes in the same clock tick get different versions
+VERSION_RANDOM_BITS = 10
+# cas ids remembered by a Client; the least recently fetched are forgotten first
+MAX_CAS_IDS = 10000
+# a write-behind Client flushes its buffer once it holds this many keys, or its oldest write is this many seconds old
+WRITE_BEHIND_MAX_ITEMS = MAX_BATCH_SIZE
+WRITE_BEHIND_SECONDS = 1
+# how new entities are written: FORMAT_LEGACY stores the value in a property of its type, pickling other values and
+# compressing nothing, so that earlier releases can read it; FORMAT_COMPACT stores the encoded value in a single
+# payload property, with the value type, codec and version packed into a header, marshals plain containers and
+# compresses large values. Both formats are always read, so switch to FORMAT_COMPACT once every instance reads it.
+FORMAT_LEGACY = 'legacy'
+FORMAT_COMPACT = 'compact'
+ENTITY_FORMAT = FORMAT_LEGACY
+# defaults of enable_bloom_filter(); a shard of this capacity and error rate is about 120KB before compression
+BLOOM_CAPACITY = 100000
+BLOOM_ERROR_RATE = 0.01
+BLOOM_SHARDS = 8
+BLOOM_MAX_AGE = 60
+BLOOM_FLUSH_SECONDS = 10
+# memcache keys of a tiered Client's copies start with this
+MEMCACHE_KEY_PREFIX = 'dscache:'
+# memcache reads expiration times above this many seconds as absolute timestamps
+MEMCACHE_MAX_RELATIVE_TIME = 30 * 24 * 60 * 60
+# seconds a key the tier removed is held by a placeholder, so that a read racing the write cannot add the old value
+# back to memcache (memcache only locks a deleted key against adds if it held a value)
+MEMCACHE_INVALIDATION_SECONDS = 10
+# get_async() lookups are coalesced into one batched lookup per event loop turn; with a GET_BATCH_WINDOW (seconds),
+# lookups made within that window of the first are batched too, at the cost of delaying each by up to the window
+AUTO_BATCH_GETS = True
+GET_BATCH_WINDOW = 0
+# how long a flush generation is cached in process; flush_all() on another instance is seen after this delay
+GENERATION_CACHE_SECONDS = 5
 
 __all__ = ['set', 'set_multi', 'get', 'get_multi', 'delete', 'delete_multi', 'add', 'add_multi',
+           'set_async', 'set_multi_async', 'get_async', 'get_multi_async', 'delete_async', 'delete_multi_async',
+           'add_async', 'add_multi_async', 'replace_async', 'replace_multi_async', 'incr_async', 'decr_async',
+           'offset_multi_async',
+           'incr_sharded', 'incr_sharded_async', 'get_sharded', 'get_sharded_async',
+           'get_or_compute', 'get_or_compute_async', 'get_or_compute_multi', 'get_or_compute_multi_async',
+           'get_or_revalidate', 'get_or_revalidate_async',
            'replace', 'replace_multi', 'incr', 'decr', 'offset_multi', 'flush_all', 'get_stats', 'Client',
+           'enable_local_cache', 'disable_local_cache', 'get_local_cache',
+           'enable_bloom_filter', 'disable_bloom_filter', 'rebuild_bloom_filter', 'rebuild_bloom_filter_async',
+           'flush_bloom_filter', 'flush_bloom_filter_async',
+           'enable_circuit_breaker', 'disable_circuit_breaker', 'get_circuit_breaker',
            'STRONG_CONSISTENCY', 'EVENTUAL_CONSISTENCY']
 
 STRONG_CONSISTENCY = datastore_rpc.Configuration.STRONG_CONSISTENCY
 EVENTUAL_CONSISTENCY = datastore_rpc.Configuration.EVENTUAL_CONSISTENCY
 
+# in-process statistics, see get_stats()
+_stats = Stats()
+
+def _measured(op, fallback=None):
+    """ Decorates a function returning a future, recording the latency of each call under op.
+
+    Calls of a function with a fallback go through the circuit breaker, if enabled: while it is open they return
+    fallback(*args, **kwargs) without being made. Only the Datastore calls they make count towards tripping or
+    closing it (see _rpc_async()), so that a call served without one, such as a local cache hit, cannot close a
+    half-open breaker. They also return the fallback if the flush generation, and so the keys, cannot be read. """
+    def decorator(func):
+        @functools.wraps(func)
+        @ndb.tasklet
+        def wrapper(*args, **kwargs):
+            breaker = _breaker if fallback is not None else None
+            if breaker is not None and not breaker.allow():
+                raise ndb.Return(fallback(*args, **kwargs))
+            start = time_pkg.time()
+            try:
+                result = yield func(*args, **kwargs)
+            except _GenerationUnavailable:
+                if fallback is None:
+                    raise
+                # the error is already logged and recorded
+                raise ndb.Return(fallback(*args, **kwargs))
+            finally:
+                _stats.record_latency(op, time_pkg.time() - start)
+            raise ndb.Return(result)
+        return wrapper
+    return decorator
+
+def _measured_sync(op, fallback=None):
+    """ Like _measured(), for a function returning its result rather than a future. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            breaker = _breaker if fallback is not None else None
+            if breaker is not None and not breaker.allow():
+                return fallback(*args, **kwargs)
+            start = time_pkg.time()
+            try:
+                result = func(*args, **kwargs)
+            except _GenerationUnavailable:
+                if fallback is None:
+                    raise
+                return fallback(*args, **kwargs)
+            finally:
+                _stats.record_latency(op, time_pkg.time() - start)
+            return result
+        return wrapper
+    return decorator
+
+# the results of calls short-circuited by the circuit breaker: a miss, or a write that failed
+def _short_circuit_none(*args, **kwargs):
+    return None
+
+def _short_circuit_false(*args, **kwargs):
+    return False
+
+def _short_circuit_dict(*args, **kwargs):
+    return {}
+
+def _short_circuit_keys(keys, *args, **kwargs):
+    return list(keys)
+
+def _short_circuit_offsets(mapping, *args, **kwargs):
+    return {key: None for key in mapping}
+
+def _short_circuit_method_keys(self, keys, *args, **kwargs):
+    return list(keys)
+
+def _record_error(op):
+    """ Counts a Datastore error under op, and against the circuit breaker, if enabled. """
+    _stats.record_error(op)
+    if _breaker is not None:
+        _breaker.record_failure()
+
+def _record_rpc(start):
+    """ Counts a Datastore call made since start, which succeeded, towards the circuit breaker, if enabled. """
+    if _breaker is not None:
+        _breaker.record_call(time_pkg.time() - start)
+
+@ndb.tasklet
+def _rpc_async(future):
+    """ Waits for the future of a Datastore call, counting it towards the circuit breaker, if enabled, if it
+    succeeds; callers count its errors with _record_error() as they log them.
+
+    The return value is a future whose result is that of the call.
+    """
+    start = time_pkg.time()
+    result = yield future
+    _record_rpc(start)
+    raise ndb.Return(result)
+
+# optional circuit breaker around Datastore, see enable_circuit_breaker()
+_breaker = None
+
+def enable_circuit_breaker(**kwargs):
+    """ Turns on an in-process circuit breaker, so that dscache does not slow requests down while Datastore is
+    failing or slow.
+
+    Keyword arguments are passed to CircuitBreaker (failure_threshold, window, cooldown, slow_seconds). Datastore
+    errors and calls slower than slow_seconds count as failures. While the breaker is open, reads return misses
+    and writes fail straight away, without calling Datastore; get_or_compute() and its variants call fn and skip
+    the cache until the breaker closes again, and a tiered Client still serves what memcache holds. Once the
+    cooldown has passed, single calls probe Datastore.
+
+    The return value is the new CircuitBreaker, whose get_stats() exposes its state and counters.
+    """
+    global _breaker
+    _breaker = CircuitBreaker(**kwargs)
+    return _breaker
+
+def disable_circuit_breaker():
+    """ Turns off the circuit breaker. """
+    global _breaker
+    _breaker = None
+
+def get_circuit_breaker():
+    """ Returns the active CircuitBreaker, or None if it is disabled. """
+    return _breaker
+
+# optional in-process cache tier, see enable_local_cache()
+_local_cache = None
+
+def enable_local_cache(**kwargs):
+    """ Turns on a bounded in-process cache in front of get() and get_multi().
+
+    Keyword arguments are passed to LocalCache (max_items, max_bytes, max_age, negative_ttl, max_negative_items).
+    Writes made through this module update the local cache; writes made on other instances are seen once the
+    entry's max_age passes. With a negative_ttl, keys that get() and get_multi() did not find are remembered as
+    misses for that many seconds, or until they are written through this module.
+
+    The return value is the new LocalCache, whose get_stats() exposes hit and miss counters.
+    """
+    global _local_cache
+    _local_cache = LocalCache(**kwargs)
+    return _local_cache
+
+def disable_local_cache():
+    """ Turns off the in-process cache tier. """
+    global _local_cache
+    _local_cache = None
+
+def get_local_cache():
+    """ Returns the active LocalCache, or None if the in-process tier is disabled. """
+    return _local_cache
+
+def _local_put(entity):
+    """ Writes an entity through to the in-process cache, if enabled. """
+    if entity.chunk_count and getattr(entity, '_chunk_data', None) is None:
+        # without its chunks the entity cannot be served, but any remembered miss of its key is now wrong
+        _local_delete(entity.key)
+        return
+    if _local_cache is not None:
+        _local_cache.put(entity.key, entity)
+
+def _local_delete(ds_key):
+    """ Removes a key from the in-process cache, if enabled. """
+    if _local_cache is not None:
+        _local_cache.delete(ds_key)
+
+# optional negative lookup index, see enable_bloom_filter()
+_bloom_config = None
+# namespace -> (merged BloomFilter, or None if it is not usable, time loaded)
+_bloom_filters = {}
+# namespace -> (names added on this instance and not yet written to a shard, time of the oldest)
+_bloom_pending = {}
+
+def enable_bloom_filter(capacity=BLOOM_CAPACITY, error_rate=BLOOM_ERROR_RATE, shards=BLOOM_SHARDS,
+                        max_age=BLOOM_MAX_AGE, flush_interval=BLOOM_FLUSH_SECONDS):
+    """ Turns on a Bloom filter per namespace of the keys set in dscache, so that get() and get_multi() skip the
+    lookup of keys it shows were never set.
+
+    set(), add() and incr() or decr() with an initial_value add their keys to the filter of this instance at once,
+    and to its shard entities in batches: the first write after flush_interval seconds adds every key added since,
+    in a single transaction on one of the shards, chosen at random. A failed batch is logged and kept for the next
+    one; the write itself does not fail. Readers load and merge the shards of a namespace at most every max_age
+    seconds, so a key set on another instance since may be reported absent, which reads as a miss. Call
+    flush_bloom_filter() at the end of a request to write the pending keys sooner; keys whose batch was lost with
+    its instance read as misses until the next rebuild. The filter of a namespace is only used once
+    rebuild_bloom_filter() has been run for it, and it must be enabled with the same settings on every instance that
+    writes to dscache. Keys are never removed; rebuild the filter from time to time to drop those that were deleted
+    or expired.
+    """
+    global _bloom_config
+    _bloom_config = {'capacity': capacity, 'error_rate': error_rate, 'shards': shards, 'max_age': max_age,
+                     'flush_interval': flush_interval}
+    _bloom_filters.clear()
+    _bloom_pending.clear()
+
+def disable_bloom_filter():
+    """ Turns off the Bloom filter. Keys not yet written to its shards are dropped. """
+    global _bloom_config
+    _bloom_config = None
+    _bloom_filters.clear()
+    _bloom_pending.clear()
+
+def _build_bloom_keys(namespace, shards):
+    """ Builds the Keys of the shard entities of a namespace's Bloom filter. """
+    return [ndb.Key(_DSCacheBloom, '{}:{}'.format(namespace or '', shard), namespace='') for shard in range(shards)]
+
+def _load_bloom_shard(shard):
+    """ Returns the BloomFilter held by a shard entity. """
+    return BloomFilter(shard.size, shard.hashes, shard.bits)
+
+# the start of the get_or_compute() lease keys, see _build_lease_key()
+_LEASE_PREFIX = '__lease__:'
+
+def _is_internal_key(key):
+    """ Whether a key is one that dscache writes for its own use and never reads through get(), like a lease. """
+    return str(key).startswith(_LEASE_PREFIX)
+
+@ndb.tasklet
+def _bloom_add_async(ds_keys, namespace=None):
+    """ Adds keys to the Bloom filter of their namespace, if enabled: to this instance's copy at once, and to the
+    shards with the other pending keys once the oldest has waited flush_interval seconds. Errors are logged.
+    """
+    config = _bloom_config
+    if config is None or not ds_keys:
+        return
+    names, since = _bloom_pending.get(namespace or '', (frozenset(), time_pkg.time()))
+    _bloom_pending[namespace or ''] = (names | {ds_key.string_id() for ds_key in ds_keys}, since)
+    # this instance sees its own writes without waiting for the next load
+    cached = _bloom_filters.get(namespace or '')
+    if cached and cached[0] is not None:
+        for ds_key in ds_keys:
+            cached[0].add(ds_key.string_id())
+    if since + config['flush_interval'] <= time_pkg.time():
+        yield _bloom_flush_async(namespace)
+
+@ndb.tasklet
+def _bloom_flush_async(namespace=None):
+    """ Adds the pending keys of a namespace to a random shard of its Bloom filter, in a transaction.
+    Errors are logged, and the keys are kept for the next flush.
+
+    The return value is a future whose result is True if the keys were written, or there were none.
+    """
+    config = _bloom_config
+    if config is None or (namespace or '') not in _bloom_pending:
+        raise ndb.Return(True)
+    names, since = _bloom_pending.pop(namespace or '')
+    shard_key = random.choice(_build_bloom_keys(namespace, config['shards']))
+
+    @ndb.tasklet
+    def tx():
+        """ Reads the shard, adds the keys and writes it back. """
+        shard = yield shard_key.get_async()
+        if shard:
+            bloom = _load_bloom_shard(shard)
+        else:
+            bloom = BloomFilter.for_capacity(config['capacity'], config['error_rate'])
+            shard = _DSCacheBloom(key=shard_key, size=bloom.size, hashes=bloom.hashes)
+        for name in names:
+            bloom.add(name)
+        shard.bits = bytes(bloom.bits)
+        yield shard.put_async()
+    try:
+        yield _rpc_async(ndb.transaction_async(tx))
+    except Exception:
+        logging.exception('dscache: error adding keys to the Bloom filter of namespace "%s".', namespace or '')
+        _record_error('bloom_add')
+        # merged with the keys added meanwhile, keeping the older time so that the next write retries
+        pending, unused_since = _bloom_pending.get(namespace or '', (frozenset(), None))
+        _bloom_pending[namespace or ''] = (names | pending, since)
+        raise ndb.Return(False)
+    raise ndb.Return(True)
+
+@ndb.tasklet
+def flush_bloom_filter_async():
+    """ Asynchronous version of flush_bloom_filter(); returns a future. """
+    results = yield [_bloom_flush_async(namespace) for namespace in list(_bloom_pending)]
+    raise ndb.Return(all(results))
+
+def flush_bloom_filter():
+    """ Writes the keys added to the Bloom filter on this instance that are still waiting for their batch.
+
+    The return value is True if every namespace's keys were written, False otherwise.
+    """
+    return flush_bloom_filter_async().get_result()
+
+@ndb.tasklet
+def _get_bloom_filter_async(namespace=None):
+    """ Merges the shards of a namespace's Bloom filter, if they were not loaded in the last max_age seconds.
+
+    The return value is a future whose result is the filter, or None if it is incomplete or could not be read.
+    """
+    config = _bloom_config
+    cached = _bloom_filters.get(namespace or '')
+    now = time_pkg.time()
+    if cached and cached[1] + config['max_age'] > now:
+        raise ndb.Return(cached[0])
+    bloom = None
+    try:
+        shards = yield _rpc_async(ndb.get_multi_async(_build_bloom_keys(namespace, config['shards'])))
+        if shards[0] and shards[0].complete:
+            bloom = _load_bloom_shard(shards[0])
+            for shard in shards[1:]:
+                if shard:
+                    bloom.update(_load_bloom_shard(shard))
+            # this instance's keys that are not in the shards yet
+            for name in _bloom_pending.get(namespace or '', ((), None))[0]:
+                bloom.add(name)
+    except Exception:
+        logging.exception('dscache: error loading the Bloom filter of namespace "%s".', namespace or '')
+        _record_error('bloom_load')
+        bloom = None
+    _bloom_filters[namespace or ''] = (bloom, now)
+    raise ndb.Return(bloom)
+
+@ndb.tasklet
+def _bloom_prune_async(ds_keys, namespace=None):
+    """ Drops the keys that the namespace's Bloom filter shows were never set, if it is enabled.
+
+    The return value is a future whose result is the list of keys that may be in dscache.
+    """
+    if _bloom_config is None or not ds_keys:
+        raise ndb.Return(ds_keys)
+    bloom = yield _get_bloom_filter_async(namespace)
+    if bloom is None:
+        raise ndb.Return(ds_keys)
+    raise ndb.Return([ds_key for ds_key in ds_keys if ds_key.string_id() in bloom])
+
+# the flush generation prefix of a key name, see _build_generation_prefix()
+_GENERATION_PREFIX = re.compile(r'@\d+\.\d+:')
+# a key name hashed by build_ds_key_name(), whose namespace is unknown
+_HASHED_KEY_NAME = re.compile(r'[0-9a-f]{40}$')
+
+@ndb.tasklet
+def rebuild_bloom_filter_async(namespace=None, batch_size=MAX_BATCH_SIZE):
+    """ Asynchronous version of rebuild_bloom_filter(); returns a future. """
+    config = _bloom_config
+    if config is None:
+        raise ValueError('the Bloom filter is not enabled')
+    shard_keys = _build_bloom_keys(namespace, config['shards'])
+    bloom = BloomFilter.for_capacity(config['capacity'], config['error_rate'])
+    # readers stop using the filter until shard 0 is complete again; keys written from here on are kept
+    yield ndb.put_multi_async([_DSCacheBloom(key=shard_key, size=bloom.size, hashes=bloom.hashes,
+                                             bits=bytes(bloom.bits)) for shard_key in shard_keys])
+
+    prefix = '{}:'.format(namespace) if namespace else None
+    query = _DSCache.query()
+    added = 0
+    cursor = None
+    more = True
+    while more:
+        keys, cursor, more = yield query.fetch_page_async(batch_size, start_cursor=cursor, keys_only=True)
+        for key in keys:
+            name = key.string_id()
+            generation = _GENERATION_PREFIX.match(name)
+            # without a namespace every key may belong, as keys may contain colons
+            if prefix and not (name[generation.end() if generation else 0:].startswith(prefix) or
+                               _HASHED_KEY_NAME.match(name)):
+                continue
+            bloom.add(name)
+            added += 1
+        more = more and cursor
+
+    @ndb.tasklet
+    def tx():
+        """ Merges the keys written during the scan and marks shard 0 complete. """
+        shard = yield shard_keys[0].get_async()
+        if shard and bloom.is_compatible(_load_bloom_shard(shard)):
+            bloom.update(_load_bloom_shard(shard))
+        yield _DSCacheBloom(key=shard_keys[0], size=bloom.size, hashes=bloom.hashes, bits=bytes(bloom.bits),
+                            complete=True).put_async()
+    yield _rpc_async(ndb.transaction_async(tx))
+    _bloom_filters.pop(namespace or '', None)
+    raise ndb.Return(added)
+
+def rebuild_bloom_filter(namespace=None, batch_size=MAX_BATCH_SIZE):
+    """ Rebuilds the Bloom filter of a namespace from a keys-only scan of the dscache entries, and marks it complete
+    so that readers use it. Readers do not use the filter while it is rebuilt; keys written meanwhile are kept.
+    A large cache takes a while to scan, so run this from a task queue task or a backend.
+
+    The return value is the number of keys found.
+    """
+    return rebuild_bloom_filter_async(namespace=namespace, batch_size=batch_size).get_result()
+
+# generation key name -> (generation, time fetched), see _get_generation()
+_generations = {}
+
+class _GenerationUnavailable(Exception):
+    """ Raised when a flush generation was never read on this instance and cannot be read now, so that the key
+    names of the entries are unknown. _measured() turns it into the fallback result of the call. """
+
+def _get_generation(name):
+    """ Returns the flush generation stored under name, caching it for GENERATION_CACHE_SECONDS. """
+    cached = _generations.get(name)
+    now = time_pkg.time()
+    if cached and cached[1] + GENERATION_CACHE_SECONDS > now:
+        return cached[0]
+    if cached and _breaker is not None and not _breaker.is_closed():
+        # keep using the last known generation rather than wait on Datastore
+        return cached[0]
+    try:
+        entity = ndb.Key(_DSCacheGeneration, name, namespace='').get()
+        _record_rpc(now)
+    except Exception:
+        logging.exception('dscache: error reading flush generation %s', name)
+        _record_error('generation')
+        if cached:
+            # keep using the last known generation rather than reverting to 0
+            return cached[0]
+        # assuming 0 would read and write the entries of before the last flush
+        raise _GenerationUnavailable(name)
+    generation = entity.generation if entity else 0
+    _generations[name] = (generation, now)
+    return generation
+
+def _get_generations(namespace=None):
+    """ Returns a tuple of the current global flush generation and that of namespace (0 without a namespace). """
+    return (_get_generation(_DSCacheGeneration.GLOBAL_GENERATION),
+            _get_generation(namespace) if namespace else 0)
+
+def _has_generations(namespace=None):
+    """ Returns True if the flush generations of namespace are known, reading them if needed. """
+    try:
+        _get_generations(namespace)
+    except _GenerationUnavailable:
+        return False
+    return True
+
+def _build_generation_prefix(namespace=None):
+    """ Builds the key name prefix for the current flush generations, or '' if nothing was ever flushed. """
+    global_generation, namespace_generation = _get_generations(namespace)
+    if not global_generation and not namespace_generation:
+        return ''
+    return '@{}.{}:'.format(global_generation, namespace_generation)
+
+def _set_generation(entity, namespace=None, generations=None):
+    """ Records on an entity the flush generations it is written under, for Vacuum.sweep_generations().
+    Transactions pass the generations, read with _get_generations() beforehand, as they cannot read them. """
+    global_generation, namespace_generation = generations or _get_generations(namespace)
+    entity.generation = global_generation
+    if namespace:
+        entity.namespace_generation = _DSCache.build_namespace_generation(namespace, namespace_generation)
+
 def build_ds_key_name(key, key_prefix='', namespace=None):
     """ Builds a key_name. """
     if not key or not isinstance(key, str):
@@ -47,6 +564,7 @@ def build_ds_key_name(key, key_prefix='', namespace=None):
     server_key = '{}{}'.format(key_prefix, key)
     if namespace:
         server_key = '{}:{}'.format(namespace, server_key)
+    server_key = _build_generation_prefix(namespace) + server_key
 
     if len(server_key) > MAX_KEY_SIZE:
         server_key = hashlib.sha1(server_key.encode()).hexdigest()
@@ -57,41 +575,199 @@ def build_ds_key(key, key_prefix='', namespace=None):
     """ Builds a Key instance. """
     return ndb.Key('_DSCache', build_ds_key_name(key, key_prefix=key_prefix, namespace=namespace), namespace='')
 
-def set_value_on_entity(entity, value):
+# signed 64-bit range of int_val; larger integers are serialized
+MIN_INT_VAL = -2 ** 63
+MAX_INT_VAL = 2 ** 63 - 1
+
+# value_type -> property holding values of that type, for values stored as a datastore type
+_VALUE_PROPERTIES = {
+    'bool': 'bool_val',
+    'int': 'int_val',
+    'float': 'float_val',
+    'datetime': 'datetime_val',
+    'date': 'date_val',
+    'time': 'time_val',
+    'str': 'str_val',
+    'text': 'text_val',
+}
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+def _encode_time(value):
+    """ Encodes a time as its microseconds since midnight. """
+    return struct.pack('!q', ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond)
+
+def _decode_time(data):
+    """ Decodes a time encoded by _encode_time(). """
+    return (datetime.datetime.min + datetime.timedelta(microseconds=struct.unpack('!q', data)[0])).time()
+
+# value_type -> (value -> bytes, bytes -> value), for the payload of compact entities; serialized values are
+# stored as serialized
+_COMPACT_CODECS = {
+    'bool': (lambda value: b'\1' if value else b'\0', lambda data: data == b'\1'),
+    'int': (lambda value: struct.pack('!q', value), lambda data: struct.unpack('!q', data)[0]),
+    'float': (lambda value: struct.pack('!d', value), lambda data: struct.unpack('!d', data)[0]),
+    'datetime': (lambda value: struct.pack('!q', (value - _EPOCH) // datetime.timedelta(microseconds=1)),
+                 lambda data: _EPOCH + datetime.timedelta(microseconds=struct.unpack('!q', data)[0])),
+    'date': (lambda value: struct.pack('!i', value.toordinal()),
+             lambda data: datetime.date.fromordinal(struct.unpack('!i', data)[0])),
+    'time': (_encode_time, _decode_time),
+    'str': (lambda value: value.encode('utf-8'), lambda data: data.decode('utf-8')),
+    'text': (lambda value: value.encode('utf-8'), lambda data: data.decode('utf-8')),
+}
+
+def set_value_on_entity(entity, value, min_compress_len=0, serializer=None, entity_format=None):
     """ Set a type-specific attribute on the entity. This is convenient when viewing the datastore
-    and avoids (extra) casting overhead. """
+    and avoids (extra) casting overhead. The type is recorded in value_type.
+
+    Other values are serialized into blob_val, with the named serializer if given, and value_type holds the
+    serializer name. Without one, the legacy format pickles them, as earlier releases unpickle every blob_val.
+
+    In the compact format (entity_format, or ENTITY_FORMAT if None), the encoded value is stored in payload instead,
+    plain containers are serialized with marshal (see serializers.dumps()), and text and serialized values of at
+    least min_compress_len bytes (MIN_COMPRESS_LEN if 0) are compressed with COMPRESSION_CODEC, which is recorded
+    on the entity. """
+    entity_format = entity_format or ENTITY_FORMAT
     if isinstance(value, str):
         if len(value) < MAX_STR_LENGTH:
-            entity.str_val = value
+            entity.str_val, entity.value_type = value, 'str'
         else:
-            entity.text_val = value
-    elif isinstance(value, (bool)):
-        entity.bool_val = value
-    elif isinstance(value, int):
-        entity.int_val = value
-    elif isinstance(value, (float)):
-        entity.float_val = value
-    elif isinstance(value, (datetime.datetime)):
-        entity.datetime_val = value
-    elif isinstance(value, (datetime.date)):
-        entity.date_val = value
-    elif isinstance(value, (datetime.time)):
-        entity.time_val = value
+            entity.text_val, entity.value_type = value, 'text'
+    elif isinstance(value, bool):
+        entity.bool_val, entity.value_type = value, 'bool'
+    elif isinstance(value, int) and MIN_INT_VAL <= value <= MAX_INT_VAL:
+        entity.int_val, entity.value_type = value, 'int'
+    elif isinstance(value, float):
+        entity.float_val, entity.value_type = value, 'float'
+    elif isinstance(value, datetime.datetime):
+        entity.datetime_val, entity.value_type = value, 'datetime'
+    elif isinstance(value, datetime.date):
+        entity.date_val, entity.value_type = value, 'date'
+    elif isinstance(value, datetime.time):
+        entity.time_val, entity.value_type = value, 'time'
     else:
-        try:
-            json = json.dumps(value)
-            entity.json_val = json
-        except Exception:
-            entity.blob_val = pickle.dumps(value)
-
-def get_value_from_entity(entity):
-    """ Gets a value from the entity. Only one value should be non-None. """
+        entity.value_type, entity.blob_val = serializers.dumps(
+            value, serializer or ('pickle' if entity_format == FORMAT_LEGACY else None))
+    if entity_format == FORMAT_COMPACT:
+        name = _VALUE_PROPERTIES.get(entity.value_type, 'blob_val')
+        data = getattr(entity, name)
+        setattr(entity, name, None)
+        entity.payload = _COMPACT_CODECS[entity.value_type][0](data) if name != 'blob_val' else data
+        _compress_entity(entity, min_compress_len or MIN_COMPRESS_LEN)
+
+def _compress_entity(entity, min_compress_len):
+    """ Moves a large text or serialized value into a compressed blob_val, if that makes it smaller. """
+    if not COMPRESSION_CODEC:
+        return
+    name, data = _get_payload(entity)
+    if data is None or len(data) < min_compress_len:
+        return
+    compressed = compression.compress(data, COMPRESSION_CODEC)
+    if len(compressed) >= len(data):
+        return
+    setattr(entity, name, None)
+    setattr(entity, 'payload' if name == 'payload' else 'blob_val', compressed)
+    entity.codec = COMPRESSION_CODEC
+
+def _get_payload(entity):
+    """ Finds the encoded value of a compact entity, or the text or serialized value of a legacy one, as written
+    by set_value_on_entity().
+
+    The return value is a tuple (property name, bytes), or (None, None) for other values.
+    """
+    if entity.payload is not None:
+        return 'payload', entity.payload
+    if entity.value_type == 'text':
+        return 'text_val', entity.text_val.encode('utf-8')
+    if entity.value_type not in _VALUE_PROPERTIES and entity.blob_val is not None:
+        return 'blob_val', entity.blob_val
+    return None, None
+
+def _decode_payload(entity, data):
+    """ Decodes the bytes of a compressed or chunked entity, according to its codec and value_type. """
+    if entity.codec:
+        data = compression.decompress(data, entity.codec)
+    if entity.value_type in _COMPACT_CODECS:
+        return _COMPACT_CODECS[entity.value_type][1](data)
+    return serializers.loads(data, entity.value_type)
+
+def _split_entity(entity):
+    """ Moves a value longer than MAX_VALUE_SIZE into _DSCacheChunk children of the entity, recording their
+    number and a checksum of the value on it. The chunks are kept on the entity, to be put with it. """
+    if entity.codec and entity.payload is None:
+        name, data = 'blob_val', entity.blob_val
+    else:
+        name, data = _get_payload(entity)
+    if data is None or len(data) <= MAX_VALUE_SIZE:
+        return
+    # a chunked compact entity keeps an empty payload
+    setattr(entity, name, b'' if name == 'payload' else None)
+    entity.chunk_count = (len(data) + CHUNK_SIZE - 1) // CHUNK_SIZE
+    entity.checksum = hashlib.md5(data).hexdigest()
+    entity._chunk_entities = [_DSCacheChunk(parent=entity.key, id=i + 1,
+                                            data=data[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE])
+                              for i in range(entity.chunk_count)]
+    entity._chunk_data = data
+
+def _get_chunked_value(entity):
+    """ Decodes the value of a chunked entity from the data attached by _load_chunks_async(). """
+    data = getattr(entity, '_chunk_data', None)
+    if data is None or hashlib.md5(data).hexdigest() != entity.checksum:
+        logging.warn('dscache: missing or inconsistent chunks for "%s".', entity.key.string_id())
+        return None
+    return _decode_payload(entity, data)
+
+@ndb.tasklet
+def _load_chunks_async(entities, **ctx_options):
+    """ Fetches the chunks of every chunked entity in entities with a single batch get, attaching the
+    reassembled value to each entity (None if a chunk is missing). """
+    chunked = [entity for entity in entities
+               if entity and entity.chunk_count and getattr(entity, '_chunk_data', None) is None]
+    if not chunked:
+        return
+    keys = [ndb.Key(_DSCacheChunk, i, parent=entity.key)
+            for entity in chunked for i in range(1, entity.chunk_count + 1)]
+    chunks = yield ndb.get_multi_async(keys, **ctx_options)
+    offset = 0
+    for entity in chunked:
+        parts = chunks[offset:offset + entity.chunk_count]
+        offset += entity.chunk_count
+        entity._chunk_data = None if None in parts else b''.join(chunk.data for chunk in parts)
+
+@ndb.tasklet
+def _put_entities_async(entities, **ctx_options):
+    """ Puts entities, after the chunks of any chunked ones, so that a manifest never refers to missing chunks. """
+    chunks = [chunk for entity in entities for chunk in getattr(entity, '_chunk_entities', ())]
+    if chunks:
+        yield [ndb.put_multi_async(batch, **ctx_options) for batch in _chunks(chunks, CHUNKS_PER_PUT)]
+    yield ndb.put_multi_async(entities, **ctx_options)
+
+def get_value_from_entity(entity, allow_expired=False):
+    """ Gets a value from the entity. Only one value should be non-None.
+    An expired entity has no value, unless allow_expired is True. """
     if not entity:
         return None
 
-    if is_entity_expired(entity):
+    if not allow_expired and is_entity_expired(entity):
         return None
 
+    if entity.tombstone:
+        return None
+    if entity.chunk_count:
+        return _get_chunked_value(entity)
+    if entity.payload is not None:
+        return _decode_payload(entity, entity.payload)
+    if entity.codec:
+        return _decode_payload(entity, entity.blob_val)
+    if entity.value_type:
+        name = _VALUE_PROPERTIES.get(entity.value_type)
+        if name:
+            return getattr(entity, name)
+        return serializers.loads(entity.blob_val, entity.value_type)
+    return _get_legacy_value(entity)
+
+def _get_legacy_value(entity):
+    """ Gets the value of an entity written before value types were recorded, from its non-None property. """
     if entity.int_val is not None:
         return entity.int_val
     if entity.float_val is not None:
@@ -114,11 +790,11 @@ def get_value_from_entity(entity):
         return pickle.loads(entity.blob_val)
 
     # entity had no non-None values, log this and dump the entity
-    logging.warn('dscache: entity does not contain any values "%s".', entity.key().name())
+    logging.warn('dscache: entity does not contain any values "%s".', entity.key.string_id())
     try:
-        entity.delete()
+        entity.key.delete()
     except Exception:
-        logging.exception('dscache: error deleting bad cache entry "%s".', entity.key().name())
+        logging.exception('dscache: error deleting bad cache entry "%s".', entity.key.string_id())
     return None
 
 def compute_timeout(time):
@@ -132,114 +808,714 @@ def is_entity_expired(entity):
         return True
     return False
 
-def create_entity(key, value, time=0, key_prefix='', namespace=None):
+def is_entity_live(entity):
+    """ Returns True if the entity holds an unexpired value (and is not a delete tombstone). """
+    return bool(entity) and not entity.tombstone and not is_entity_expired(entity)
+
+def _new_version():
+    """ Returns the version of an entity written without reading the previous one: the time in microseconds,
+    followed by VERSION_RANDOM_BITS random bits. """
+    return (int(time_pkg.time() * 1000000) << VERSION_RANDOM_BITS) | random.getrandbits(VERSION_RANDOM_BITS)
+
+def _next_version(entity):
+    """ Returns the version following that of an entity read within a transaction. """
+    return entity.version + 1 if entity.version is not None else _new_version()
+
+def _get_cas_id(entity):
+    """ Returns the cas id of an entity: its version, or its write time if it predates versions. """
+    if entity.version is not None:
+        return entity.version
+    return entity.cas_id or 0 # existing dscache entries may not have a cas_id
+
+def create_entity(key, value, time=0, key_prefix='', namespace=None, min_compress_len=0, serializer=None,
+                  entity_format=None):
     """ Creates a new _DSCache entity (without putting it). """
     key = build_ds_key(key, key_prefix=key_prefix, namespace=namespace)
     entity = _DSCache(key=key)
-    set_value_on_entity(entity, value)
+    set_value_on_entity(entity, value, min_compress_len=min_compress_len, serializer=serializer,
+                        entity_format=entity_format)
+    _split_entity(entity)
     if time:
         entity.timeout = compute_timeout(time)
-    entity.cas_id = time_pkg.time()
+    _set_generation(entity, namespace)
+    entity.version = _new_version()
     return entity
 
-def set(key, value, time=0, namespace=None, **ctx_options):
+@_measured('set', fallback=_short_circuit_false)
+@ndb.tasklet
+def set_async(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
     """ Sets a key's value, regardless of previous contents in cache.
 
-    The return value is True if set, False on error.
+    The return value is a future whose result is True if set, False on error.
+    """
+    entity = create_entity(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                           serializer=serializer)
+    result = yield _set_entity_async(entity, key, namespace=namespace, **ctx_options)
+    raise ndb.Return(result)
+
+@ndb.tasklet
+def _set_entity_async(entity, key, namespace=None, **ctx_options):
+    """ Puts an entity made by create_entity(), as set() does.
+
+    The return value is a future whose result is True if set, False on error.
     """
-    entity = create_entity(key, value, time=time, namespace=namespace)
     try:
-        entity.put(**ctx_options)
+        yield _bloom_add_async([entity.key], namespace)
+        yield _rpc_async(_put_entities_async([entity], **ctx_options))
     except Exception:
         logging.exception('dscache: error on dscache.set(). %s', key)
-        return False
-    else:
-        return True
+        _record_error('set')
+        _local_delete(entity.key)
+        raise ndb.Return(False)
+    _stats.record_write(items=1, bytes_written=entity_size(entity))
+    _local_put(entity)
+    raise ndb.Return(True)
+
+def set(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
+    """ Sets a key's value, regardless of previous contents in cache.
+
+    The return value is True if set, False on error.
+    """
+    return set_async(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                     serializer=serializer, **ctx_options).get_result()
 
 def _chunks(l, n):
     """ Breaks a list l into chunks of maximum size n. """
     return [l[i:i+n] for i in range(0, len(l), n)]
 
-def set_multi(mapping, time=0, key_prefix='', namespace=None, **ctx_options):
-    """ Set multiple keys' values at once. Reduces the network latency of doing many requests in serial.
+@ndb.tasklet
+def _dispatch_chunks_async(fn, chunks, max_concurrency=None):
+    """ Calls the tasklet fn on every chunk, keeping at most max_concurrency calls in flight.
 
-    The return value is a list of keys whose values were NOT set. On total success, this list should be empty.
+    The return value is a future whose result is the list of fn results, in chunk order.
+    """
+    max_concurrency = max_concurrency or MAX_CONCURRENT_RPCS
+    results = [None] * len(chunks)
+    pending = iter(enumerate(chunks))
+    @ndb.tasklet
+    def worker():
+        """ Pulls chunks off the shared iterator until it is exhausted. """
+        for i, chunk in pending:
+            results[i] = yield fn(chunk)
+    yield [worker() for _ in range(min(max_concurrency, len(chunks)))]
+    raise ndb.Return(results)
+
+@_measured('set_multi', fallback=_short_circuit_keys)
+@ndb.tasklet
+def set_multi_async(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+                    serializer=None, **ctx_options):
+    """ Set multiple keys' values at once. Reduces the network latency of doing many requests in serial.
 
-    Datastore has a limit of 500 entities at a time on put(), so if there are more than 500 passed, they
-    are put() 500 at a time until the mapping is exhausted. If this causes too much delay, the client should
-    subset the mapping before calling this function.
+    The return value is a future whose result is a list of keys whose values were NOT set.
     """
     # create a list of tuples: [ (entity_for_datastore, mapping_key), ... ]
-    entity_key_tuples = [(create_entity(key, value, time=time, key_prefix=key_prefix, namespace=namespace), key)
+    entity_key_tuples = [(create_entity(key, value, time=time, key_prefix=key_prefix, namespace=namespace,
+                                        min_compress_len=min_compress_len, serializer=serializer), key)
                          for key, value in list(mapping.items())]
 
-    # chunk tuples into lists of max 500
-    entities = _chunks(entity_key_tuples, 500)
-
-    failed_keys = []
-    for sub_list in entities:
+    @ndb.tasklet
+    def put_chunk(sub_list):
+        """ Puts one chunk, returning the keys that failed. """
         entities, keys = list(zip(*sub_list))
         try:
-            ndb.put_multi(entities, **ctx_options)
+            yield _rpc_async(_put_entities_async(entities, **ctx_options))
         except Exception:
             s = str(keys)
             if len(s) > 50:
                 s = s[:50]
                 s += '...'
             logging.exception('dscache: error on dscache.set_multi(). %s', s)
-            failed_keys.extend(keys)
-    return failed_keys
+            _record_error('set_multi')
+            for entity in entities:
+                _local_delete(entity.key)
+            raise ndb.Return(list(keys))
+        _stats.record_write(items=len(entities), bytes_written=sum(entity_size(entity) for entity in entities))
+        for entity in entities:
+            _local_put(entity)
+        raise ndb.Return([])
+
+    yield _bloom_add_async([entity.key for entity, unused_key in entity_key_tuples], namespace)
+    results = yield _dispatch_chunks_async(put_chunk, _chunks(entity_key_tuples, MAX_BATCH_SIZE),
+                                           max_concurrency=max_concurrency)
+    raise ndb.Return([key for failed_keys in results for key in failed_keys])
+
+def set_multi(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+              serializer=None, **ctx_options):
+    """ Set multiple keys' values at once. Reduces the network latency of doing many requests in serial.
 
-def _get_entity(key, namespace=None, **ctx_options):
+    The return value is a list of keys whose values were NOT set. On total success, this list should be empty.
+
+    Datastore has a limit of 500 entities at a time on put(), so the mapping is put() in chunks of
+    MAX_BATCH_SIZE, with up to max_concurrency (default MAX_CONCURRENT_RPCS) chunks in flight at once.
+    """
+    return set_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                           max_concurrency=max_concurrency, min_compress_len=min_compress_len,
+                           serializer=serializer, **ctx_options).get_result()
+
+@ndb.tasklet
+def _get_entity_async(key, namespace=None, allow_expired=False, **ctx_options):
     """ Looks up a single entity in dscache.
 
-    The return value is the entity, if found in dscache, else None.
+    The return value is a future whose result is the entity, if found in dscache (expired or not, if
+    allow_expired is True), else None.
     """
     ds_key = build_ds_key(key, namespace=namespace)
     try:
-        entity = ds_key.get(**ctx_options)
-        if is_entity_expired(entity):
-            return None
+        entity = yield _rpc_async(ds_key.get_async(**ctx_options))
+        if not allow_expired and is_entity_expired(entity):
+            _stats.record_read(expired=1)
+            raise ndb.Return(None)
+        if entity and entity.tombstone:
+            raise ndb.Return(None)
+        yield _load_chunks_async([entity], **ctx_options)
+    except ndb.Return:
+        raise
     except Exception:
         logging.exception('dscache: error on dscache.get(). %s', key)
-        return None
-    else:
-        return entity
+        _record_error('get')
+        raise ndb.Return(None)
+    raise ndb.Return(entity)
+
+def _get_entity(key, namespace=None, **ctx_options):
+    """ Looks up a single entity in dscache.
+
+    The return value is the entity, if found in dscache, else None.
+    """
+    return _get_entity_async(key, namespace=namespace, **ctx_options).get_result()
+
+@_measured('get', fallback=_short_circuit_none)
+@ndb.tasklet
+def get_async(key, namespace=None, **ctx_options):
+    """ Looks up a single key in dscache.
+
+    The return value is a future whose result is the value of the key, if found in dscache, else None.
+    """
+    ds_key = build_ds_key(key, namespace=namespace)
+    if AUTO_BATCH_GETS:
+        value = yield _queue_get(ds_key, namespace, ctx_options)
+        raise ndb.Return(value)
+    entity = None
+    if _local_cache is not None:
+        entity = _local_cache.get(ds_key)
+        if entity is None and _local_cache.is_missing(ds_key):
+            _stats.record_read(misses=1)
+            raise ndb.Return(None)
+    if entity is None and (yield _bloom_prune_async([ds_key], namespace)):
+        entity = yield _get_entity_async(key, namespace=namespace, **ctx_options)
+        if entity:
+            _local_put(entity)
+    if entity:
+        _stats.record_read(hits=1, bytes_read=entity_size(entity))
+        raise ndb.Return(get_value_from_entity(entity))
+    _stats.record_read(misses=1)
+    raise ndb.Return(None)
 
 def get(key, namespace=None, **ctx_options):
     """ Looks up a single key in dscache.
 
     The return value is the value of the key, if found in dscache, else None.
     """
-    entity = _get_entity(key, namespace=namespace, **ctx_options)
-    if entity:
-        return get_value_from_entity(entity)
-    else:
-        return None
+    return get_async(key, namespace=namespace, **ctx_options).get_result()
 
-def get_multi(keys, key_prefix='', namespace=None, **ctx_options):
+def _queue_get(ds_key, namespace, ctx_options):
+    """ Queues a lookup for the next batch of the current event loop; the batch is looked up once the loop is idle,
+    or GET_BATCH_WINDOW seconds after its first lookup.
+
+    The return value is a future whose result is the value of the key, if found in dscache, else None.
+    """
+    # the event loop is per thread and per request, so its batches are too
+    loop = eventloop.get_event_loop()
+    batches = getattr(loop, '_dscache_get_batches', None)
+    if batches is None:
+        batches = loop._dscache_get_batches = collections.OrderedDict()
+    if not batches:
+        if GET_BATCH_WINDOW:
+            loop.queue_call(GET_BATCH_WINDOW, _flush_gets, loop)
+        else:
+            loop.add_idle(_flush_gets, loop)
+    future = ndb.Future('dscache.get')
+    batch = batches.setdefault((namespace, tuple(sorted(ctx_options.items()))), collections.OrderedDict())
+    batch.setdefault(ds_key, []).append(future)
+    return future
+
+def _flush_gets(loop):
+    """ Looks up the queued keys of an event loop, with one lookup per namespace and set of context options. """
+    batches, loop._dscache_get_batches = loop._dscache_get_batches, collections.OrderedDict()
+    for (namespace, options), batch in batches.items():
+        future = _get_entity_map_async(list(batch), namespace=namespace, **dict(options))
+        future.add_callback(_resolve_gets, future, batch)
+
+def _resolve_gets(future, batch):
+    """ Resolves the futures of a batch of lookups. """
+    exception = future.get_exception()
+    if exception is not None:
+        for waiters in batch.values():
+            for waiter in waiters:
+                waiter.set_exception(exception, future.get_traceback())
+        return
+    entity_map = future.get_result()
+    for ds_key, waiters in batch.items():
+        entity = entity_map.get(ds_key)
+        try:
+            value = get_value_from_entity(entity) if entity else None
+        except Exception as e:
+            # a value that cannot be decoded fails its own lookups, not the caller running the event loop
+            for waiter in waiters:
+                waiter.set_exception(e)
+            continue
+        for waiter in waiters:
+            waiter.set_result(value)
+
+@ndb.tasklet
+def _get_entities_async(ds_keys, max_concurrency=None, failed=None, **ctx_options):
+    """ Fetches entities in concurrent chunks of MAX_BATCH_SIZE.
+
+    The return value is a future whose result is a list of entities (or None) in ds_keys order.
+    A chunk that fails is logged and treated as all misses; its keys are added to the failed list, if given.
+    """
+    @ndb.tasklet
+    def get_chunk(chunk):
+        """ Gets one chunk of keys. """
+        try:
+            entities = yield _rpc_async(ndb.get_multi_async(chunk, **ctx_options))
+        except Exception:
+            s = str([ds_key.string_id() for ds_key in chunk])
+            logging.exception('dscache: error on dscache.get_multi(). %s', s[:50])
+            _record_error('get_multi')
+            if failed is not None:
+                failed.extend(chunk)
+            raise ndb.Return([None] * len(chunk))
+        raise ndb.Return(entities)
+
+    results = yield _dispatch_chunks_async(get_chunk, _chunks(ds_keys, MAX_BATCH_SIZE),
+                                           max_concurrency=max_concurrency)
+    raise ndb.Return([entity for entities in results for entity in entities])
+
+@_measured('get_multi', fallback=_short_circuit_dict)
+@ndb.tasklet
+def get_multi_async(keys, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
+    """ Looks up multiple keys from dscache in one operation.
+
+    The return value is a future whose result is a dictionary of the keys and values that were present in dscache.
+    """
+    values = yield _get_values_async(keys, key_prefix=key_prefix, namespace=namespace,
+                                     max_concurrency=max_concurrency, **ctx_options)
+    raise ndb.Return({key: value for key, value in values.items() if value})
+
+@ndb.tasklet
+def _get_values_async(keys, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
+    """ Looks up multiple keys like get_multi(), but keeps falsy values.
+
+    The return value is a future whose result is a dictionary of the keys found and their values.
+    """
+    key_map = {key: build_ds_key(key, key_prefix=key_prefix, namespace=namespace) for key in keys}
+    entity_map = yield _get_entity_map_async(list(key_map.values()), namespace=namespace,
+                                             max_concurrency=max_concurrency, **ctx_options)
+    raise ndb.Return({key: get_value_from_entity(entity_map[ds_key]) for key, ds_key in key_map.items()
+                      if is_entity_live(entity_map.get(ds_key))})
+
+@ndb.tasklet
+def _get_entity_map_async(ds_keys, namespace=None, max_concurrency=None, **ctx_options):
+    """ Looks up entities of a namespace, in the local cache first, and records the reads. Keys that the Bloom
+    filter shows were never set are not looked up.
+
+    The return value is a future whose result is a dictionary of the keys and live entities found.
+    """
+    entity_map = {}
+    missing = ds_keys
+    if _local_cache is not None:
+        for ds_key in ds_keys:
+            entity = _local_cache.get(ds_key)
+            if entity is not None:
+                entity_map[ds_key] = entity
+        missing = [ds_key for ds_key in ds_keys if ds_key not in entity_map and not _local_cache.is_missing(ds_key)]
+    missing = yield _bloom_prune_async(missing, namespace)
+    failed = []
+    entities = yield _get_entities_async(missing, max_concurrency=max_concurrency, failed=failed, **ctx_options)
+    expired = sum(1 for entity in entities if is_entity_expired(entity))
+    entities = [entity for entity in entities if is_entity_live(entity)]
+    try:
+        yield _load_chunks_async(entities, **ctx_options)
+    except Exception:
+        logging.exception('dscache: error on dscache.get_multi() chunks.')
+        _record_error('get_multi')
+        failed.extend(entity.key for entity in entities if entity.chunk_count)
+        entities = [entity for entity in entities if not entity.chunk_count]
+    for entity in entities:
+        entity_map[entity.key] = entity
+        _local_put(entity)
+    if _local_cache is not None:
+        failed = frozenset(failed)
+        for ds_key in missing:
+            if ds_key not in entity_map and ds_key not in failed:
+                _local_cache.put_missing(ds_key)
+    _stats.record_read(hits=len(entity_map), misses=len(ds_keys) - len(entity_map), expired=expired,
+                       bytes_read=sum(entity_size(entity) for entity in entity_map.values()))
+    raise ndb.Return(entity_map)
+
+def get_multi(keys, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
     """ Looks up multiple keys from dscache in one operation. This is the recommended way to do bulk loads.
 
     The returned value is a dictionary of the keys and values that were present in dscache.
     Even if the key_prefix was specified, that key_prefix won't be on the keys in the returned dictionary.
+
+    Keys are fetched in chunks of MAX_BATCH_SIZE, with up to max_concurrency chunks in flight at once.
     """
-    ds_keys = [build_ds_key(key, key_prefix=key_prefix, namespace=namespace) for key in keys]
+    return get_multi_async(keys, key_prefix=key_prefix, namespace=namespace, max_concurrency=max_concurrency,
+                           **ctx_options).get_result()
+
+def _build_lease_key(key):
+    """ Builds the key of the get_or_compute() lease on a key. """
+    return '%s%s' % (_LEASE_PREFIX, key)
+
+@ndb.tasklet
+def _compute_async(fn, *args):
+    """ Calls fn, which may return a value or a future. """
+    result = fn(*args)
+    if isinstance(result, ndb.Future):
+        result = yield result
+    raise ndb.Return(result)
+
+@ndb.tasklet
+def _fill_entity_async(entity, **ctx_options):
+    """ Puts entity in a transaction, if and only if there is no live delete lock (tombstone) at its key, so that a
+    value computed from a lookup made before a delete is not stored over it.
+
+    The return value is a future whose result is True if the entity was put, False otherwise.
+    """
+    @ndb.tasklet
+    def tx():
+        """ Checks for a delete lock, and puts the entity if there is none. """
+        existing_entity = yield entity.key.get_async(**ctx_options)
+        if existing_entity and existing_entity.tombstone and not is_entity_expired(existing_entity):
+            raise ndb.Return(False)
+        yield _put_entities_async([entity], **ctx_options)
+        raise ndb.Return(True)
+    filled = yield _rpc_async(ndb.transaction_async(tx))
+    if filled:
+        _stats.record_write(items=1, bytes_written=entity_size(entity))
+        _local_put(entity)
+    raise ndb.Return(filled)
+
+@ndb.tasklet
+def _fill_entities_async(entities, op, namespace=None, max_concurrency=None, **ctx_options):
+    """ Stores the entities of values computed by get_or_compute() or its variants, each with _fill_entity_async()
+    in its own transaction. Errors are logged and counted under op. """
+    yield _bloom_add_async([entity.key for entity in entities], namespace)
+
+    @ndb.tasklet
+    def fill_one(chunk):
+        """ Stores a single entity. """
+        entity = chunk[0]
+        try:
+            yield _fill_entity_async(entity, **ctx_options)
+        except Exception:
+            logging.exception('dscache: error on dscache.%s(). %s', op, entity.key.string_id())
+            _record_error(op)
+            _local_delete(entity.key)
+
+    yield _dispatch_chunks_async(fill_one, _chunks(entities, 1), max_concurrency=max_concurrency)
+
+@ndb.tasklet
+def _compute_and_set_async(key, fn, time=0, namespace=None, serializer=None, **ctx_options):
+    """ Computes a value with fn() and stores it, unless the key is delete locked, recording on the entity how long
+    the computation took.
+
+    The return value is a future whose result is the value.
+    """
+    start = time_pkg.time()
+    value = yield _compute_async(fn)
+    entity = create_entity(key, value, time=time, namespace=namespace, serializer=serializer)
+    entity.compute_seconds = time_pkg.time() - start
+    yield _fill_entities_async([entity], 'get_or_compute', namespace=namespace, **ctx_options)
+    raise ndb.Return(value)
+
+def _should_refresh(entity, beta):
+    """ Returns True if a hit on entity should recompute it ahead of its timeout, as in XFetch: the probability
+    rises as the timeout nears, scaled by beta and by how long the value took to compute. """
+    if not beta or not entity.timeout or not entity.compute_seconds:
+        return False
+    remaining = (entity.timeout - datetime.datetime.utcnow()).total_seconds()
+    return -entity.compute_seconds * beta * math.log(1.0 - random.random()) >= remaining
+
+@ndb.tasklet
+def _refresh_async(key, fn, version, time=0, namespace=None, lease_time=LEASE_SECONDS, serializer=None,
+                   **ctx_options):
+    """ Recomputes and sets the value read at version if the get_or_compute() lease on its key can be taken, and
+    no one has written the key since. Errors are logged, and the lease is then kept until it expires, so that
+    callers keep getting the current value meanwhile rather than each calling fn again.
+
+    The return value is a future whose result is the recomputed value, or None if it was not recomputed.
+    """
+    lease_key = _build_lease_key(key)
+    leased = yield add_async(lease_key, True, time=lease_time, namespace=namespace, **ctx_options)
+    if not leased:
+        raise ndb.Return(None)
     try:
-        entities = ndb.get_multi(ds_keys, **ctx_options)
+        entity = yield _get_entity_async(key, namespace=namespace, allow_expired=True, **ctx_options)
+        # otherwise refreshed by a previous lease holder
+        value = None
+        if not entity or entity.version == version:
+            value = yield _compute_and_set_async(key, fn, time=time, namespace=namespace, serializer=serializer,
+                                                 **ctx_options)
     except Exception:
-        s = str(keys)
-        logging.exception('dscache: error on dscache.get_multi(). %s', s[:50])
-        return {}
-    else:
-        entity_map = {entity.key: entity for entity in entities if entity}
-        result = {}
-        for key in keys:
-            ds_key = build_ds_key(key, key_prefix=key_prefix, namespace=namespace)
-            if ds_key in entity_map:
-                value = get_value_from_entity(entity_map[ds_key])
-                if value:
-                    result[key] = value
-        return result
+        logging.exception('dscache: error refreshing "%s" ahead of its timeout.', key)
+        _stats.record_error('get_or_compute')
+        raise ndb.Return(None)
+    yield delete_async(lease_key, namespace=namespace, **ctx_options)
+    raise ndb.Return(value)
+
+def _get_stale_value(entity, stale_ttl=0):
+    """ Gets the value of an expired entity, if it expired less than stale_ttl seconds ago (or at all, without a
+    stale_ttl), else None. """
+    if not entity:
+        return None
+    if stale_ttl and entity.timeout + datetime.timedelta(seconds=stale_ttl) < datetime.datetime.utcnow():
+        return None
+    return get_value_from_entity(entity, allow_expired=True)
+
+@ndb.tasklet
+def _get_or_compute_async(key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                          serializer=None, refresh_ahead=0, stale_ttl=0, stale_if_error=False, refreshes=None,
+                          **ctx_options):
+    """ Looks up a single key in dscache, computing and storing its value with fn() on a miss.
+
+    The futures of the refreshes started, which are not waited for, are appended to refreshes, if given.
+
+    The return value is a future whose result is a tuple (value, stale).
+    """
+    entity = None
+    use_cache = (_breaker is None or _breaker.allow()) and _has_generations(namespace)
+    if use_cache:
+        ds_key = build_ds_key(key, namespace=namespace)
+        entity = _local_cache.get(ds_key) if _local_cache is not None else None
+        if entity is None:
+            entity = yield _get_entity_async(key, namespace=namespace, allow_expired=True, **ctx_options)
+            # the lookup may be the probe of a half-open breaker, whose failure opened it again
+            use_cache = _breaker is None or _breaker.state != OPEN
+    if not use_cache:
+        # Datastore is failing: computing the value is faster than waiting on it, and storing it may be impossible
+        value = yield _compute_async(fn)
+        raise ndb.Return((value, False))
+    if entity and not is_entity_expired(entity):
+        _local_put(entity)
+        _stats.record_read(hits=1, bytes_read=entity_size(entity))
+        if _should_refresh(entity, refresh_ahead):
+            refresh = _refresh_async(key, fn, entity.version, time=time, namespace=namespace, lease_time=lease_time,
+                                     serializer=serializer, **ctx_options)
+            if refreshes is not None:
+                refreshes.append(refresh)
+        raise ndb.Return((get_value_from_entity(entity), False))
+    _stats.record_read(misses=1)
+
+    stale_value = _get_stale_value(entity, stale_ttl=stale_ttl)
+    if stale_ttl and stale_value is not None:
+        # serve the stale value while the lease holder revalidates it
+        refresh = _refresh_async(key, fn, entity.version, time=time, namespace=namespace, lease_time=lease_time,
+                                 serializer=serializer, **ctx_options)
+        if refreshes is not None:
+            refreshes.append(refresh)
+        raise ndb.Return((stale_value, True))
+
+    lease_key = _build_lease_key(key)
+    leased = yield add_async(lease_key, True, time=lease_time, namespace=namespace, **ctx_options)
+    if not leased:
+        # someone else is computing the value: serve the previous one, or wait for theirs
+        if stale_value is not None:
+            raise ndb.Return((stale_value, True))
+        deadline = time_pkg.time() + wait
+        while time_pkg.time() < deadline:
+            yield ndb.sleep(LEASE_POLL_SECONDS)
+            entity = yield _get_entity_async(key, namespace=namespace, **ctx_options)
+            if entity:
+                raise ndb.Return((get_value_from_entity(entity), False))
+        # the holder is too slow, or died: compute the value without the lease
+    try:
+        value = yield _compute_and_set_async(key, fn, time=time, namespace=namespace, serializer=serializer,
+                                             **ctx_options)
+    except Exception:
+        if not stale_if_error or stale_value is None:
+            raise
+        logging.exception('dscache: error computing "%s", serving its expired value.', key)
+        _stats.record_error('get_or_compute')
+        raise ndb.Return((stale_value, True))
+    finally:
+        if leased:
+            yield delete_async(lease_key, namespace=namespace, **ctx_options)
+    raise ndb.Return((value, False))
+
+@_measured('get_or_compute')
+@ndb.tasklet
+def get_or_compute_async(key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                         serializer=None, refresh_ahead=0, stale_ttl=0, stale_if_error=False, refreshes=None,
+                         **ctx_options):
+    """ Looks up a single key in dscache, computing and storing its value with fn() on a miss.
+
+    The future of the refresh or revalidation it may start is appended to refreshes, if given, for the caller to
+    wait on; its result is the new value, or None if this caller did not recompute it.
+
+    The return value is a future whose result is the value.
+    """
+    value, _ = yield _get_or_compute_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                           serializer=serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                           stale_if_error=stale_if_error, refreshes=refreshes, **ctx_options)
+    raise ndb.Return(value)
+
+def get_or_compute(key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                   serializer=None, refresh_ahead=0, stale_ttl=0, stale_if_error=False, **ctx_options):
+    """ Looks up a single key in dscache, computing and storing its value with fn() on a miss.
+
+    Only one caller at a time computes a missing value: it takes a lease on the key, which is an add() of a lock
+    entry lasting lease_time seconds, so that a lease whose holder dies expires on its own. Callers that do not get
+    the lease return the expired value, if there is one, or wait up to wait seconds for the holder to store the
+    new value, after which they compute it themselves. fn may return the value or a future. Values are stored in a
+    transaction that skips keys with a live delete lock (see delete()), whose computed value is only returned.
+
+    With a refresh_ahead factor (XFetch's beta; 1 is a good start), a hit may also recompute the value before its
+    timeout, so that keys written with the same time do not all miss at once. The chance of an early refresh grows
+    as the timeout nears and with how long fn took the last time. The hit still returns the cached value at once:
+    the caller that gets the lease starts the recompute without waiting for it, as described below, and every other
+    caller gets the cached value until it is stored. Values set other than through get_or_compute() are not
+    refreshed early.
+
+    time is the soft TTL of the value. With a stale_ttl, a value that expired less than stale_ttl seconds ago is
+    returned straight away while one caller revalidates it in the same way; an older one is never returned (see
+    Vacuum's grace to keep expired values that long). With stale_if_error, the expired value is returned if fn
+    raises an exception, rather than the exception; see get_or_revalidate() to tell stale values apart.
+
+    Refreshes and revalidations are not waited for: they run on the request's ndb event loop after this returns,
+    so decorate the request handler with ndb.toplevel for them to finish, or use get_or_compute_async() and wait on
+    its refreshes to get the new value. One that fails, or is cut short with its request, keeps the lease until
+    lease_time runs out, and callers keep getting the current value until another caller takes it again.
+
+    The return value is the value of the key.
+    """
+    return get_or_compute_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                serializer=serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                stale_if_error=stale_if_error, **ctx_options).get_result()
+
+@_measured('get_or_revalidate')
+def get_or_revalidate_async(key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                            serializer=None, refresh_ahead=0, stale_ttl=0, stale_if_error=False, refreshes=None,
+                            **ctx_options):
+    """ Looks up a single key in dscache like get_or_compute(), also telling whether the value is stale. The
+    future of a refresh or revalidation it starts is appended to refreshes, as by get_or_compute_async(); a value
+    it results in is no longer stale.
+
+    The return value is a future whose result is a tuple (value, stale).
+    """
+    return _get_or_compute_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                 serializer=serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                 stale_if_error=stale_if_error, refreshes=refreshes, **ctx_options)
+
+def get_or_revalidate(key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                      serializer=None, refresh_ahead=0, stale_ttl=0, stale_if_error=False, **ctx_options):
+    """ Looks up a single key in dscache like get_or_compute(), also telling whether the value is stale: one
+    that expired and was served while it is revalidated, to a caller without the lease, or because fn failed.
+
+    The return value is a tuple (value of the key, whether it is stale).
+    """
+    return get_or_revalidate_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                   serializer=serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                   stale_if_error=stale_if_error, **ctx_options).get_result()
+
+@_measured('get_or_compute_multi')
+@ndb.tasklet
+def get_or_compute_multi_async(keys, fn, time=0, key_prefix='', namespace=None, lease_time=LEASE_SECONDS,
+                               wait=LEASE_WAIT_SECONDS, serializer=None, **ctx_options):
+    """ Looks up multiple keys in dscache, computing and storing the missing values with fn(keys).
+
+    The return value is a future whose result is a dictionary of the keys and their values.
+    """
+    use_cache = (_breaker is None or _breaker.allow()) and _has_generations(namespace)
+    if use_cache:
+        result = yield _get_values_async(keys, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        # the lookup may be the probe of a half-open breaker, whose failure opened it again
+        use_cache = _breaker is None or _breaker.state != OPEN
+    if not use_cache:
+        result = yield _compute_async(fn, list(keys))
+        raise ndb.Return(result)
+    missing = [key for key in keys if key not in result]
+    if not missing:
+        raise ndb.Return(result)
+
+    lease_keys = {_build_lease_key(key_prefix + key): key for key in missing}
+    not_leased = yield add_multi_async({lease_key: True for lease_key in lease_keys}, time=lease_time,
+                                       namespace=namespace, **ctx_options)
+    not_leased = {lease_keys[lease_key] for lease_key in not_leased}
+    leased = [key for key in missing if key not in not_leased]
+    waiting = [key for key in missing if key in not_leased]
+
+    if waiting:
+        # serve the previous values of keys someone else is computing, and wait for the rest
+        stale_entities = yield _get_entities_async([build_ds_key(key, key_prefix=key_prefix, namespace=namespace)
+                                                    for key in waiting], **ctx_options)
+        yield _load_chunks_async(stale_entities, **ctx_options)
+        for key, entity in zip(waiting, stale_entities):
+            stale_value = get_value_from_entity(entity, allow_expired=True)
+            if stale_value is not None:
+                result[key] = stale_value
+        waiting = [key for key in waiting if key not in result]
+        deadline = time_pkg.time() + wait
+        while waiting and time_pkg.time() < deadline:
+            yield ndb.sleep(LEASE_POLL_SECONDS)
+            result.update((yield _get_values_async(waiting, key_prefix=key_prefix, namespace=namespace,
+                                                   **ctx_options)))
+            waiting = [key for key in waiting if key not in result]
+
+    # compute the leased keys, and those whose holder is too slow or died
+    compute = leased + waiting
+    try:
+        if compute:
+            values = yield _compute_async(fn, compute)
+            entities = [create_entity(key, value, time=time, key_prefix=key_prefix, namespace=namespace,
+                                      serializer=serializer)
+                        for key, value in values.items()]
+            yield _fill_entities_async(entities, 'get_or_compute_multi', namespace=namespace, **ctx_options)
+            result.update(values)
+    finally:
+        if leased:
+            yield delete_multi_async([_build_lease_key(key_prefix + key) for key in leased], namespace=namespace,
+                                     **ctx_options)
+    raise ndb.Return(result)
+
+def get_or_compute_multi(keys, fn, time=0, key_prefix='', namespace=None, lease_time=LEASE_SECONDS,
+                         wait=LEASE_WAIT_SECONDS, serializer=None, **ctx_options):
+    """ Looks up multiple keys in dscache, computing and storing the missing values with fn(keys), where fn
+    returns a dictionary of keys and values (or a future of one). Leases are taken on the missing keys with a
+    single add_multi(), and each key is otherwise handled as by get_or_compute().
+
+    The return value is a dictionary of the keys and their values; a key missing from the dictionary returned
+    by fn is missing from it too.
+    """
+    return get_or_compute_multi_async(keys, fn, time=time, key_prefix=key_prefix, namespace=namespace,
+                                      lease_time=lease_time, wait=wait, serializer=serializer,
+                                      **ctx_options).get_result()
+
+def _build_tombstone(ds_key, seconds):
+    """ Creates the tombstone left at ds_key by a delete lasting the given number of seconds. """
+    return _DSCache(key=ds_key, tombstone=True, timeout=compute_timeout(seconds),
+                   version=_new_version())
+
+@_measured('delete', fallback=_short_circuit_false)
+@ndb.tasklet
+def delete_async(key, seconds=0, namespace=None, **ctx_options):
+    """ Deletes a key from dscache.
+
+    The return value is a future whose result is True if successful, False otherwise.
+    """
+    ds_key = build_ds_key(key, namespace=namespace)
+    _local_delete(ds_key)
+    try:
+        if seconds:
+            yield _rpc_async(_build_tombstone(ds_key, seconds).put_async(**ctx_options))
+        else:
+            yield _rpc_async(ds_key.delete_async(**ctx_options))
+    except Exception:
+        logging.exception('dscache: error on dscache.delete() %s', key)
+        _record_error('delete')
+        raise ndb.Return(False)
+    raise ndb.Return(True)
 
 def delete(key, seconds=0, namespace=None, **ctx_options):
     """ Deletes a key from dscache.
@@ -248,85 +1524,357 @@ def delete(key, seconds=0, namespace=None, **ctx_options):
     #if the server tried to delete the item but didn't have it, and 2 (DELETE_SUCCESSFUL) if the
     #item was actually deleted. This can be used as a boolean value, where a network failure is the only bad condition.
 
+    If seconds is given, the entry is replaced by a tombstone for that many seconds, during which add() and
+    replace() of the key fail, and get_or_compute() and its variants do not store the values they compute (set()
+    still succeeds). Tombstones are reclaimed by Vacuum like expired entries.
+
     Returns True if successful, False otherwise.
     """
-    if seconds != 0:
-        raise NotImplementedError('delete lock not implemented.')
-    ds_key = build_ds_key(key, namespace=namespace)
-    try:
-        ds_key.delete(**ctx_options)
-    except Exception:
-        logging.exception('dscache: error on dscache.delete() %s', key)
-        return False
-    else:
-        return True
+    return delete_async(key, seconds=seconds, namespace=namespace, **ctx_options).get_result()
 
-def delete_multi(keys, seconds=0, key_prefix='', namespace=None, **ctx_options):
+@_measured('delete_multi', fallback=_short_circuit_false)
+@ndb.tasklet
+def delete_multi_async(keys, seconds=0, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
     """ Delete multiple keys at once.
 
-    The return value is True if all operations completed successfully. False if one or more failed to complete.
+    The return value is a future whose result is True if all operations completed successfully.
     """
-    if seconds != 0:
-        raise NotImplementedError('delete lock not implemented.')
     ds_keys = [build_ds_key(key, key_prefix=key_prefix, namespace=namespace) for key in keys]
-    try:
-        ndb.delete_multi(ds_keys, **ctx_options)
-    except Exception:
-        s = str(keys)
-        logging.exception('dscache: error on dscache.delete_multi(). %s', s[:50])
-        return False
-    else:
-        return True
+    for ds_key in ds_keys:
+        _local_delete(ds_key)
+
+    @ndb.tasklet
+    def delete_chunk(chunk):
+        """ Deletes one chunk of keys, returning False on error. """
+        try:
+            if seconds:
+                yield _rpc_async(ndb.put_multi_async([_build_tombstone(ds_key, seconds) for ds_key in chunk],
+                                                     **ctx_options))
+            else:
+                yield _rpc_async(ndb.delete_multi_async(chunk, **ctx_options))
+        except Exception:
+            s = str([ds_key.string_id() for ds_key in chunk])
+            logging.exception('dscache: error on dscache.delete_multi(). %s', s[:50])
+            _record_error('delete_multi')
+            raise ndb.Return(False)
+        raise ndb.Return(True)
+
+    results = yield _dispatch_chunks_async(delete_chunk, _chunks(ds_keys, MAX_BATCH_SIZE),
+                                           max_concurrency=max_concurrency)
+    raise ndb.Return(all(results))
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
+    """ Delete multiple keys at once.
+
+    The return value is True if all operations completed successfully. False if one or more failed to complete.
+
+    Keys are deleted in chunks of MAX_BATCH_SIZE, with up to max_concurrency chunks in flight at once.
+    If seconds is given, the entries are replaced by tombstones, as for delete().
+    """
+    return delete_multi_async(keys, seconds=seconds, key_prefix=key_prefix, namespace=namespace,
+                              max_concurrency=max_concurrency, **ctx_options).get_result()
+
+@ndb.tasklet
+def _add_entity_async(entity, **ctx_options):
+    """ Puts entity in a transaction, if and only if there is no unexpired entity at its key.
 
-def add(key, value, time=0, namespace=None, **ctx_options):
+    The return value is a future whose result is True if the entity was put, False otherwise.
+    """
+    @ndb.tasklet
+    def tx():
+        """ Tries to get an existing entity, and adds a new one if not found. """
+        # re-get the entity to lock it within the transaction
+        existing_entity = yield entity.key.get_async(**ctx_options)
+        if existing_entity and not is_entity_expired(existing_entity):
+            raise ndb.Return(False)
+        yield _put_entities_async([entity], **ctx_options)
+        raise ndb.Return(True)
+    added = yield _rpc_async(ndb.transaction_async(tx))
+    if added:
+        _stats.record_write(items=1, bytes_written=entity_size(entity))
+        _local_put(entity)
+    raise ndb.Return(added)
+
+@_measured('add', fallback=_short_circuit_false)
+@ndb.tasklet
+def add_async(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
     """ Sets a key's value, if and only if the item is not already in dscache.
 
-    The return value is True if added, False if not added or on an error.
+    The return value is a future whose result is True if added, False if not added or on an error.
     """
     # this should use get_or_insert, but that doesn't provide the information necessary to see if inserted,
     # so we aren't able to return the correct response
     ds_key = build_ds_key(key, namespace=namespace)
-    # perform an initial check as a performance optimization (not setting up a transaction)
-    existing_entity = ds_key.get(**ctx_options)
-    if existing_entity and not is_entity_expired(existing_entity):
-        return False
-    def tx():
-        """ Tries to get an existing entity, and adds a new one if not found. """
-        result = False
-        # re-get the entity to lock it within the transaction
-        existing_entity = ds_key.get(**ctx_options)
-        if (not existing_entity) or (is_entity_expired(existing_entity)):
-            entity = create_entity(key, value, time=time, namespace=namespace)
-            entity.put(**ctx_options)
-            result = True
-        return result
     try:
-        return ndb.transaction(tx)
+        # perform an initial check as a performance optimization (not setting up a transaction)
+        existing_entity = yield _rpc_async(ds_key.get_async(**ctx_options))
+        if existing_entity and not is_entity_expired(existing_entity):
+            raise ndb.Return(False)
+        entity = create_entity(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                               serializer=serializer)
+        if not _is_internal_key(key):
+            yield _bloom_add_async([entity.key], namespace)
+        added = yield _add_entity_async(entity, **ctx_options)
+    except ndb.Return:
+        raise
     except Exception:
         logging.exception('dscache: error on dscache.add(). %s', key)
-        return False
+        _record_error('add')
+        raise ndb.Return(False)
+    raise ndb.Return(added)
+
+def add(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
+    """ Sets a key's value, if and only if the item is not already in dscache.
+
+    The return value is True if added, False if not added or on an error.
+    """
+    return add_async(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                     serializer=serializer, **ctx_options).get_result()
+
+@_measured('add_multi', fallback=_short_circuit_keys)
+@ndb.tasklet
+def add_multi_async(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+                    serializer=None, **ctx_options):
+    """ Adds multiple values at once, with no effect for keys already in dscache.
 
-def add_multi(mapping, time=0, key_prefix='', namespace=None, **ctx_options):
+    The return value is a future whose result is a list of keys whose values were not set.
+    """
+    entities = {key: create_entity(key, value, time=time, key_prefix=key_prefix, namespace=namespace,
+                                   min_compress_len=min_compress_len, serializer=serializer)
+                for key, value in list(mapping.items())}
+    keys = list(entities.keys())
+
+    # one batched check filters out the keys that are already present, without setting up transactions
+    existing_entities = yield _get_entities_async([entities[key].key for key in keys],
+                                                  max_concurrency=max_concurrency, **ctx_options)
+    candidates = [key for key, existing_entity in zip(keys, existing_entities)
+                  if not existing_entity or is_entity_expired(existing_entity)]
+
+    @ndb.tasklet
+    def add_one(chunk):
+        """ Adds a single key in its own transaction. """
+        key = chunk[0]
+        try:
+            added = yield _add_entity_async(entities[key], **ctx_options)
+        except Exception:
+            logging.exception('dscache: error on dscache.add_multi(). %s', key)
+            _record_error('add_multi')
+            raise ndb.Return(False)
+        raise ndb.Return(added)
+
+    yield _bloom_add_async([entities[key].key for key in candidates if not _is_internal_key(key_prefix + key)],
+                           namespace)
+    results = yield _dispatch_chunks_async(add_one, _chunks(candidates, 1), max_concurrency=max_concurrency)
+    added_keys = {key for key, added in zip(candidates, results) if added}
+    raise ndb.Return([key for key in keys if key not in added_keys])
+
+def add_multi(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+              serializer=None, **ctx_options):
     """ Adds multiple values at once, with no effect for keys already in dscache.
 
     The return value is a list of keys whose values were not set because they were already set in dscache, or an empty list.
+
+    Existing keys are found with a single batched lookup; each remaining key is then added in its own
+    transaction, with up to max_concurrency transactions in flight at once.
     """
-    # this is difficult to do efficiently
-    raise NotImplementedError()
+    return add_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                           max_concurrency=max_concurrency, min_compress_len=min_compress_len,
+                           serializer=serializer, **ctx_options).get_result()
+
+@ndb.tasklet
+def _replace_entity_async(entity, **ctx_options):
+    """ Puts entity in a transaction, if and only if there is a live entity at its key.
 
-def replace(key, value, time=0, namespace=None, **ctx_options):
+    The return value is a future whose result is True if the entity was put, False otherwise.
+    """
+    @ndb.tasklet
+    def tx():
+        """ Checks for an existing entity, and replaces it if found. """
+        existing_entity = yield entity.key.get_async(**ctx_options)
+        if not is_entity_live(existing_entity):
+            raise ndb.Return(False)
+        yield _put_entities_async([entity], **ctx_options)
+        raise ndb.Return(True)
+    replaced = yield _rpc_async(ndb.transaction_async(tx))
+    if replaced:
+        _stats.record_write(items=1, bytes_written=entity_size(entity))
+        _local_put(entity)
+    raise ndb.Return(replaced)
+
+@_measured('replace', fallback=_short_circuit_false)
+@ndb.tasklet
+def replace_async(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
+    """ Replaces a key's value, failing if item isn't already in dscache.
+
+    The return value is a future whose result is True if replaced, False on error or cache miss.
+    """
+    ds_key = build_ds_key(key, namespace=namespace)
+    try:
+        # perform an initial check as a performance optimization (not setting up a transaction)
+        existing_entity = yield _rpc_async(ds_key.get_async(**ctx_options))
+        if not is_entity_live(existing_entity):
+            raise ndb.Return(False)
+        entity = create_entity(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                               serializer=serializer)
+        replaced = yield _replace_entity_async(entity, **ctx_options)
+    except ndb.Return:
+        raise
+    except Exception:
+        logging.exception('dscache: error on dscache.replace(). %s', key)
+        _record_error('replace')
+        raise ndb.Return(False)
+    raise ndb.Return(replaced)
+
+def replace(key, value, time=0, namespace=None, min_compress_len=0, serializer=None, **ctx_options):
     """ Replaces a key's value, failing if item isn't already in dscache.
 
     The return value is True if replaced. False on error or cache miss.
     """
-    raise NotImplementedError()
+    return replace_async(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                         serializer=serializer, **ctx_options).get_result()
+
+@_measured('replace_multi', fallback=_short_circuit_keys)
+@ndb.tasklet
+def replace_multi_async(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+                        serializer=None, **ctx_options):
+    """ Replaces multiple values at once, with no effect for keys not in dscache.
+
+    The return value is a future whose result is a list of keys whose values were not set.
+    """
+    entities = {key: create_entity(key, value, time=time, key_prefix=key_prefix, namespace=namespace,
+                                   min_compress_len=min_compress_len, serializer=serializer)
+                for key, value in list(mapping.items())}
+    keys = list(entities.keys())
+
+    # one batched check filters out the keys that are missing, without setting up transactions
+    existing_entities = yield _get_entities_async([entities[key].key for key in keys],
+                                                  max_concurrency=max_concurrency, **ctx_options)
+    candidates = [key for key, existing_entity in zip(keys, existing_entities) if is_entity_live(existing_entity)]
+
+    @ndb.tasklet
+    def replace_one(chunk):
+        """ Replaces a single key in its own transaction. """
+        key = chunk[0]
+        try:
+            replaced = yield _replace_entity_async(entities[key], **ctx_options)
+        except Exception:
+            logging.exception('dscache: error on dscache.replace_multi(). %s', key)
+            _record_error('replace_multi')
+            raise ndb.Return(False)
+        raise ndb.Return(replaced)
+
+    results = yield _dispatch_chunks_async(replace_one, _chunks(candidates, 1), max_concurrency=max_concurrency)
+    replaced_keys = {key for key, replaced in zip(candidates, results) if replaced}
+    raise ndb.Return([key for key in keys if key not in replaced_keys])
 
-def replace_multi(mapping, time=0, key_prefix='', namespace=None, **ctx_options):
+def replace_multi(mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+                  serializer=None, **ctx_options):
     """ Replaces multiple values at once, with no effect for keys not in dscache.
 
     The return value is a list of keys whose values were not set because they were not set in dscache, or an empty list.
+
+    Present keys are found with a single batched lookup; each of them is then replaced in its own
+    transaction, with up to max_concurrency transactions in flight at once.
     """
-    raise NotImplementedError()
+    return replace_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                               max_concurrency=max_concurrency, min_compress_len=min_compress_len,
+                               serializer=serializer, **ctx_options).get_result()
+
+@ndb.tasklet
+def _offset_async(ds_key, delta, initial_value=None, namespace=None, **ctx_options):
+    """ Applies a signed delta to the integer value of the entity at ds_key, within a transaction.
+
+    Values are unsigned 64-bit: increments wrap around at 2**64 and decrements stop at 0. Values of
+    2**63 and above are stored as their (negative) two's complement, as integers are stored as signed 64-bit.
+
+    The return value is a future whose result is the new value, or None if the key was missing (and
+    no initial_value was given), held a non-integer value, or could not be updated.
+    """
+    @ndb.tasklet
+    def tx():
+        """ Reads, offsets and writes back the counter. """
+        entity = yield ds_key.get_async(**ctx_options)
+        if not entity or is_entity_expired(entity):
+            if initial_value is None:
+                raise ndb.Return(None)
+            value = initial_value
+            timeout = None
+        else:
+            value = _get_int_value(entity)
+            if value is None:
+                raise ndb.Return(None)
+            timeout = entity.timeout
+        value %= COUNTER_MODULUS
+        if delta >= 0:
+            value = (value + delta) % COUNTER_MODULUS
+        else:
+            value = max(0, value + delta)
+        counter = _DSCache(key=ds_key, timeout=timeout)
+        _set_generation(counter, namespace, generations)
+        set_value_on_entity(counter, value if value < COUNTER_MODULUS // 2 else value - COUNTER_MODULUS)
+        counter.version = _next_version(entity) if entity else _new_version()
+        yield counter.put_async(**ctx_options)
+        raise ndb.Return(value)
+    _local_delete(ds_key)
+    try:
+        generations = _get_generations(namespace)
+        # with an initial_value the entry may be created
+        if initial_value is not None:
+            yield _bloom_add_async([ds_key], namespace)
+        result = yield _rpc_async(ndb.transaction_async(tx))
+    except Exception:
+        logging.exception('dscache: error on dscache offset. %s', ds_key.string_id())
+        _record_error('offset')
+        raise ndb.Return(None)
+    if result is not None:
+        _stats.record_write(items=1)
+    raise ndb.Return(result)
+
+@ndb.tasklet
+def _cas_entity_async(entity, cas_id, **ctx_options):
+    """ Puts entity in a transaction, if and only if the live entity at its key still has the given cas_id.
+    The new entity's version follows that of the one it replaces.
+
+    The return value is a future whose result is True if the entity was put, False otherwise.
+    """
+    @ndb.tasklet
+    def tx():
+        """ Rechecks the cas_id of the existing entity, and replaces it if unchanged. """
+        existing_entity = yield entity.key.get_async(**ctx_options)
+        if not is_entity_live(existing_entity) or _get_cas_id(existing_entity) != cas_id:
+            raise ndb.Return(False)
+        entity.version = _next_version(existing_entity)
+        yield _put_entities_async([entity], **ctx_options)
+        raise ndb.Return(True)
+    stored = yield _rpc_async(ndb.transaction_async(tx))
+    if stored:
+        _stats.record_write(items=1, bytes_written=entity_size(entity))
+        _local_put(entity)
+    raise ndb.Return(stored)
+
+def _get_int_value(entity):
+    """ Returns the integer value of an entity, or None if it is missing, expired or holds another type. """
+    value = get_value_from_entity(entity)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return None
+
+def _check_delta(delta):
+    """ Validates an incr()/decr() delta, which must be a non-negative integer. """
+    if not isinstance(delta, int) or isinstance(delta, bool):
+        raise TypeError('delta must be an integer, not %r' % delta)
+    if delta < 0:
+        raise ValueError('delta must not be negative: %d' % delta)
+
+@_measured('incr', fallback=_short_circuit_none)
+def incr_async(key, delta=1, namespace=None, initial_value=None, **ctx_options):
+    """ Atomically increments a key's value.
+
+    The return value is a future whose result is the new value, or None.
+    """
+    _check_delta(delta)
+    ds_key = build_ds_key(key, namespace=namespace)
+    return _offset_async(ds_key, delta, initial_value=initial_value, namespace=namespace, **ctx_options)
 
 def incr(key, delta=1, namespace=None, initial_value=None, **ctx_options):
     """ Atomically increments a key's value. Internally, the value is a unsigned 64-bit integer.
@@ -338,7 +1886,17 @@ def incr(key, delta=1, namespace=None, initial_value=None, **ctx_options):
     The return value is a new long integer value, or None if key was not in the cache or
     could not be incremented for any other reason.
     """
-    raise NotImplementedError()
+    return incr_async(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options).get_result()
+
+@_measured('decr', fallback=_short_circuit_none)
+def decr_async(key, delta=1, namespace=None, initial_value=None, **ctx_options):
+    """ Atomically decrements a key's value.
+
+    The return value is a future whose result is the new value, or None.
+    """
+    _check_delta(delta)
+    ds_key = build_ds_key(key, namespace=namespace)
+    return _offset_async(ds_key, -delta, initial_value=initial_value, namespace=namespace, **ctx_options)
 
 def decr(key, delta=1, namespace=None, initial_value=None, **ctx_options):
     """ Atomically decrements a key's value. Internally, the value is a unsigned 64-bit integer.
@@ -346,13 +1904,36 @@ def decr(key, delta=1, namespace=None, initial_value=None, **ctx_options):
     If the key does not yet exist in the cache and you specify an initial_value,
     the key's value will be set to this initial value and then decremented.
     If the key does not exist and no initial_value is specified, the key's value will not be set.
+    As with memcache, decrementing below zero sets the value to zero.
 
     The return value is a new long integer value, or None if key was not in the cache or could not be
     decremented for any other reason.
     """
-    raise NotImplementedError()
+    return decr_async(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options).get_result()
+
+@_measured('offset_multi', fallback=_short_circuit_offsets)
+@ndb.tasklet
+def offset_multi_async(mapping, key_prefix='', namespace=None, initial_value=None, max_concurrency=None,
+                       **ctx_options):
+    """ Increments or decrements multiple keys with integer values.
+
+    The return value is a future whose result is a mapping of the provided keys to their new values (or None).
+    """
+    keys = list(mapping.keys())
+
+    @ndb.tasklet
+    def offset_one(chunk):
+        """ Applies the offset of a single key in its own transaction. """
+        key = chunk[0]
+        ds_key = build_ds_key(key, key_prefix=key_prefix, namespace=namespace)
+        result = yield _offset_async(ds_key, mapping[key], initial_value=initial_value, namespace=namespace,
+                                     **ctx_options)
+        raise ndb.Return(result)
+
+    results = yield _dispatch_chunks_async(offset_one, _chunks(keys, 1), max_concurrency=max_concurrency)
+    raise ndb.Return(dict(zip(keys, results)))
 
-def offset_multi(mapping, key_prefix='', namespace=None, initial_value=None, **ctx_options):
+def offset_multi(mapping, key_prefix='', namespace=None, initial_value=None, max_concurrency=None, **ctx_options):
     """ Increments or decrements multiple keys with integer values in a single service call.
     Each key can have a separate offset. The offset can be positive or negative.
     Applying an offset to a single key is atomic. Applying an offset to multiple keys may
@@ -362,50 +1943,402 @@ def offset_multi(mapping, key_prefix='', namespace=None, initial_value=None, **c
     If there was an error applying an offset to a key, if a key doesn't exist in the cache and
     no initial_value is provided, or if a key is set with a non-integer value, its return value is None.
     """
-    raise NotImplementedError()
+    return offset_multi_async(mapping, key_prefix=key_prefix, namespace=namespace, initial_value=initial_value,
+                              max_concurrency=max_concurrency, **ctx_options).get_result()
+
+def _build_shard_keys(key, shards, namespace=None):
+    """ Builds the Keys of the shard entities of a sharded counter. """
+    return [build_ds_key('__shard__%d:%s' % (i, key), namespace=namespace) for i in range(shards)]
+
+@_measured('incr_sharded', fallback=_short_circuit_false)
+@ndb.tasklet
+def incr_sharded_async(key, delta=1, shards=DEFAULT_COUNTER_SHARDS, namespace=None, **ctx_options):
+    """ Adds a signed delta to one randomly chosen shard of a sharded counter.
+
+    The return value is a future whose result is True if the shard was updated, False on error.
+    """
+    ds_key = random.choice(_build_shard_keys(key, shards, namespace=namespace))
+    generations = _get_generations(namespace)
+    @ndb.tasklet
+    def tx():
+        """ Reads, offsets and writes back the shard. """
+        entity = yield ds_key.get_async(**ctx_options)
+        shard = _DSCache(key=ds_key)
+        _set_generation(shard, namespace, generations)
+        set_value_on_entity(shard, (_get_int_value(entity) or 0) + delta)
+        shard.version = _next_version(entity) if entity else _new_version()
+        yield shard.put_async(**ctx_options)
+    try:
+        yield _rpc_async(ndb.transaction_async(tx))
+    except Exception:
+        logging.exception('dscache: error on dscache.incr_sharded(). %s', key)
+        _record_error('incr_sharded')
+        raise ndb.Return(False)
+    _stats.record_write(items=1)
+    raise ndb.Return(True)
+
+def incr_sharded(key, delta=1, shards=DEFAULT_COUNTER_SHARDS, namespace=None, **ctx_options):
+    """ Adds a signed delta to a sharded counter. Use this instead of incr() for counters that are updated
+    more often than a single entity allows; each update only contends on one of its shard entities.
+    Unlike incr(), sharded counters are signed and do not wrap around. The number of shards must be the
+    same for every call on a given counter.
+
+    The return value is True if the counter was updated, False on error.
+    """
+    return incr_sharded_async(key, delta=delta, shards=shards, namespace=namespace, **ctx_options).get_result()
+
+@_measured('get_sharded', fallback=_short_circuit_none)
+@ndb.tasklet
+def get_sharded_async(key, shards=DEFAULT_COUNTER_SHARDS, namespace=None, **ctx_options):
+    """ Reads a sharded counter.
+
+    The return value is a future whose result is the sum of the shards, or None on error.
+    """
+    try:
+        entities = yield _rpc_async(ndb.get_multi_async(_build_shard_keys(key, shards, namespace=namespace),
+                                                        **ctx_options))
+    except Exception:
+        logging.exception('dscache: error on dscache.get_sharded(). %s', key)
+        _record_error('get_sharded')
+        raise ndb.Return(None)
+    raise ndb.Return(sum(_get_int_value(entity) or 0 for entity in entities))
+
+def get_sharded(key, shards=DEFAULT_COUNTER_SHARDS, namespace=None, **ctx_options):
+    """ Reads a sharded counter written with incr_sharded(), summing all of its shards in one batch get.
+
+    The return value is the counter's value (0 if it was never incremented), or None on error.
+    """
+    return get_sharded_async(key, shards=shards, namespace=namespace, **ctx_options).get_result()
+
+@_measured_sync('flush_all', fallback=_short_circuit_false)
+def flush_all(namespace=None, **ctx_options):
+    """ Deletes everything in dscache, or only the entries of the given namespace.
 
-def flush_all(**ctx_options):
-    """ Deletes everything in dscache.
+    Nothing is actually deleted: a flush bumps a generation number that is folded into every key name, so
+    entries written before the flush are no longer reachable. Vacuum reclaims them: those with a timeout once they
+    expire, and the others with its generation sweep. Other instances see the flush within GENERATION_CACHE_SECONDS;
+    one that has never read the generation, and cannot read it, fails its operations as on a Datastore error.
 
     The return value is True on success, False on RPC or server error."""
-    raise NotImplementedError()
+    name = namespace or _DSCacheGeneration.GLOBAL_GENERATION
+    ds_key = ndb.Key(_DSCacheGeneration, name, namespace='')
+    def tx():
+        """ Bumps the generation. """
+        entity = ds_key.get(**ctx_options) or _DSCacheGeneration(key=ds_key)
+        entity.generation += 1
+        entity.put(**ctx_options)
+        return entity.generation
+    start = time_pkg.time()
+    try:
+        generation = ndb.transaction(tx)
+        _record_rpc(start)
+    except Exception:
+        logging.exception('dscache: error on dscache.flush_all(). %s', namespace)
+        _record_error('flush_all')
+        return False
+    _generations[name] = (generation, time_pkg.time())
+    if _local_cache is not None:
+        _local_cache.clear()
+    return True
 
 def get_stats():
     """ Gets dscache statistics for this application. All of these statistics may
     reset due to various transient conditions. They provide the best information
     available at the time of being called.
 
+    Statistics are collected in process, so they only cover the calls made on this instance
+    since it started. See Stats.get_stats() for the statistics returned.
+
     The return value is a dictionary mapping statistic names to associated values. """
-    raise NotImplementedError()
+    return _stats.get_stats()
+
+def _build_memcache_key(key, key_prefix='', namespace=None):
+    """ Builds the memcache key of a tiered Client's copy of a value. It includes the flush generation, so after
+    flush_all() the old copies are no longer read, as the old entities are not. """
+    return MEMCACHE_KEY_PREFIX + build_ds_key_name(key, key_prefix=key_prefix, namespace=namespace)
+
+def _memcache_time(seconds):
+    """ Converts a number of seconds from now to a memcache expiration time. """
+    if seconds > MEMCACHE_MAX_RELATIVE_TIME:
+        return int(time_pkg.time() + seconds)
+    return int(math.ceil(seconds))
+
+# the placeholder of a key removed from the tier; encoded values are never empty
+_MEMCACHE_INVALIDATED = b''
+
+def _encode_memcache_value(value, serializer=None):
+    """ Encodes a value as the compact format stores it, preceded by its value type and codec.
+
+    The return value is the bytes, or None if they are too large for memcache.
+    """
+    entity = _DSCache()
+    set_value_on_entity(entity, value, serializer=serializer, entity_format=FORMAT_COMPACT)
+    data = '{}\0{}\0'.format(entity.value_type, entity.codec or '').encode() + entity.payload
+    return data if len(data) <= memcache.MAX_VALUE_SIZE else None
+
+def _decode_memcache_value(data):
+    """ Decodes a value encoded by _encode_memcache_value(). """
+    value_type, codec, payload = data.split(b'\0', 2)
+    return _decode_payload(_DSCache(value_type=value_type.decode(), codec=codec.decode() or None), payload)
+
+def _memcache_set_placeholder_async(memcache_key):
+    """ Writes the placeholder of a key removed from memcache, for MEMCACHE_INVALIDATION_SECONDS. """
+    return ndb.get_context().memcache_set(memcache_key, _MEMCACHE_INVALIDATED, time=MEMCACHE_INVALIDATION_SECONDS,
+                                          namespace='')
+
+@ndb.tasklet
+def _memcache_claim_async(memcache_keys):
+    """ Prepares memcache keys for a set through to dscache: each key is replaced by a placeholder, which is then
+    read for a compare-and-set. Errors are logged.
+
+    The return value is a future whose result is the set of keys that can be written by _memcache_write_async().
+    """
+    context = ndb.get_context()
+    try:
+        yield [_memcache_set_placeholder_async(memcache_key) for memcache_key in memcache_keys]
+        values = yield [context.memcache_gets(memcache_key, namespace='') for memcache_key in memcache_keys]
+    except Exception:
+        logging.exception('dscache: error writing the memcache tier.')
+        _stats.record_error('memcache_set')
+        raise ndb.Return(frozenset())
+    # an evicted placeholder leaves nothing to compare against; the key is then copied back by reads
+    raise ndb.Return(frozenset(memcache_key for memcache_key, value in zip(memcache_keys, values) if value is not None))
+
+@ndb.tasklet
+def _memcache_write_async(values, serializer=None, add=False):
+    """ Writes values to memcache, given as a dictionary of memcache keys and (value, seconds to expiration).
+    The keys must have been claimed by _memcache_claim_async() before the values were written to dscache; each value
+    is written with a compare-and-set, and a key that another write touched since it was claimed, or whose value is
+    too large for memcache, is left with a placeholder instead. This way, of two writers racing on a key, the one
+    whose dscache write landed first cannot leave its value in memcache. Errors are logged.
+
+    With add=True, only keys that memcache does not hold, nor holds a placeholder for, are written, and values too
+    large for it are skipped; this is how reads copy values to memcache without overwriting newer ones.
+    """
+    context = ndb.get_context()
+
+    @ndb.tasklet
+    def cas_one(memcache_key, data, seconds):
+        written = data is not None and (yield context.memcache_cas(memcache_key, data, time=_memcache_time(seconds),
+                                                                   namespace=''))
+        if not written:
+            yield _memcache_set_placeholder_async(memcache_key)
+
+    futures = []
+    for memcache_key, (value, seconds) in values.items():
+        data = _encode_memcache_value(value, serializer)
+        if not add:
+            futures.append(cas_one(memcache_key, data, seconds))
+        elif data is not None:
+            futures.append(context.memcache_add(memcache_key, data, time=_memcache_time(seconds), namespace=''))
+    try:
+        yield futures
+    except Exception:
+        logging.exception('dscache: error writing the memcache tier.')
+        _stats.record_error('memcache_set')
+
+@ndb.tasklet
+def _memcache_invalidate_async(keys, key_prefix='', namespace=None):
+    """ Removes keys from memcache, leaving a placeholder for MEMCACHE_INVALIDATION_SECONDS that reads treat as a miss
+    and that makes their add() of the value they found in dscache fail. Errors are logged. """
+    try:
+        yield [_memcache_set_placeholder_async(_build_memcache_key(key, key_prefix=key_prefix, namespace=namespace))
+               for key in keys]
+    except Exception:
+        logging.exception('dscache: error removing keys from the memcache tier.')
+        _stats.record_error('memcache_delete')
 
+def _completed_future(result):
+    """ Returns a future that already has the given result. """
+    future = ndb.Future()
+    future.set_result(result)
+    return future
 
 class Client:
-    """ A Client() interface for memcached compatibility. """
+    """ A Client() interface for memcached compatibility.
+
+    With write_behind=True, set() and delete() calls (and their multi and async versions) are buffered rather than
+    written, keeping only the last write of each key, and reads on this client see the buffered values. The buffer is
+    written with batched set_multi() and delete_multi() calls once it holds max_buffered keys or its oldest write is
+    flush_interval seconds old (checked on each write), before any other operation on this client, and on flush().
+    Use the client as a context manager, or call flush() at the end of the request, so the last writes are not lost.
+    A buffered write's timeout counts from the flush. A write-behind client is meant to be used by a single request
+    and is not thread-safe; other clients and the module functions do not see its buffered writes.
+
+    With tiered=True, App Engine memcache is used as a faster, evictable tier in front of dscache. get() and
+    get_multi() read memcache first and copy the values they then find in dscache to memcache, to expire with their
+    entity. set() and set_multi() write dscache, then memcache, with a compare-and-set over a placeholder so that of
+    two racing sets, the one whose dscache write landed first cannot overwrite the other's value in memcache (when
+    they interleave, the key is left to be copied back by reads). Every other write removes its keys from memcache once
+    dscache is written, so they are copied back on their first read MEMCACHE_INVALIDATION_SECONDS later (a placeholder
+    makes the add() that reads copy values with fail meanwhile, so that a read racing the write cannot copy back the
+    old value). gets(), get_or_compute() and the module functions
+    use dscache alone, so writes made through the module functions are only seen by tiered clients once the memcache
+    copy expires; write through tiered clients only. flush_all() changes the keys the copies are stored under.
+
+    With a deadline, each Datastore RPC made by the client's operations gives up after that many seconds, unless the
+    call passes its own deadline context option; the operation then fails as on any other Datastore error. The flush
+    generation, read at most every GENERATION_CACHE_SECONDS, is read without it. Combined with
+    enable_circuit_breaker(), this bounds how long dscache can hold up a request.
+    """
 
-    def __init__(self):
-        """ Initalizes client. """
+    def __init__(self, max_cas_ids=MAX_CAS_IDS, serializer=None, write_behind=False,
+                 max_buffered=WRITE_BEHIND_MAX_ITEMS, flush_interval=WRITE_BEHIND_SECONDS, tiered=False,
+                 deadline=None):
+        """ Initalizes client. At most max_cas_ids cas ids are remembered; cas() fails on keys whose cas id was
+        forgotten, as if they were never fetched with gets(). Values that are not stored as a datastore type are
+        serialized with the named serializer, if given (see serializers.register_serializer()). """
+        self.max_cas_ids = max_cas_ids
+        self.serializer = serializer
+        self.write_behind = write_behind
+        self.tiered = tiered
+        self.deadline = deadline
+        self.max_buffered = max_buffered
+        self.flush_interval = flush_interval
+        self._buffer = collections.OrderedDict()
+        self._buffered_since = None
+        self._pending_flushes = []
         self.cas_reset()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def _options(self, ctx_options):
+        """ Returns the context options of a call, with the client's deadline unless the call gives one. """
+        if self.deadline is not None and 'deadline' not in ctx_options:
+            ctx_options = dict(ctx_options, deadline=self.deadline)
+        return ctx_options
+
+    def _buffer_write(self, op, key, namespace, value, time, ctx_options):
+        """ Buffers a set or delete of a key, replacing any earlier buffered write of it. """
+        ds_key = build_ds_key(key, namespace=namespace)
+        self._buffer.pop(ds_key, None)
+        self._buffer[ds_key] = (op, key, namespace, value, time, ctx_options)
+        now = time_pkg.time()
+        if self._buffered_since is None:
+            self._buffered_since = now
+        if len(self._buffer) >= self.max_buffered or now - self._buffered_since >= self.flush_interval:
+            self.flush_async()
+
+    def _get_buffered(self, key, namespace=None):
+        """ Returns a tuple (buffered, value); value is None for a buffered delete. Writes stay buffered until the
+        flush that writes them completes. """
+        if not self._buffer and not self._pending_flushes:
+            return False, None
+        ds_key = build_ds_key(key, namespace=namespace)
+        entry = self._buffer.get(ds_key)
+        for future, buffer in reversed(self._pending_flushes):
+            if entry is not None:
+                break
+            if not future.done():
+                entry = buffer.get(ds_key)
+        if entry is None:
+            return False, None
+        return True, entry[3] if entry[0] == 'set' else None
+
+    def _flush_buffer(self):
+        """ Writes the buffer before an operation that does not read it. """
+        if self._buffer or self._pending_flushes:
+            self.flush()
+
+    def flush_async(self):
+        """ Writes the buffered sets and deletes with batched calls, emptying the buffer.
+
+        The return value is a future whose result is True if every buffered write succeeded.
+        """
+        buffer, self._buffer, self._buffered_since = self._buffer, collections.OrderedDict(), None
+        sets = collections.OrderedDict()
+        deletes = collections.OrderedDict()
+        for op, key, namespace, value, time, ctx_options in buffer.values():
+            group = (namespace, time, tuple(sorted(ctx_options.items())))
+            if op == 'set':
+                sets.setdefault(group, {})[key] = value
+            else:
+                deletes.setdefault(group, []).append(key)
+        futures = []
+        for (namespace, time, options), mapping in sets.items():
+            write = functools.partial(set_multi_async, mapping, time=time, namespace=namespace,
+                                      serializer=self.serializer, **dict(options))
+            futures.append(self._set_through_async(write, mapping, '', namespace, time) if self.tiered else write())
+        for (namespace, seconds, options), keys in deletes.items():
+            future = delete_multi_async(keys, seconds=seconds, namespace=namespace, **dict(options))
+            futures.append(self._through_tier(future, keys, namespace=namespace))
+        future = self._wait_flush_async(futures, len(sets))
+        # keep the writes readable until they are written
+        self._pending_flushes.append((future, buffer))
+        return future
+
+    @ndb.tasklet
+    def _wait_flush_async(self, futures, set_count):
+        """ Waits for the set_multi() and delete_multi() calls of a flush. """
+        results = yield futures
+        raise ndb.Return(all(not result for result in results[:set_count]) and all(results[set_count:]))
+
+    def flush(self):
+        """ Writes the buffered sets and deletes and waits for every flush in progress.
+
+        The return value is True if every buffered write succeeded, False otherwise.
+        """
+        if self._buffer:
+            self.flush_async()
+        pending, self._pending_flushes = self._pending_flushes, []
+        return all([future.get_result() for future, buffer in pending])
+
     def set(self, key, value, time=0, namespace=None, **ctx_options):
         """ Sets a key's value, regardless of previous contents in cache.
 
         The return value is True if set, False on error.
         """
-        return set(key, value, time=time, namespace=namespace, **ctx_options)
+        return self.set_async(key, value, time=time, namespace=namespace, **ctx_options).get_result()
+
+    def set_async(self, key, value, time=0, namespace=None, **ctx_options):
+        """ Asynchronous version of set(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        if self.write_behind:
+            self._buffer_write('set', key, namespace, value, time, ctx_options)
+            return _completed_future(True)
+        write = functools.partial(set_async, key, value, time=time, namespace=namespace, serializer=self.serializer,
+                                  **ctx_options)
+        return self._set_through_async(write, {key: value}, '', namespace, time) if self.tiered else write()
 
     def set_multi(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
         """ Set multiple keys' values at once. Reduces the network latency of doing many requests in serial.
 
         The return value is a list of keys whose values were NOT set. On total success, this list should be empty.
         """
-        return set_multi(mapping, time=time, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self.set_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                    **ctx_options).get_result()
+
+    def set_multi_async(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
+        """ Asynchronous version of set_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        if self.write_behind:
+            for key, value in mapping.items():
+                self._buffer_write('set', key_prefix + key, namespace, value, time, ctx_options)
+            return _completed_future([])
+        write = functools.partial(set_multi_async, mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                  serializer=self.serializer, **ctx_options)
+        return self._set_through_async(write, mapping, key_prefix, namespace, time) if self.tiered else write()
 
     def get(self, key, namespace=None, **ctx_options):
         """ Looks up a single key in dscache.
 
         The return value is the value of the key, if found in dscache, else None.
         """
-        return get(key, namespace=namespace, **ctx_options)
+        return self.get_async(key, namespace=namespace, **ctx_options).get_result()
+
+    def get_async(self, key, namespace=None, **ctx_options):
+        """ Asynchronous version of get(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        buffered, value = self._get_buffered(key, namespace=namespace)
+        if buffered:
+            return _completed_future(value)
+        if self.tiered:
+            return self._get_tiered_async(key, namespace, ctx_options)
+        return get_async(key, namespace=namespace, **ctx_options)
 
     def get_multi(self, keys, key_prefix='', namespace=None, **ctx_options):
         """ Looks up multiple keys from dscache in one operation. This is the recommended way to do bulk loads.
@@ -413,7 +2346,193 @@ class Client:
         The returned value is a dictionary of the keys and values that were present in dscache.
         Even if the key_prefix was specified, that key_prefix won't be on the keys in the returned dictionary.
         """
-        return get_multi(keys, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self.get_multi_async(keys, key_prefix=key_prefix, namespace=namespace, **ctx_options).get_result()
+
+    def get_multi_async(self, keys, key_prefix='', namespace=None, **ctx_options):
+        """ Asynchronous version of get_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        if not self._buffer and not self._pending_flushes and not self.tiered:
+            return get_multi_async(keys, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self._get_multi_buffered_async(keys, key_prefix, namespace, ctx_options)
+
+    @ndb.tasklet
+    def _get_multi_buffered_async(self, keys, key_prefix, namespace, ctx_options):
+        """ Looks up multiple keys, serving those with a buffered write from the buffer. """
+        result = {}
+        unbuffered = []
+        for key in keys:
+            buffered, value = self._get_buffered(key_prefix + key, namespace=namespace)
+            if not buffered:
+                unbuffered.append(key)
+            elif value:
+                # as get_multi() leaves out falsy values once the write is flushed
+                result[key] = value
+        if unbuffered and self.tiered:
+            found = yield self._get_multi_tiered_async(unbuffered, key_prefix, namespace, ctx_options)
+            result.update((key, value) for key, value in found.items() if value)
+        elif unbuffered:
+            found = yield get_multi_async(unbuffered, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+            result.update(found)
+        raise ndb.Return(result)
+
+    @_measured('get')
+    @ndb.tasklet
+    def _get_tiered_async(self, key, namespace, ctx_options):
+        """ Looks up a single key in memcache, then in dscache. """
+        result = yield self._lookup_tiered_async([key], '', namespace, ctx_options)
+        raise ndb.Return(result.get(key))
+
+    @_measured('get_multi')
+    def _get_multi_tiered_async(self, keys, key_prefix, namespace, ctx_options):
+        """ Looks up multiple keys in memcache, then in dscache. """
+        return self._lookup_tiered_async(keys, key_prefix, namespace, ctx_options)
+
+    @ndb.tasklet
+    def _lookup_tiered_async(self, keys, key_prefix, namespace, ctx_options):
+        """ Looks up keys in memcache, then the misses in dscache, copying the values found there to memcache
+        until their entity's timeout. While the circuit breaker is open, the misses are not looked up in dscache,
+        and nothing is looked up if the flush generation cannot be read.
+
+        The return value is a future whose result is a dictionary of the keys and values found.
+        """
+        context = ndb.get_context()
+        if not _has_generations(namespace):
+            raise ndb.Return({})
+        memcache_keys = {key: _build_memcache_key(key, key_prefix=key_prefix, namespace=namespace) for key in keys}
+        try:
+            cached = yield [context.memcache_get(memcache_keys[key], namespace='') for key in keys]
+            result = {key: _decode_memcache_value(data) for key, data in zip(keys, cached)
+                      if data is not None and data != _MEMCACHE_INVALIDATED}
+        except Exception:
+            logging.exception('dscache: error reading the memcache tier.')
+            _stats.record_error('memcache_get')
+            result = {}
+
+        ds_keys = {key: build_ds_key(key, key_prefix=key_prefix, namespace=namespace)
+                   for key in keys if key not in result}
+        if not ds_keys or (_breaker is not None and not _breaker.allow()):
+            raise ndb.Return(result)
+        entity_map = yield _get_entity_map_async(list(ds_keys.values()), namespace=namespace, **ctx_options)
+        backfill = {}
+        for key, ds_key in ds_keys.items():
+            entity = entity_map.get(ds_key)
+            if entity is None:
+                continue
+            result[key] = value = get_value_from_entity(entity)
+            if value is not None:
+                seconds = (entity.timeout - datetime.datetime.utcnow()).total_seconds() if entity.timeout else 0
+                backfill[memcache_keys[key]] = (value, seconds)
+        # added, not set: a write since the lookup has set the key in memcache, or left a placeholder
+        yield _memcache_write_async(backfill, self.serializer, add=True)
+        raise ndb.Return(result)
+
+    @ndb.tasklet
+    def _set_through_async(self, write, mapping, key_prefix, namespace, time):
+        """ Claims the keys of a dscache set in memcache, then calls write() to start the set and waits for it, then
+        writes the values that were set through to memcache and removes the others from it, so memcache never serves
+        a value that dscache does not hold, nor one older than it.
+
+        The return value is a future whose result is that of the set.
+        """
+        memcache_keys = {key: _build_memcache_key(key, key_prefix=key_prefix, namespace=namespace) for key in mapping}
+        claimed = yield _memcache_claim_async(list(memcache_keys.values()))
+        result = False
+        try:
+            result = yield write()
+        finally:
+            failed = frozenset(mapping if result is False else () if result is True else result)
+            written = {memcache_keys[key]: (mapping[key], time)
+                       for key in mapping if key not in failed and time >= 0 and memcache_keys[key] in claimed}
+            removed = [key for key in mapping if key in failed or time < 0]
+            yield [_memcache_write_async(written, self.serializer),
+                   _memcache_invalidate_async(removed, key_prefix=key_prefix, namespace=namespace)]
+        raise ndb.Return(result)
+
+    @ndb.tasklet
+    def _invalidate_async(self, future, keys, key_prefix='', namespace=None):
+        """ Waits for a dscache write, then removes the keys from memcache, to be copied back on their next read.
+
+        The return value is a future whose result is that of the write.
+        """
+        try:
+            result = yield future
+        finally:
+            yield _memcache_invalidate_async(keys, key_prefix=key_prefix, namespace=namespace)
+        raise ndb.Return(result)
+
+    def _through_tier(self, future, keys, key_prefix='', namespace=None):
+        """ Removes the keys of a write from memcache once it completes, if this client is tiered. """
+        if not self.tiered:
+            return future
+        return self._invalidate_async(future, keys, key_prefix=key_prefix, namespace=namespace)
+
+    def get_or_compute(self, key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS, wait=LEASE_WAIT_SECONDS,
+                       refresh_ahead=0, stale_ttl=0, stale_if_error=False, **ctx_options):
+        """ Looks up a single key in dscache, computing and storing its value with fn() on a miss.
+        Only one caller at a time computes a missing value, and hits may refresh it ahead of its timeout; see the
+        module's get_or_compute().
+
+        The return value is the value of the key.
+        """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_compute(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                              serializer=self.serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                              stale_if_error=stale_if_error, **ctx_options)
+
+    def get_or_compute_async(self, key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS,
+                             wait=LEASE_WAIT_SECONDS, refresh_ahead=0, stale_ttl=0, stale_if_error=False,
+                             refreshes=None, **ctx_options):
+        """ Asynchronous version of get_or_compute(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_compute_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                    serializer=self.serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                    stale_if_error=stale_if_error, refreshes=refreshes, **ctx_options)
+
+    def get_or_revalidate(self, key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS,
+                          wait=LEASE_WAIT_SECONDS, refresh_ahead=0, stale_ttl=0, stale_if_error=False,
+                          **ctx_options):
+        """ Looks up a single key in dscache like get_or_compute(), also telling whether the value is stale; see
+        the module's get_or_revalidate().
+
+        The return value is a tuple (value of the key, whether it is stale).
+        """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_revalidate(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                 serializer=self.serializer, refresh_ahead=refresh_ahead, stale_ttl=stale_ttl,
+                                 stale_if_error=stale_if_error, **ctx_options)
+
+    def get_or_revalidate_async(self, key, fn, time=0, namespace=None, lease_time=LEASE_SECONDS,
+                                wait=LEASE_WAIT_SECONDS, refresh_ahead=0, stale_ttl=0, stale_if_error=False,
+                                refreshes=None, **ctx_options):
+        """ Asynchronous version of get_or_revalidate(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_revalidate_async(key, fn, time=time, namespace=namespace, lease_time=lease_time, wait=wait,
+                                       serializer=self.serializer, refresh_ahead=refresh_ahead,
+                                       stale_ttl=stale_ttl, stale_if_error=stale_if_error, refreshes=refreshes,
+                                       **ctx_options)
+
+    def get_or_compute_multi(self, keys, fn, time=0, key_prefix='', namespace=None, lease_time=LEASE_SECONDS,
+                             wait=LEASE_WAIT_SECONDS, **ctx_options):
+        """ Looks up multiple keys in dscache, computing and storing the missing values with fn(keys).
+
+        The return value is a dictionary of the keys and their values.
+        """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_compute_multi(keys, fn, time=time, key_prefix=key_prefix, namespace=namespace,
+                                    lease_time=lease_time, wait=wait, serializer=self.serializer, **ctx_options)
+
+    def get_or_compute_multi_async(self, keys, fn, time=0, key_prefix='', namespace=None, lease_time=LEASE_SECONDS,
+                                   wait=LEASE_WAIT_SECONDS, **ctx_options):
+        """ Asynchronous version of get_or_compute_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return get_or_compute_multi_async(keys, fn, time=time, key_prefix=key_prefix, namespace=namespace,
+                                          lease_time=lease_time, wait=wait, serializer=self.serializer, **ctx_options)
 
     def delete(self, key, seconds=0, namespace=None, **ctx_options):
         """ Deletes a key from dscache.
@@ -424,42 +2543,94 @@ class Client:
 
         Returns True if successful, False otherwise.
         """
-        return delete(key, seconds=seconds, namespace=namespace, **ctx_options)
+        return self.delete_async(key, seconds=seconds, namespace=namespace, **ctx_options).get_result()
+
+    def delete_async(self, key, seconds=0, namespace=None, **ctx_options):
+        """ Asynchronous version of delete(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        if self.write_behind:
+            self._buffer_write('delete', key, namespace, None, seconds, ctx_options)
+            return _completed_future(True)
+        return self._through_tier(delete_async(key, seconds=seconds, namespace=namespace, **ctx_options), [key],
+                                  namespace=namespace)
 
     def delete_multi(self, keys, seconds=0, key_prefix='', namespace=None, **ctx_options):
         """ Delete multiple keys at once.
 
         The return value is True if all operations completed successfully. False if one or more failed to complete.
         """
-        return delete_multi(keys, seconds=seconds, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self.delete_multi_async(keys, seconds=seconds, key_prefix=key_prefix, namespace=namespace,
+                                       **ctx_options).get_result()
+
+    def delete_multi_async(self, keys, seconds=0, key_prefix='', namespace=None, **ctx_options):
+        """ Asynchronous version of delete_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        if self.write_behind:
+            for key in keys:
+                self._buffer_write('delete', key_prefix + key, namespace, None, seconds, ctx_options)
+            return _completed_future(True)
+        future = delete_multi_async(keys, seconds=seconds, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self._through_tier(future, keys, key_prefix=key_prefix, namespace=namespace)
 
     def add(self, key, value, time=0, namespace=None, **ctx_options):
         """ Sets a key's value, if and only if the item is not already in dscache.
 
         The return value is True if added, False on error.
         """
-        return add(key, value, time=time, namespace=namespace, **ctx_options)
+        return self.add_async(key, value, time=time, namespace=namespace, **ctx_options).get_result()
+
+    def add_async(self, key, value, time=0, namespace=None, **ctx_options):
+        """ Asynchronous version of add(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = add_async(key, value, time=time, namespace=namespace, serializer=self.serializer, **ctx_options)
+        return self._through_tier(future, [key], namespace=namespace)
 
     def add_multi(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
         """ Adds multiple values at once, with no effect for keys already in dscache.
 
         The return value is a list of keys whose values were not set because they were already set in dscache, or an empty list.
         """
-        return add_multi(mapping, time=time, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self.add_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                    **ctx_options).get_result()
+
+    def add_multi_async(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
+        """ Asynchronous version of add_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = add_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                 serializer=self.serializer, **ctx_options)
+        return self._through_tier(future, list(mapping), key_prefix=key_prefix, namespace=namespace)
 
     def replace(self, key, value, time=0, namespace=None, **ctx_options):
         """ Replaces a key's value, failing if item isn't already in dscache.
 
         The return value is True if replaced. False on error or cache miss.
         """
-        return replace(key, value, time=time, namespace=namespace, **ctx_options)
+        return self.replace_async(key, value, time=time, namespace=namespace, **ctx_options).get_result()
 
     def replace_multi(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
         """ Replaces multiple values at once, with no effect for keys not in dscache.
 
         The return value is a list of keys whose values were not set because they were not set in dscache, or an empty list.
         """
-        return replace_multi(mapping, time=time, key_prefix=key_prefix, namespace=namespace, **ctx_options)
+        return self.replace_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                        **ctx_options).get_result()
+
+    def replace_async(self, key, value, time=0, namespace=None, **ctx_options):
+        """ Asynchronous version of replace(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = replace_async(key, value, time=time, namespace=namespace, serializer=self.serializer, **ctx_options)
+        return self._through_tier(future, [key], namespace=namespace)
+
+    def replace_multi_async(self, mapping, time=0, key_prefix='', namespace=None, **ctx_options):
+        """ Asynchronous version of replace_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = replace_multi_async(mapping, time=time, key_prefix=key_prefix, namespace=namespace,
+                                     serializer=self.serializer, **ctx_options)
+        return self._through_tier(future, list(mapping), key_prefix=key_prefix, namespace=namespace)
 
     def incr(self, key, delta=1, namespace=None, initial_value=None, **ctx_options):
         """ Atomically increments a key's value. Internally, the value is a unsigned 64-bit integer.
@@ -471,7 +2642,15 @@ class Client:
         The return value is a new long integer value, or None if key was not in the cache or
         could not be incremented for any other reason.
         """
-        return incr(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options)
+        return self.incr_async(key, delta=delta, namespace=namespace, initial_value=initial_value,
+                               **ctx_options).get_result()
+
+    def incr_async(self, key, delta=1, namespace=None, initial_value=None, **ctx_options):
+        """ Asynchronous version of incr(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = incr_async(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options)
+        return self._through_tier(future, [key], namespace=namespace)
 
     def decr(self, key, delta=1, namespace=None, initial_value=None, **ctx_options):
         """ Atomically decrements a key's value. Internally, the value is a unsigned 64-bit integer.
@@ -483,7 +2662,15 @@ class Client:
         The return value is a new long integer value, or None if key was not in the cache or could not be
         decremented for any other reason.
         """
-        return decr(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options)
+        return self.decr_async(key, delta=delta, namespace=namespace, initial_value=initial_value,
+                               **ctx_options).get_result()
+
+    def decr_async(self, key, delta=1, namespace=None, initial_value=None, **ctx_options):
+        """ Asynchronous version of decr(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = decr_async(key, delta=delta, namespace=namespace, initial_value=initial_value, **ctx_options)
+        return self._through_tier(future, [key], namespace=namespace)
 
     def offset_multi(self, mapping, key_prefix='', namespace=None, initial_value=None, **ctx_options):
         """ Increments or decrements multiple keys with integer values in a single service call.
@@ -495,13 +2682,24 @@ class Client:
         If there was an error applying an offset to a key, if a key doesn't exist in the cache and
         no initial_value is provided, or if a key is set with a non-integer value, its return value is None.
         """
-        return offset_multi(mapping, key_prefix=key_prefix, namespace=namespace, initial_value=initial_value, **ctx_options)
+        return self.offset_multi_async(mapping, key_prefix=key_prefix, namespace=namespace,
+                                       initial_value=initial_value, **ctx_options).get_result()
 
-    def flush_all(self, **ctx_options):
-        """ Deletes everything in dscache.
+    def offset_multi_async(self, mapping, key_prefix='', namespace=None, initial_value=None, **ctx_options):
+        """ Asynchronous version of offset_multi(); returns a future. """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        future = offset_multi_async(mapping, key_prefix=key_prefix, namespace=namespace, initial_value=initial_value,
+                                    **ctx_options)
+        return self._through_tier(future, list(mapping), key_prefix=key_prefix, namespace=namespace)
+
+    def flush_all(self, namespace=None, **ctx_options):
+        """ Deletes everything in dscache, or only the entries of the given namespace.
 
         The return value is True on success, False on RPC or server error."""
-        return flush_all(**ctx_options)
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        return flush_all(namespace=namespace, **ctx_options)
 
     def get_stats(self):
         """ Gets dscache statistics for this application. All of these statistics may
@@ -513,11 +2711,17 @@ class Client:
 
     def _build_cas_dict_key(self, key, namespace=None):
         """ Builds an internal dictionary key for the __cas_id dict. """
-        result = key
-        if namespace:
-            result += namespace
-        return result
+        return (key, namespace or None)
+
+    def _remember_cas_id(self, key, namespace, entity):
+        """ Records the cas id of an entity fetched by gets() or gets_multi(), forgetting the oldest if needed. """
+        dict_key = self._build_cas_dict_key(key, namespace=namespace)
+        self.__cas_id.pop(dict_key, None)
+        self.__cas_id[dict_key] = _get_cas_id(entity)
+        while len(self.__cas_id) > self.max_cas_ids:
+            self.__cas_id.popitem(last=False)
 
+    @_measured_sync('gets', fallback=_short_circuit_none)
     def gets(self, key, namespace=None, **ctx_options):
         """
         Looks up a single key in dscache and fetches its cas_id as well. You use this method rather than get()
@@ -526,13 +2730,18 @@ class Client:
         current cas_id, which is required for cas() and cas_multi() calls. (The cas_id is handled for you
         automatically by this call.)
         """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
         entity = _get_entity(key, namespace=namespace, **ctx_options)
         if entity:
-            self.__cas_id[self._build_cas_dict_key(key, namespace=namespace)] = entity.cas_id or 0 # existing dscache entries may not have a cas_id
+            _stats.record_read(hits=1, bytes_read=entity_size(entity))
+            self._remember_cas_id(key, namespace, entity)
             return get_value_from_entity(entity)
         else:
+            _stats.record_read(misses=1)
             return None
 
+    @_measured_sync('cas', fallback=_short_circuit_false)
     def cas(self, key, value, time=0, min_compress_len=0, namespace=None, **ctx_options):
         """
         Performs a "compare and set" update to a value that was fetched by a method that supports compare and set,
@@ -547,29 +2756,95 @@ class Client:
         Note: The cas_id is a hidden value, handled internally and automatically by the methods that support compare
         and set. You don't do anything explicit in your code to read, write, or manipulate cas_ids.
 
-        Note: This operation uses a datastore transaction, and thus is not particularly performant.
+        Note: This operation uses a datastore transaction, with one read and one write.
         """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
         cas_id = self.__cas_id.get(self._build_cas_dict_key(key, namespace=namespace), None)
         if cas_id is None:
             logging.warn('You must use a gets() method before calling cas(). Key: "%s".', key)
             return False
-        # do a quick check first before the Tx
-        entity = _get_entity(key, namespace=namespace, **ctx_options)
-        if not entity or entity.cas_id != cas_id:
-            return False
-        def tx():
-            entity = _get_entity(key, namespace=namespace, **ctx_options)
-            # recheck cas_id in the Tx
-            if not entity or entity.cas_id != cas_id:
-                return False
-            set(key, value, time=time, namespace=namespace, **ctx_options)
-            return True
-        return ndb.transaction(tx)
-
-    def cas_multi(self, mapping, time=0, key_prefix='', namespace=None, rpc=None, **ctx_options):
-        """ Not implemented. """
-        raise NotImplementedError()
+        entity = create_entity(key, value, time=time, namespace=namespace, min_compress_len=min_compress_len,
+                               serializer=self.serializer)
+        try:
+            return self._through_tier(_cas_entity_async(entity, cas_id, **ctx_options), [key],
+                                      namespace=namespace).get_result()
+        except Exception:
+            _record_error('cas')
+            raise
+
+    @_measured_sync('gets_multi', fallback=_short_circuit_dict)
+    def gets_multi(self, keys, key_prefix='', namespace=None, max_concurrency=None, **ctx_options):
+        """ Looks up multiple keys from dscache in one operation, fetching their cas_ids as well, for use with
+        cas_multi() (or cas()).
+
+        The returned value is a dictionary of the keys and values that were present in dscache.
+        """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        key_map = {key: build_ds_key(key, key_prefix=key_prefix, namespace=namespace) for key in keys}
+        entities = _get_entities_async(list(key_map.values()), max_concurrency=max_concurrency,
+                                       **ctx_options).get_result()
+        entities = [entity for entity in entities if is_entity_live(entity)]
+        _load_chunks_async(entities, **ctx_options).get_result()
+        entity_map = {entity.key: entity for entity in entities}
+        _stats.record_read(hits=len(entity_map), misses=len(key_map) - len(entity_map),
+                           bytes_read=sum(entity_size(entity) for entity in entity_map.values()))
+        result = {}
+        for key, ds_key in key_map.items():
+            if ds_key in entity_map:
+                entity = entity_map[ds_key]
+                self._remember_cas_id(key_prefix + key, namespace, entity)
+                result[key] = get_value_from_entity(entity)
+        return result
+
+    @_measured_sync('cas_multi', fallback=_short_circuit_method_keys)
+    def cas_multi(self, mapping, time=0, key_prefix='', namespace=None, max_concurrency=None, min_compress_len=0,
+                  **ctx_options):
+        """ Performs a "compare and set" update of multiple keys, each of which must have been fetched with gets()
+        or gets_multi(). See cas().
+
+        The keys whose cas_id no longer matches are found with a single batched lookup; each remaining key is
+        then compared and set in its own transaction, with up to max_concurrency transactions in flight at once.
+
+        The return value is a list of keys whose values were NOT set, because they were not fetched with gets(),
+        their cas_id did not match, or on error. On total success, this list should be empty.
+        """
+        ctx_options = self._options(ctx_options)
+        self._flush_buffer()
+        cas_ids = {key: self.__cas_id.get(self._build_cas_dict_key(key_prefix + key, namespace=namespace))
+                   for key in mapping}
+        keys = [key for key, cas_id in cas_ids.items() if cas_id is not None]
+        if len(keys) < len(mapping):
+            logging.warn('You must use a gets() method before calling cas_multi(). Keys: "%s".',
+                         str([key for key in mapping if cas_ids[key] is None])[:50])
+        entities = {key: create_entity(key, mapping[key], time=time, key_prefix=key_prefix, namespace=namespace,
+                                       min_compress_len=min_compress_len, serializer=self.serializer)
+                    for key in keys}
+
+        # do a quick batched check first before the Txs
+        existing_entities = _get_entities_async([entities[key].key for key in keys], max_concurrency=max_concurrency,
+                                                **ctx_options).get_result()
+        candidates = [key for key, existing_entity in zip(keys, existing_entities)
+                      if is_entity_live(existing_entity) and _get_cas_id(existing_entity) == cas_ids[key]]
+
+        @ndb.tasklet
+        def cas_one(chunk):
+            """ Compares and sets a single key in its own transaction. """
+            key = chunk[0]
+            try:
+                stored = yield _cas_entity_async(entities[key], cas_ids[key], **ctx_options)
+            except Exception:
+                logging.exception('dscache: error on dscache.cas_multi(). %s', key)
+                _record_error('cas_multi')
+                raise ndb.Return(False)
+            raise ndb.Return(stored)
+
+        future = _dispatch_chunks_async(cas_one, _chunks(candidates, 1), max_concurrency=max_concurrency)
+        results = self._through_tier(future, candidates, key_prefix=key_prefix, namespace=namespace).get_result()
+        stored_keys = {key for key, stored in zip(candidates, results) if stored}
+        return [key for key in mapping if key not in stored_keys]
 
     def cas_reset(self):
         """ Clears all of the cas_ids from the current Client object. """
-        self.__cas_id = {}
+        self.__cas_id = collections.OrderedDict()
@@ -0,0 +1,170 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import datetime
+import threading
+import time as time_pkg
+
+DEFAULT_MAX_ITEMS = 1000
+DEFAULT_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_MAX_AGE = 60
+DEFAULT_MAX_NEGATIVE_ITEMS = 1000
+
+# rough per-entry overhead for non-string values and bookkeeping
+ENTRY_OVERHEAD = 64
+
+def entity_size(entity):
+    """ Estimates the size of a _DSCache entity's value, counting the bytes of its string and blob value properties
+    and of the reassembled value of a chunked entity. """
+    size = len(getattr(entity, '_chunk_data', None) or b'')
+    for name in entity._properties:
+        if not name.endswith('_val') and name != 'payload':
+            continue
+        value = getattr(entity, name, None)
+        if isinstance(value, (str, bytes)):
+            size += len(value)
+    return size
+
+class LocalCache:
+    """ A bounded, in-process LRU cache of _DSCache entities.
+
+    Entries are evicted once either max_items or max_bytes is exceeded. An entity is never served
+    past its own timeout, nor more than max_age seconds after it was cached (other instances may have
+    changed the value in the meantime). A max_age of 0 disables the age limit.
+
+    With a negative_ttl, keys found missing can be remembered for that many seconds, in a separate LRU of at most
+    max_negative_items keys; caching an entity under a key forgets that it was missing. A negative_ttl of 0 (the
+    default) disables this.
+    """
+
+    def __init__(self, max_items=DEFAULT_MAX_ITEMS, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE,
+                 negative_ttl=0, max_negative_items=DEFAULT_MAX_NEGATIVE_ITEMS):
+        """ Initializes the cache. """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.max_negative_items = max_negative_items
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """ Drops every entry and resets the counters. """
+        with self._lock:
+            self._entries = collections.OrderedDict()
+            # ds_key -> time the miss is forgotten
+            self._missing = collections.OrderedDict()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.negative_hits = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, ds_key):
+        """ Returns the cached entity for ds_key, or None if it is absent or expired. """
+        with self._lock:
+            entry = self._entries.get(ds_key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entity, size, cached_at = entry
+            if self._is_stale(entity, cached_at):
+                self._remove(ds_key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ds_key)
+            self.hits += 1
+            return entity
+
+    def put(self, ds_key, entity):
+        """ Caches entity under ds_key, evicting least recently used entries as needed. """
+        size = entity_size(entity) + ENTRY_OVERHEAD
+        with self._lock:
+            self._remove(ds_key)
+            self._missing.pop(ds_key, None)
+            if size > self.max_bytes:
+                return
+            self._entries[ds_key] = (entity, size, time_pkg.time())
+            self.bytes += size
+            while len(self._entries) > self.max_items or self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def delete(self, ds_key):
+        """ Removes ds_key from the cache, if present, and forgets that it was missing. """
+        with self._lock:
+            self._remove(ds_key)
+            self._missing.pop(ds_key, None)
+
+    def put_missing(self, ds_key):
+        """ Remembers that ds_key was not found, for negative_ttl seconds, unless an entity is cached under it. """
+        if not self.negative_ttl:
+            return
+        with self._lock:
+            if ds_key in self._entries:
+                return
+            self._missing.pop(ds_key, None)
+            self._missing[ds_key] = time_pkg.time() + self.negative_ttl
+            while len(self._missing) > self.max_negative_items:
+                self._missing.popitem(last=False)
+
+    def is_missing(self, ds_key):
+        """ Returns True if ds_key was recently found missing. """
+        with self._lock:
+            expires = self._missing.get(ds_key)
+            if expires is None:
+                return False
+            if expires < time_pkg.time():
+                del self._missing[ds_key]
+                return False
+            self._missing.move_to_end(ds_key)
+            self.negative_hits += 1
+            return True
+
+    def get_stats(self):
+        """ Returns a dictionary of counters for this cache. """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._entries),
+                'bytes': self.bytes,
+                'negative_hits': self.negative_hits,
+                'negative_items': len(self._missing),
+            }
+
+    def _is_stale(self, entity, cached_at):
+        """ Returns True if the entity's timeout, or the max_age of the entry, has passed. """
+        if entity.timeout and entity.timeout < datetime.datetime.utcnow():
+            return True
+        if self.max_age and cached_at + self.max_age < time_pkg.time():
+            return True
+        return False
+
+    def _remove(self, ds_key):
+        """ Removes an entry; the caller must hold the lock. """
+        entry = self._entries.pop(ds_key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
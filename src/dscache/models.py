@@ -17,13 +17,18 @@ Copyright 2010 VendAsta Technologies Inc.
    limitations under the License.
 """
 
+import struct
+
 from google.appengine.ext import ndb
 
 class _DSCache(ndb.Model):
     """ The actual dscache cache entry.
     
-    Exactly one of the *_val items should have a non-None value.
+    Exactly one of the *_val items should have a non-None value, unless the entry is in the compact format:
+    then the encoded value is in payload, and value_type, codec and version are packed into header.
     Timeout is a UTC absolute timeout.
+
+    Only the properties that are set are written, rather than a null for every other declared property.
     """
 
     int_val = ndb.IntegerProperty(indexed=False)
@@ -36,6 +41,117 @@ class _DSCache(ndb.Model):
     text_val = ndb.TextProperty(indexed=False)
     json_val = ndb.TextProperty(indexed=False)
     blob_val = ndb.BlobProperty(indexed=False)
+    # the time of the write, on entries written before versions were introduced
     cas_id = ndb.FloatProperty(indexed=False)
+    # changes on every write; cas() compares it and increments it
+    version = ndb.IntegerProperty(indexed=False)
+
+    # the type or serializer of the value, and the codec it is compressed with (if any)
+    codec = ndb.StringProperty(indexed=False)
+    value_type = ndb.StringProperty(indexed=False)
+
+    # compact format only
+    payload = ndb.BlobProperty(indexed=False)
+    header = ndb.BlobProperty(indexed=False)
+
+    # set when the value is too large for one entity and is stored in _DSCacheChunk children instead
+    chunk_count = ndb.IntegerProperty(indexed=False)
+    checksum = ndb.StringProperty(indexed=False)
+
+    # set on the placeholder left by delete(seconds=...), which holds no value and blocks add() until its timeout
+    tombstone = ndb.BooleanProperty(indexed=False)
+
+    # set by get_or_compute(): how long the value took to compute, which scales its early refresh
+    compute_seconds = ndb.FloatProperty(indexed=False)
     
     timeout = ndb.DateTimeProperty()
+
+    # the flush generations the entry was written under, see build_namespace_generation(); Vacuum.sweep_generations()
+    # queries them to delete entries that a flush made unreachable (hashed key names lose their generation prefix)
+    generation = ndb.IntegerProperty()
+    namespace_generation = ndb.StringProperty()
+
+    # properties packed into the header of a compact entity
+    HEADER_PROPERTIES = ('value_type', 'codec', 'version')
+
+    @staticmethod
+    def build_namespace_generation(namespace, generation):
+        """ Builds the namespace_generation of an entry of a dscache namespace. Values of one namespace sort by
+        generation, and the namespace length in front keeps any namespace from sorting among another's values. """
+        return '{}:{}:{:020d}'.format(len(namespace), namespace, generation)
+
+    def _to_pb(self, *args, **kwargs):
+        """ Serializes the properties that are set, packing the header of a compact entity. """
+        if self.payload is not None:
+            self.header = struct.pack('!q', self.version or 0) + \
+                '{}\0{}'.format(self.value_type, self.codec or '').encode('utf-8')
+            skipped = self.HEADER_PROPERTIES
+        else:
+            skipped = ()
+        properties = self._properties
+        self._properties = {name: prop for name, prop in properties.items()
+                            if name not in skipped and prop._get_user_value(self) is not None}
+        try:
+            return super()._to_pb(*args, **kwargs)
+        finally:
+            if properties is self.__class__._properties:
+                del self._properties
+            else:
+                self._properties = properties
+
+    @classmethod
+    def _from_pb(cls, pb, *args, **kwargs):
+        """ Deserializes an entity, unpacking the header of a compact entity. """
+        entity = super()._from_pb(pb, *args, **kwargs)
+        if not entity._projection and entity.header:
+            value_type, codec = entity.header[8:].decode('utf-8').split('\0')
+            entity.version = struct.unpack('!q', entity.header[:8])[0]
+            entity.value_type = value_type
+            entity.codec = codec or None
+        return entity
+
+class _DSCacheChunk(ndb.Model):
+    """ One piece of a value too large for a single _DSCache entity.
+
+    The parent is the _DSCache manifest entity; ids run from 1 to its chunk_count.
+    """
+
+    # chunks are close to the memcache item limit and are always read through their manifest
+    _use_memcache = False
+
+    data = ndb.BlobProperty(indexed=False)
+    written = ndb.DateTimeProperty(auto_now=True)
+
+class _DSCacheGeneration(ndb.Model):
+    """ The flush generation of a dscache namespace.
+
+    The key name is the namespace, or GLOBAL_GENERATION for the generation shared by all of dscache.
+    Bumping a generation makes every entry written under the previous one unreachable.
+    """
+
+    GLOBAL_GENERATION = '__global__'
+
+    generation = ndb.IntegerProperty(indexed=False, default=0)
+
+class _DSCacheBloom(ndb.Model):
+    """ One shard of the Bloom filter of the keys set in a dscache namespace, keyed by "<namespace>:<shard index>".
+
+    Writers add keys to a random shard and readers merge all of them. The filter is only used once shard 0 is
+    complete, which rebuild_bloom_filter() marks after adding every existing key.
+    """
+
+    # the shards are read on their own schedule and are too large to keep in the context cache
+    _use_cache = False
+    _use_memcache = False
+
+    size = ndb.IntegerProperty(indexed=False)
+    hashes = ndb.IntegerProperty(indexed=False)
+    bits = ndb.BlobProperty(compressed=True)
+    complete = ndb.BooleanProperty(indexed=False, default=False)
+
+class _DSCacheVacuumProgress(ndb.Model):
+    """ The progress of one worker of a sharded vacuum run, keyed by "<run id>:<shard index>". """
+
+    deleted = ndb.IntegerProperty(indexed=False, default=0)
+    done = ndb.BooleanProperty(indexed=False, default=False)
+    updated = ndb.DateTimeProperty(indexed=False, auto_now=True)
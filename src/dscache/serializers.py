@@ -0,0 +1,81 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import json
+import marshal
+import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# marshal format version; readable by every Python 3 release
+MARSHAL_VERSION = 4
+# types whose values are serialized with marshal, if they contain nothing else (marshal rejects subclasses)
+MARSHAL_TYPES = frozenset([dict, list, tuple, set, frozenset, bytes, complex, type(None)])
+
+# serializer name -> (dumps, loads); the name is recorded on each entity as its value_type
+_SERIALIZERS = {
+    'pickle': (lambda value: pickle.dumps(value, pickle.HIGHEST_PROTOCOL), pickle.loads),
+    'marshal': (lambda value: marshal.dumps(value, MARSHAL_VERSION), marshal.loads),
+    'json': (lambda value: json.dumps(value).encode('utf-8'), lambda data: json.loads(data.decode('utf-8'))),
+}
+if msgpack is not None:
+    _SERIALIZERS['msgpack'] = (lambda value: msgpack.packb(value, use_bin_type=True),
+                               lambda data: msgpack.unpackb(data, raw=False))
+
+def register_serializer(name, dumps, loads):
+    """ Registers a serializer. dumps takes a value and returns bytes; loads does the reverse.
+
+    Entities record the serializer name they were written with, so a serializer must stay registered
+    (under the same name) for as long as entities serialized with it may be read.
+    """
+    _SERIALIZERS[name] = (dumps, loads)
+
+def is_registered(name):
+    """ Returns True if a serializer is registered under name. """
+    return name in _SERIALIZERS
+
+def dumps(value, name=None):
+    """ Serializes a value with the named serializer.
+
+    Without a name, plain containers of builtin values are serialized with marshal and anything else with pickle.
+    The return value is a tuple (serializer name, bytes).
+    """
+    if name is None:
+        if type(value) in MARSHAL_TYPES:
+            try:
+                return 'marshal', marshal.dumps(value, MARSHAL_VERSION)
+            except ValueError:
+                # the container holds something marshal does not support
+                pass
+        name = 'pickle'
+    try:
+        serialize = _SERIALIZERS[name][0]
+    except KeyError:
+        raise ValueError('unknown serializer "%s"' % name)
+    return name, serialize(value)
+
+def loads(data, name):
+    """ Deserializes bytes with the named serializer. """
+    try:
+        return _SERIALIZERS[name][1](data)
+    except KeyError:
+        raise ValueError('unknown serializer "%s"' % name)
@@ -0,0 +1,103 @@
+""" appengine-dscache: A datastore-based implementation of memcache
+
+Docs and examples: http://code.google.com/p/appengine-dscache/
+
+Copyright 2010 VendAsta Technologies Inc.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import collections
+import threading
+import time as time_pkg
+
+# number of recent latency samples kept per operation
+MAX_LATENCY_SAMPLES = 1024
+LATENCY_PERCENTILES = (50, 90, 99)
+
+class Stats:
+    """ An in-process collector of dscache statistics.
+
+    Counters are updated under a lock held only for the increments; latency samples are appended to
+    bounded deques without locking, and percentiles are only computed when get_stats() is called.
+    """
+
+    def __init__(self, max_samples=MAX_LATENCY_SAMPLES):
+        """ Initializes the collector. """
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clears all counters and latency samples. """
+        with self._lock:
+            self._started = time_pkg.time()
+            self._counters = collections.Counter()
+            self._errors = collections.Counter()
+            self._latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.max_samples))
+
+    def record_read(self, hits=0, misses=0, bytes_read=0, expired=0):
+        """ Records the outcome of a lookup. """
+        with self._lock:
+            self._counters['hits'] += hits
+            self._counters['misses'] += misses
+            self._counters['bytes_read'] += bytes_read
+            self._counters['expired'] += expired
+
+    def record_write(self, items=0, bytes_written=0):
+        """ Records entities written to dscache. """
+        with self._lock:
+            self._counters['items_written'] += items
+            self._counters['bytes_written'] += bytes_written
+
+    def record_error(self, op):
+        """ Records an error on the named operation. """
+        with self._lock:
+            self._errors[op] += 1
+
+    def record_latency(self, op, seconds):
+        """ Records how long a call of the named operation took. """
+        self._latencies[op].append(seconds)
+
+    def get_stats(self):
+        """ Returns the statistics as a dictionary.
+
+        The memcache keys (hits, misses, byte_hits, items, bytes, oldest_item_age) are always present; items and
+        bytes count what this instance has written, as the total size of dscache is not tracked. Also included are
+        expired (entities found but past their timeout), errors (per operation) and latency (per operation: the
+        sample count and percentiles, in milliseconds, of the most recent calls).
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            errors = dict(self._errors)
+            started = self._started
+        latency = {}
+        for op, samples in list(self._latencies.items()):
+            samples = sorted(samples)
+            if not samples:
+                continue
+            latency[op] = {'count': len(samples)}
+            for percentile in LATENCY_PERCENTILES:
+                index = min(len(samples) - 1, len(samples) * percentile // 100)
+                latency[op]['p%d' % percentile] = samples[index] * 1000.0
+        return {
+            'hits': counters.get('hits', 0),
+            'misses': counters.get('misses', 0),
+            'byte_hits': counters.get('bytes_read', 0),
+            'items': counters.get('items_written', 0),
+            'bytes': counters.get('bytes_written', 0),
+            'oldest_item_age': int(time_pkg.time() - started),
+            'expired': counters.get('expired', 0),
+            'errors': errors,
+            'latency': latency,
+        }
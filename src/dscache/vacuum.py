@@ -18,27 +18,278 @@ Copyright 2010 VendAsta Technologies Inc.
 """
 
 import datetime
+import json
+import logging
+import time as time_pkg
+from urllib.parse import parse_qs, urlencode
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from .models import _DSCache
+from .models import _DSCache, _DSCacheChunk, _DSCacheGeneration, _DSCacheVacuumProgress
+
+BATCH_DELETE_SIZE = 500
+# seconds a single vacuum request may run before returning a continuation cursor
+DEFAULT_TIME_BUDGET = 50
+DEFAULT_VACUUM_SHARDS = 8
+# chunks younger than this are left alone by the sweep, as their manifest may not have been put yet
+CHUNK_GRACE_PERIOD = datetime.timedelta(minutes=10)
+
+def _to_timestamp(value):
+    """ Converts a naive UTC datetime to a POSIX timestamp string, for use in query parameters. """
+    return repr((value - datetime.datetime(1970, 1, 1)).total_seconds())
 
-BATCH_DELETE_SIZE = 100
+def _from_timestamp(value):
+    """ Converts a POSIX timestamp string back to a naive UTC datetime. """
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=float(value))
 
 class Vacuum:
-    """ A vacuum to clean up old dscache entries. """
+    """ A vacuum to clean up old dscache entries.
+
+    Each run walks the expired entries with a query cursor, deleting one page while the next is fetched,
+    until the entries run out or the time budget is spent. The WSGI response is a JSON object with the
+    number of entities deleted, whether there is more to do and, if so, the cursor to resume from
+    (pass it back as the cursor query parameter, e.g. from a task chain).
+
+    The start and end query parameters (POSIX timestamps) restrict a run to entries whose timeout falls in
+    [start, end); VacuumCoordinator uses them to split the work. When the chain parameter is given, a run that
+    did not finish enqueues a task to resume itself. A run with a run and shard parameter records its progress
+    in a _DSCacheVacuumProgress entity; see VacuumCoordinator.get_progress().
+
+    With the sweep=chunks query parameter, a run deletes orphaned chunks of large values instead; see sweep_chunks().
+    With sweep=generations, it deletes the entries made unreachable by flush_all(); see sweep_generations().
+
+    Entries are deleted once they have been expired for grace seconds, so that get_or_revalidate() can serve them
+    stale in the meantime; give the largest stale_ttl it is called with.
+    """
+
+    def __init__(self, batch_size=BATCH_DELETE_SIZE, time_budget=DEFAULT_TIME_BUDGET, grace=0):
+        """ Initializes the vacuum. """
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.grace = grace
 
     def __call__(self, environ, start_response):
         """ The GET method. """
+        params = {name: values[0] for name, values in parse_qs(environ.get('QUERY_STRING', '')).items()}
+        start = _from_timestamp(params['start']) if params.get('start') else None
+        end = _from_timestamp(params['end']) if params.get('end') else None
+        if params.get('sweep') == 'chunks':
+            deleted, cursor, more = self.sweep_chunks(cursor=params.get('cursor'))
+        elif params.get('sweep') == 'generations':
+            deleted, cursor, more = self.sweep_generations()
+        else:
+            deleted, cursor, more = self.run(cursor=params.get('cursor'), start=start, end=end)
+
+        if params.get('run') and params.get('shard'):
+            self._record_progress('{}:{}'.format(params['run'], params['shard']), deleted, not more)
+        if more and params.get('chain'):
+            params.pop('cursor', None)
+            if cursor:
+                params['cursor'] = cursor
+            taskqueue.add(url='{}?{}'.format(environ.get('PATH_INFO', '/'), urlencode(params)), method='GET',
+                          queue_name=params.get('queue', 'default'))
+
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'deleted': deleted, 'cursor': cursor, 'more': more}).encode()]
+
+    def run(self, cursor=None, time_budget=None, start=None, end=None):
+        """ Deletes expired entries, starting from cursor (a urlsafe cursor string, or None to start over).
+        Only entries whose timeout is in [start, end) are considered; either bound may be None.
+
+        The return value is a tuple (deleted, cursor, more): the number of entities deleted, the urlsafe cursor
+        to resume from, and whether there may be more expired entries after it.
+        """
+        return self.run_async(cursor=cursor, time_budget=time_budget, start=start, end=end).get_result()
+
+    def _query(self, start=None, end=None):
+        """ Builds the query of entries expired for over the grace period, optionally restricted to timeouts in
+        [start, end). """
+        now = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.grace)
+        end = min(end, now) if end else now
+        query = _DSCache.query().filter(_DSCache.timeout < end)
+        if start:
+            query = query.filter(_DSCache.timeout >= start)
+        return query
+
+    def _record_progress(self, name, deleted, done):
+        """ Adds to the progress entity of a sharded vacuum worker; only that worker writes it. """
+        try:
+            progress = _DSCacheVacuumProgress.get_by_id(name, namespace='') or \
+                _DSCacheVacuumProgress(id=name, namespace='')
+            progress.deleted += deleted
+            progress.done = done
+            progress.put()
+        except Exception:
+            logging.exception('dscache: error recording vacuum progress %s', name)
+
+    @ndb.tasklet
+    def run_async(self, cursor=None, time_budget=None, start=None, end=None):
+        """ Asynchronous version of run(); returns a future. """
+        time_budget = self.time_budget if time_budget is None else time_budget
+        deadline = time_pkg.time() + time_budget
+        query = self._query(start=start, end=end)
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+
+        deleted = 0
+        pending_delete = None
+        keys, next_cursor, more = yield query.fetch_page_async(self.batch_size, start_cursor=start_cursor,
+                                                               keys_only=True)
+        while True:
+            # delete this page while the next one is being fetched
+            if pending_delete:
+                yield pending_delete
+            pending_delete = ndb.delete_multi_async(keys)
+            deleted += len(keys)
+            if not more or not next_cursor or time_pkg.time() >= deadline:
+                break
+            keys, next_cursor, more = yield query.fetch_page_async(self.batch_size, start_cursor=next_cursor,
+                                                                   keys_only=True)
+        yield pending_delete
+
+        urlsafe = next_cursor.urlsafe().decode() if more and next_cursor else None
+        raise ndb.Return((deleted, urlsafe, bool(urlsafe)))
+
+    def sweep_chunks(self, cursor=None, time_budget=None):
+        """ Deletes the chunks of values that were deleted, expired, flushed or overwritten, starting from cursor.
+        Chunks are not reachable by key from the expired-entry query, so they are found by scanning all chunks.
+
+        The return value is a tuple (deleted, cursor, more), as for run().
+        """
+        return self.sweep_chunks_async(cursor=cursor, time_budget=time_budget).get_result()
+
+    @ndb.tasklet
+    def sweep_chunks_async(self, cursor=None, time_budget=None):
+        """ Asynchronous version of sweep_chunks(); returns a future. """
+        time_budget = self.time_budget if time_budget is None else time_budget
+        deadline = time_pkg.time() + time_budget
         now = datetime.datetime.utcnow()
-        
-        query = _DSCache.query().filter(_DSCache.timeout < now)
-        
-        # this will just run until the rug gets pulled out (DeadlineExceededError)
-        keys = query.fetch(BATCH_DELETE_SIZE, keys_only=True)
-
-        ndb.delete_multi(keys)
-        while len(keys) == BATCH_DELETE_SIZE:
-            keys = query.fetch(BATCH_DELETE_SIZE, keys_only=True)
-            ndb.delete_multi(keys)
-        
-        start_response('200 OK', [('Content-Type', 'text/plain')])
-        return [b'']
\ No newline at end of file
+        query = _DSCacheChunk.query().filter(_DSCacheChunk.written < now - CHUNK_GRACE_PERIOD)
+        next_cursor = Cursor(urlsafe=cursor) if cursor else None
+
+        deleted = 0
+        while True:
+            keys, next_cursor, more = yield query.fetch_page_async(self.batch_size, start_cursor=next_cursor,
+                                                                   keys_only=True)
+            parent_keys = list({key.parent() for key in keys})
+            manifests = yield ndb.get_multi_async(parent_keys)
+            chunk_counts = {manifest.key: manifest.chunk_count for manifest in manifests
+                            if manifest and manifest.chunk_count and not (manifest.timeout and manifest.timeout < now)}
+            orphans = [key for key in keys if key.id() > chunk_counts.get(key.parent(), 0)]
+            if orphans:
+                yield ndb.delete_multi_async(orphans)
+            deleted += len(orphans)
+            if not more or not next_cursor or time_pkg.time() >= deadline:
+                break
+
+        urlsafe = next_cursor.urlsafe().decode() if more and next_cursor else None
+        raise ndb.Return((deleted, urlsafe, bool(urlsafe)))
+
+    def sweep_generations(self, time_budget=None):
+        """ Deletes the entries written under a flush generation older than the current one, which flush_all() made
+        unreachable. Entries with a timeout are also deleted by run() once they expire, but the others are only
+        found here. Entries written before generations were recorded on them are not found.
+
+        Deleted entries drop out of the queries, so a run that is out of time returns no cursor: the next run starts
+        over. The return value is a tuple (deleted, None, more), as for run().
+        """
+        return self.sweep_generations_async(time_budget=time_budget).get_result()
+
+    def _generation_queries(self):
+        """ Builds the queries of the entries of older generations: one for the global generation, and one for each
+        namespace that was flushed on its own. """
+        queries = []
+        for generation in _DSCacheGeneration.query(namespace='').fetch():
+            name = generation.key.id()
+            if name == _DSCacheGeneration.GLOBAL_GENERATION:
+                queries.append(_DSCache.query().filter(_DSCache.generation < generation.generation))
+            else:
+                first = _DSCache.build_namespace_generation(name, 0)
+                current = _DSCache.build_namespace_generation(name, generation.generation)
+                queries.append(_DSCache.query().filter(_DSCache.namespace_generation >= first,
+                                                       _DSCache.namespace_generation < current))
+        return queries
+
+    @ndb.tasklet
+    def sweep_generations_async(self, time_budget=None):
+        """ Asynchronous version of sweep_generations(); returns a future. """
+        time_budget = self.time_budget if time_budget is None else time_budget
+        deadline = time_pkg.time() + time_budget
+
+        deleted = 0
+        for query in self._generation_queries():
+            cursor, more = None, True
+            while more:
+                keys, cursor, more = yield query.fetch_page_async(self.batch_size, start_cursor=cursor,
+                                                                  keys_only=True)
+                more = more and bool(cursor)
+                if keys:
+                    yield ndb.delete_multi_async(keys)
+                deleted += len(keys)
+                if more and time_pkg.time() >= deadline:
+                    raise ndb.Return((deleted, None, True))
+        raise ndb.Return((deleted, None, False))
+
+class VacuumCoordinator:
+    """ Fans a vacuum out over several workers, so cleanup throughput scales with the number of instances.
+
+    Datastore allows inequality filters on a single property, and the vacuum query already filters on the
+    timeout, so the keyspace is split by expiry time rather than by key: the span from the oldest expired
+    entry to now is cut into equal ranges, and one chained Vacuum task is enqueued per range. worker_url
+    is the path a Vacuum is mounted at.
+
+    The WSGI response is a JSON object with the run id and the ranges enqueued. Pass the run id to
+    get_progress() to see how far each worker got.
+    """
+
+    def __init__(self, worker_url, shards=DEFAULT_VACUUM_SHARDS, queue_name='default'):
+        """ Initializes the coordinator. """
+        self.worker_url = worker_url
+        self.shards = shards
+        self.queue_name = queue_name
+
+    def __call__(self, environ, start_response):
+        """ The GET method. """
+        run_id, ranges = self.start()
+
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [json.dumps({'run': run_id, 'ranges': ranges}).encode()]
+
+    def split(self):
+        """ Splits the expired entries into at most self.shards timeout ranges.
+
+        The return value is a list of (start, end) POSIX timestamp strings; the first start is None.
+        """
+        now = datetime.datetime.utcnow()
+        oldest = _DSCache.query().filter(_DSCache.timeout < now).order(_DSCache.timeout).get(
+            projection=[_DSCache.timeout])
+        if not oldest:
+            return []
+        step = (now - oldest.timeout) / self.shards
+        bounds = [oldest.timeout + step * i for i in range(1, self.shards)]
+        starts = [None] + [_to_timestamp(bound) for bound in bounds]
+        ends = [_to_timestamp(bound) for bound in bounds] + [_to_timestamp(now)]
+        return list(zip(starts, ends))
+
+    def start(self):
+        """ Enqueues one vacuum task per timeout range.
+
+        The return value is a tuple (run id, list of ranges).
+        """
+        run_id = str(int(time_pkg.time() * 1000))
+        ranges = self.split()
+        for shard, (start, end) in enumerate(ranges):
+            params = {'end': end, 'run': run_id, 'shard': shard, 'chain': 1, 'queue': self.queue_name}
+            if start:
+                params['start'] = start
+            taskqueue.add(url='{}?{}'.format(self.worker_url, urlencode(params)), method='GET',
+                          queue_name=self.queue_name)
+        return run_id, ranges
+
+    @staticmethod
+    def get_progress(run_id, shards=DEFAULT_VACUUM_SHARDS):
+        """ Returns a list with one dictionary (deleted, done) per worker of the given run. """
+        keys = [ndb.Key(_DSCacheVacuumProgress, '{}:{}'.format(run_id, shard), namespace='')
+                for shard in range(shards)]
+        return [{'deleted': progress.deleted if progress else 0, 'done': bool(progress and progress.done)}
+                for progress in ndb.get_multi(keys)]
@@ -2,11 +2,19 @@
 
 import unittest
 import datetime
-from google.appengine.api import full_app_id
-from google.appengine.ext import testbed
-from dscache import dscache
-from dscache.models import _DSCache
-from dscache.vacuum import Vacuum, BATCH_DELETE_SIZE
+import json
+import os
+import pickle
+import zlib
+from google.appengine.api import apiproxy_stub_map, full_app_id, memcache
+from google.appengine.ext import ndb, testbed
+from google.appengine.ext.ndb import eventloop
+from dscache import compression, dscache, serializers
+from dscache.bloom import BloomFilter
+from dscache.breaker import CircuitBreaker
+from dscache import vacuum
+from dscache.models import _DSCache, _DSCacheBloom, _DSCacheChunk
+from dscache.vacuum import Vacuum, VacuumCoordinator, BATCH_DELETE_SIZE
 
 class DatastoreTests(unittest.TestCase):
 
@@ -18,6 +26,8 @@ class DatastoreTests(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        dscache._generations.clear()
+        dscache._stats.reset()
 
     def tearDown(self):
         """ Tear down the unit test environment. """
@@ -39,7 +49,7 @@ class VacuumTests(DatastoreTests):
     def test_nothing_to_delete(self):
         _DSCache(timeout=self.tomorrow).put()
 
-        self.vacuum.get()
+        self.vacuum.run()
 
         keys = _DSCache.query().fetch(2, keys_only=True)
         self.assertEqual(1, len(keys))
@@ -48,7 +58,16 @@ class VacuumTests(DatastoreTests):
         _DSCache(timeout=self.tomorrow).put()
         _DSCache(timeout=self.yesterday).put()
 
-        self.vacuum.get()
+        self.vacuum.run()
+
+        keys = _DSCache.query().fetch(2, keys_only=True)
+        self.assertEqual(1, len(keys))
+
+    def test_grace_keeps_recently_expired_values(self):
+        _DSCache(timeout=datetime.datetime.utcnow() - datetime.timedelta(minutes=1)).put()
+        _DSCache(timeout=self.yesterday).put()
+
+        self.assertEqual(1, Vacuum(grace=3600).run()[0])
 
         keys = _DSCache.query().fetch(2, keys_only=True)
         self.assertEqual(1, len(keys))
@@ -57,11 +76,100 @@ class VacuumTests(DatastoreTests):
         for i in range(0, 2*BATCH_DELETE_SIZE+1):
             _DSCache(timeout=self.yesterday).put()
 
-        self.vacuum.get()
+        self.vacuum.run()
 
         keys = _DSCache.query().fetch(1000, keys_only=True)
         self.assertEqual(0, len(keys))
 
+    def test_run_reports_deleted_count(self):
+        for i in range(0, 3):
+            _DSCache(timeout=self.yesterday).put()
+        deleted, cursor, more = self.vacuum.run()
+        self.assertEqual(3, deleted)
+        self.assertEqual(None, cursor)
+        self.assertEqual(False, more)
+
+    def test_time_budget_returns_resumable_cursor(self):
+        for i in range(0, 5):
+            _DSCache(timeout=self.yesterday).put()
+        vacuum = Vacuum(batch_size=2, time_budget=0)
+        deleted, cursor, more = vacuum.run()
+        self.assertEqual(2, deleted)
+        self.assertEqual(True, more)
+        total = deleted
+        while more:
+            deleted, cursor, more = vacuum.run(cursor=cursor)
+            total += deleted
+        self.assertEqual(5, total)
+        self.assertEqual(0, len(_DSCache.query().fetch(10, keys_only=True)))
+
+    def test_wsgi_response(self):
+        for i in range(0, 3):
+            _DSCache(timeout=self.yesterday).put()
+        statuses = []
+        vacuum = Vacuum(batch_size=2, time_budget=0)
+        body = vacuum({'QUERY_STRING': ''}, lambda status, headers: statuses.append(status))
+        result = json.loads(b''.join(body))
+        self.assertEqual(['200 OK'], statuses)
+        self.assertEqual(2, result['deleted'])
+        self.assertEqual(True, result['more'])
+        body = vacuum({'QUERY_STRING': 'cursor=' + result['cursor']}, lambda status, headers: None)
+        result = json.loads(b''.join(body))
+        self.assertEqual(1, result['deleted'])
+        self.assertEqual(False, result['more'])
+
+class VacuumCoordinatorTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue_stub = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.coordinator = VacuumCoordinator('/vacuum', shards=4)
+        self.vacuum = Vacuum(batch_size=2, time_budget=0)
+        now = datetime.datetime.utcnow()
+        for days in range(1, 9):
+            _DSCache(timeout=now - datetime.timedelta(days=days)).put()
+        _DSCache(timeout=now + datetime.timedelta(days=1)).put()
+
+    def _run_tasks(self):
+        """ Runs queued vacuum tasks (including the ones they chain) until the queue is empty. """
+        while True:
+            tasks = self.taskqueue_stub.get_filtered_tasks()
+            if not tasks:
+                return
+            self.taskqueue_stub.FlushQueue('default')
+            for task in tasks:
+                path, query = task.url.split('?', 1)
+                self.vacuum({'PATH_INFO': path, 'QUERY_STRING': query}, lambda status, headers: None)
+
+    def test_ranges_cover_expired_entries(self):
+        ranges = self.coordinator.split()
+        self.assertEqual(4, len(ranges))
+        self.assertEqual(None, ranges[0][0])
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, start)
+
+    def test_nothing_to_split(self):
+        ndb.delete_multi(_DSCache.query().fetch(keys_only=True))
+        self.assertEqual([], self.coordinator.split())
+
+    def test_one_task_per_range(self):
+        run_id, ranges = self.coordinator.start()
+        tasks = self.taskqueue_stub.get_filtered_tasks()
+        self.assertEqual(len(ranges), len(tasks))
+        for task in tasks:
+            self.assertTrue(task.url.startswith('/vacuum?'))
+
+    def test_workers_delete_all_expired_entries_and_report_progress(self):
+        statuses = []
+        body = self.coordinator({}, lambda status, headers: statuses.append(status))
+        run_id = json.loads(b''.join(body))['run']
+        self._run_tasks()
+        self.assertEqual(1, len(_DSCache.query().fetch(10, keys_only=True)))
+        progress = VacuumCoordinator.get_progress(run_id, shards=4)
+        self.assertEqual(8, sum(shard['deleted'] for shard in progress))
+        self.assertTrue(all(shard['done'] for shard in progress))
+
 class SetTests(DatastoreTests):
 
     def test_int_set(self):
@@ -157,6 +265,305 @@ class SetTests(DatastoreTests):
         dscache.set('1', True)
         self.assertNotEqual(None, dscache.get('1'))
 
+class CompressionTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        dscache.ENTITY_FORMAT = dscache.FORMAT_COMPACT
+
+    def tearDown(self):
+        dscache.ENTITY_FORMAT = dscache.FORMAT_LEGACY
+        super().tearDown()
+
+    def _get_entity(self, key):
+        return dscache.build_ds_key(key).get()
+
+    def test_large_text_compressed(self):
+        value = 'abc' * 10000
+        dscache.set('key', value)
+        entity = self._get_entity('key')
+        self.assertEqual('zlib', entity.codec)
+        self.assertEqual(None, entity.text_val)
+        self.assertTrue(len(entity.payload) < len(value))
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_legacy_format_not_compressed(self):
+        dscache.ENTITY_FORMAT = dscache.FORMAT_LEGACY
+        dscache.set_multi({'text': 'abc' * 10000, 'object': [{'a': i % 10} for i in range(5000)]})
+        self.assertEqual((None, 'abc' * 10000), (self._get_entity('text').codec, self._get_entity('text').text_val))
+        # readable by earlier releases, which unpickle blob_val
+        self.assertEqual(None, self._get_entity('object').codec)
+        self.assertEqual({'a': 1}, pickle.loads(self._get_entity('object').blob_val)[1])
+
+    def test_large_object_compressed(self):
+        value = [{'a': i % 10} for i in range(5000)]
+        dscache.set('key', value)
+        self.assertEqual('zlib', self._get_entity('key').codec)
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_small_value_not_compressed(self):
+        dscache.set('key', 'abc' * 200)
+        entity = self._get_entity('key')
+        self.assertEqual(None, entity.codec)
+        self.assertEqual(b'abc' * 200, entity.payload)
+
+    def test_incompressible_value_not_compressed(self):
+        value = os.urandom(10000)
+        dscache.set('key', value)
+        self.assertEqual(None, self._get_entity('key').codec)
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_min_compress_len_override(self):
+        dscache.set_multi({'a': 'abc' * 200}, min_compress_len=100)
+        self.assertEqual('zlib', self._get_entity('a').codec)
+        self.assertEqual('abc' * 200, dscache.get_multi(['a'])['a'])
+
+    def test_custom_codec(self):
+        compression.register_compressor('reversed', lambda data: zlib.compress(data)[::-1],
+                                        lambda data: zlib.decompress(data[::-1]))
+        old_codec = dscache.COMPRESSION_CODEC
+        dscache.COMPRESSION_CODEC = 'reversed'
+        try:
+            dscache.set('key', 'abc' * 10000)
+        finally:
+            dscache.COMPRESSION_CODEC = old_codec
+        self.assertEqual('reversed', self._get_entity('key').codec)
+        self.assertEqual('abc' * 10000, dscache.get('key'))
+
+    def test_cas_honors_min_compress_len(self):
+        client = dscache.Client()
+        dscache.set('key', 'value')
+        client.gets('key')
+        self.assertTrue(client.cas('key', 'abc' * 200, min_compress_len=100))
+        self.assertEqual('zlib', self._get_entity('key').codec)
+        self.assertEqual('abc' * 200, dscache.get('key'))
+
+class SerializerTests(DatastoreTests):
+
+    def _get_entity(self, key):
+        return dscache.build_ds_key(key).get()
+
+    def test_value_type_recorded(self):
+        dscache.set('key', 1)
+        self.assertEqual('int', self._get_entity('key').value_type)
+        self.assertEqual(1, dscache.get('key'))
+
+    def test_legacy_format_pickles_containers(self):
+        dscache.set('key', {'a': 1})
+        self.assertEqual('pickle', self._get_entity('key').value_type)
+        self.assertEqual({'a': 1}, pickle.loads(self._get_entity('key').blob_val))
+
+    def test_object_pickled(self):
+        dscache.set('key', [Obj(a=1)])
+        self.assertEqual('pickle', self._get_entity('key').value_type)
+        self.assertEqual(1, dscache.get('key')[0].a)
+
+    def test_large_integer(self):
+        dscache.set('key', 2 ** 70)
+        self.assertEqual(2 ** 70, dscache.get('key'))
+
+    def test_serializer_override(self):
+        dscache.set('key', {'a': 1}, serializer='json')
+        self.assertEqual('json', self._get_entity('key').value_type)
+        self.assertEqual({'a': 1}, dscache.get('key'))
+
+    def test_client_serializer(self):
+        serializers.register_serializer('repr', lambda value: repr(value).encode(), lambda data: eval(data))
+        client = dscache.Client(serializer='repr')
+        client.set_multi({'a': [1, 2]})
+        self.assertEqual('repr', self._get_entity('a').value_type)
+        self.assertEqual([1, 2], dscache.get('a'))
+
+    def test_unknown_serializer(self):
+        self.assertRaises(ValueError, dscache.set, 'key', [1], serializer='unknown')
+
+    def test_legacy_json_entity(self):
+        _DSCache(key=dscache.build_ds_key('key'), json_val=json.dumps({'a': 1})).put()
+        self.assertEqual({'a': 1}, dscache.get('key'))
+
+    def test_legacy_pickled_entity(self):
+        _DSCache(key=dscache.build_ds_key('key'), blob_val=pickle.dumps([1, 2])).put()
+        self.assertEqual([1, 2], dscache.get('key'))
+
+    def test_unset_properties_not_written(self):
+        dscache.set('key', 1)
+        pb = dscache.build_ds_key('key').get()._to_pb()
+        self.assertEqual(['int_val', 'value_type', 'version'], sorted(p.name for p in pb.raw_property))
+        # the flush generation is the only indexed property
+        self.assertEqual(['generation'], [p.name for p in pb.property])
+
+    def test_legacy_compressed_text_entity(self):
+        _DSCache(key=dscache.build_ds_key('key'), blob_val=zlib.compress(b'abc' * 1000), codec='zlib',
+                 value_type='text').put()
+        self.assertEqual('abc' * 1000, dscache.get('key'))
+
+class CompactFormatTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        dscache.ENTITY_FORMAT = dscache.FORMAT_COMPACT
+
+    def tearDown(self):
+        dscache.ENTITY_FORMAT = dscache.FORMAT_LEGACY
+        super().tearDown()
+
+    def _get_entity(self, key):
+        ndb.get_context().clear_cache()
+        return dscache.build_ds_key(key).get()
+
+    def _property_names(self, key):
+        pb = self._get_entity(key)._to_pb()
+        return sorted(p.name for p in list(pb.property) + list(pb.raw_property))
+
+    def test_values_round_trip(self):
+        values = [True, False, -5, 2 ** 63 - 1, 2 ** 70, 1.5, 'abc', 'abc' * 200, '',
+                  datetime.datetime(2020, 1, 2, 3, 4, 5, 6), datetime.date(2020, 1, 2), datetime.time(3, 4, 5, 6),
+                  {'a': (1, 2)}, Obj(a=1).__dict__]
+        dscache.set_multi({str(i): value for i, value in enumerate(values)})
+        ndb.get_context().clear_cache()
+        for i, value in enumerate(values):
+            self.assertEqual(value, dscache.get(str(i)))
+            self.assertEqual(type(value), type(dscache.get(str(i))))
+
+    def test_only_payload_and_header_written(self):
+        dscache.set('a', 1)
+        dscache.set('b', 'value', time=60)
+        self.assertEqual(['generation', 'header', 'payload'], self._property_names('a'))
+        self.assertEqual(['generation', 'header', 'payload', 'timeout'], self._property_names('b'))
+
+    def test_header(self):
+        dscache.set('key', 'abc' * 10000)
+        entity = self._get_entity('key')
+        self.assertEqual(('text', 'zlib'), (entity.value_type, entity.codec))
+        self.assertEqual(None, entity.blob_val)
+        self.assertEqual('abc' * 10000, dscache.get('key'))
+
+    def test_plain_container_marshalled(self):
+        value = {'a': (1, 2.5), 'b': [None, b'x', {3}]}
+        dscache.set('key', value)
+        self.assertEqual('marshal', self._get_entity('key').value_type)
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_compressed_marshalled_value(self):
+        value = list(range(10000))
+        dscache.set('key', value)
+        entity = self._get_entity('key')
+        self.assertEqual(('marshal', 'zlib'), (entity.value_type, entity.codec))
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_legacy_entity_read(self):
+        dscache.ENTITY_FORMAT = dscache.FORMAT_LEGACY
+        dscache.set_multi({'a': 1, 'b': [1, 2]})
+        dscache.ENTITY_FORMAT = dscache.FORMAT_COMPACT
+        self.assertEqual({'a': 1, 'b': [1, 2]}, dscache.get_multi(['a', 'b']))
+        self.assertEqual(2, dscache.incr('a'))
+        self.assertEqual(['generation', 'header', 'payload'], self._property_names('a'))
+
+    def test_chunked(self):
+        value = os.urandom(2 * 1024 * 1024)
+        dscache.set('key', value)
+        self.assertEqual(3, self._get_entity('key').chunk_count)
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_counters(self):
+        self.assertEqual(11, dscache.incr('key', initial_value=10))
+        self.assertEqual(2 ** 64 - 1, dscache.decr('big', initial_value=2 ** 64 - 1, delta=0))
+        dscache.incr_sharded('sharded', 5, shards=2)
+        self.assertEqual(5, dscache.get_sharded('sharded', shards=2))
+
+    def test_cas(self):
+        client = dscache.Client()
+        dscache.set('key', 'value')
+        ndb.get_context().clear_cache()
+        client.gets('key')
+        self.assertTrue(client.cas('key', 'value2'))
+        self.assertFalse(client.cas('key', 'value3'))
+        self.assertEqual('value2', dscache.get('key'))
+
+class ChunkingTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.value = os.urandom(2 * 1024 * 1024)
+        self.grace_period = vacuum.CHUNK_GRACE_PERIOD
+        vacuum.CHUNK_GRACE_PERIOD = datetime.timedelta(0)
+
+    def tearDown(self):
+        vacuum.CHUNK_GRACE_PERIOD = self.grace_period
+        super().tearDown()
+
+    def _chunk_count(self):
+        return _DSCacheChunk.query().count()
+
+    def test_large_value_chunked(self):
+        self.assertTrue(dscache.set('key', self.value))
+        entity = dscache.build_ds_key('key').get()
+        self.assertEqual(3, entity.chunk_count)
+        self.assertEqual(None, entity.blob_val)
+        self.assertEqual(3, self._chunk_count())
+        ndb.get_context().clear_cache()
+        self.assertEqual(self.value, dscache.get('key'))
+
+    def test_large_compressed_text_chunked(self):
+        value = os.urandom(1024 * 1024).hex()
+        dscache.ENTITY_FORMAT = dscache.FORMAT_COMPACT
+        try:
+            dscache.set('key', value)
+        finally:
+            dscache.ENTITY_FORMAT = dscache.FORMAT_LEGACY
+        entity = dscache.build_ds_key('key').get()
+        self.assertEqual('zlib', entity.codec)
+        self.assertEqual(2, entity.chunk_count)
+        self.assertEqual(value, dscache.get('key'))
+
+    def test_set_multi_and_get_multi(self):
+        self.assertEqual([], dscache.set_multi({'large': self.value, 'small': 'value'}))
+        self.assertEqual({'large': self.value, 'small': 'value'}, dscache.get_multi(['large', 'small']))
+
+    def test_add(self):
+        self.assertTrue(dscache.add('key', self.value))
+        self.assertFalse(dscache.add('key', self.value))
+        self.assertEqual(self.value, dscache.get('key'))
+
+    def test_missing_chunk_is_miss(self):
+        dscache.set('key', self.value)
+        ndb.Key(_DSCacheChunk, 2, parent=dscache.build_ds_key('key')).delete()
+        ndb.get_context().clear_cache()
+        self.assertEqual(None, dscache.get('key'))
+        self.assertEqual({}, dscache.get_multi(['key']))
+
+    def test_chunks_share_timeout(self):
+        dscache.set('key', self.value, time=-1)
+        self.assertEqual(None, dscache.get('key'))
+
+    def test_sweep_deletes_chunks_of_deleted_value(self):
+        dscache.set('key', self.value)
+        dscache.set('other', self.value)
+        dscache.delete('key')
+        deleted, cursor, more = Vacuum().sweep_chunks()
+        self.assertEqual(3, deleted)
+        self.assertFalse(more)
+        self.assertEqual(3, self._chunk_count())
+        self.assertEqual(self.value, dscache.get('other'))
+
+    def test_sweep_deletes_chunks_of_expired_value(self):
+        dscache.set('key', self.value, time=-1)
+        Vacuum().sweep_chunks()
+        self.assertEqual(0, self._chunk_count())
+
+    def test_sweep_deletes_extra_chunks_of_overwritten_value(self):
+        dscache.set('key', self.value)
+        dscache.set('key', self.value[:1024 * 1024])
+        self.assertEqual(1, Vacuum().sweep_chunks()[0])
+        self.assertEqual(2, self._chunk_count())
+        self.assertEqual(self.value[:1024 * 1024], dscache.get('key'))
+
+    def test_sweep_spares_recent_chunks(self):
+        vacuum.CHUNK_GRACE_PERIOD = datetime.timedelta(minutes=10)
+        dscache.set('key', self.value)
+        dscache.delete('key')
+        self.assertEqual(0, Vacuum().sweep_chunks()[0])
+
 class GetTests(DatastoreTests):
 
     def test_unknown_key_returns_none(self):
@@ -286,6 +693,257 @@ class GetMultiTests(DatastoreTests):
         result = client.get_multi(['a', 'b'])
         self.assertEqual({'a': 1, 'b': 2}, result)
 
+    def test_more_than_500_keys_returned(self):
+        mapping = {str(i): i + 1 for i in range(1001)}
+        dscache.set_multi(mapping)
+        result = dscache.get_multi(list(mapping.keys()))
+        self.assertEqual(mapping, result)
+
+    def test_chunks_dispatched_with_concurrency_cap(self):
+        mapping = {str(i): i + 1 for i in range(7)}
+        old_batch_size = dscache.MAX_BATCH_SIZE
+        dscache.MAX_BATCH_SIZE = 2
+        try:
+            self.assertEqual([], dscache.set_multi(mapping, max_concurrency=2))
+            self.assertEqual(mapping, dscache.get_multi(list(mapping.keys()), max_concurrency=2))
+            self.assertEqual(True, dscache.delete_multi(list(mapping.keys()), max_concurrency=2))
+        finally:
+            dscache.MAX_BATCH_SIZE = old_batch_size
+        self.assertEqual({}, dscache.get_multi(list(mapping.keys())))
+
+class GetOrComputeTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+    def compute(self, value='computed'):
+        def fn(*args):
+            self.calls.append(args)
+            return value
+        return fn
+
+    def test_miss_computes_and_stores(self):
+        self.assertEqual('computed', dscache.get_or_compute('key', self.compute()))
+        self.assertEqual('computed', dscache.get('key'))
+        self.assertEqual('computed', dscache.get_or_compute('key', self.compute()))
+        self.assertEqual(1, len(self.calls))
+
+    def test_delete_lock_blocks_refill(self):
+        dscache.set('key', 'old')
+        dscache.delete('key', seconds=60)
+        self.assertEqual('computed', dscache.get_or_compute('key', self.compute()))
+        self.assertEqual(None, dscache.get('key'))
+        dscache.delete_multi(['a', 'b'], seconds=60)
+        dscache.delete('c', seconds=-1)
+        self.assertEqual({'a': 'a', 'c': 'c'},
+                         dscache.get_or_compute_multi(['a', 'c'], lambda keys: {key: key for key in keys}))
+        self.assertEqual({'c': 'c'}, dscache.get_multi(['a', 'c']))
+
+    def test_lease_released(self):
+        dscache.get_or_compute('key', self.compute())
+        self.assertEqual(None, dscache.get(dscache._build_lease_key('key')))
+
+    def test_lease_released_when_fn_fails(self):
+        def fn():
+            raise ValueError()
+        self.assertRaises(ValueError, dscache.get_or_compute, 'key', fn)
+        self.assertEqual(None, dscache.get(dscache._build_lease_key('key')))
+
+    def test_leased_key_serves_stale_value(self):
+        dscache.set('key', 'stale', time=-1)
+        dscache.add(dscache._build_lease_key('key'), True)
+        self.assertEqual('stale', dscache.get_or_compute('key', self.compute()))
+        self.assertEqual([], self.calls)
+
+    def test_leased_key_waits_for_holder(self):
+        dscache.add(dscache._build_lease_key('key'), True)
+        @ndb.tasklet
+        def holder():
+            yield ndb.sleep(0.2)
+            yield dscache.set_async('key', 'from holder')
+        future = dscache.get_or_compute_async('key', self.compute(), wait=5)
+        holder().get_result()
+        self.assertEqual('from holder', future.get_result())
+        self.assertEqual([], self.calls)
+
+    def test_leased_key_computes_after_wait(self):
+        dscache.add(dscache._build_lease_key('key'), True)
+        self.assertEqual('computed', dscache.get_or_compute('key', self.compute(), wait=0))
+        self.assertEqual(1, len(self.calls))
+
+    def test_expired_lease_is_taken(self):
+        dscache.add(dscache._build_lease_key('key'), True, time=-1)
+        self.assertEqual('computed', dscache.get_or_compute('key', self.compute(), wait=0))
+
+    def test_fn_returning_future(self):
+        @ndb.tasklet
+        def fn():
+            raise ndb.Return('async')
+        self.assertEqual('async', dscache.get_or_compute('key', fn))
+
+    def test_client(self):
+        self.assertEqual('computed', dscache.Client().get_or_compute('key', self.compute(), time=60))
+        self.assertEqual('computed', dscache.get('key'))
+
+    def set_compute_seconds(self, key, seconds):
+        entity = dscache.build_ds_key(key).get()
+        entity.compute_seconds = seconds
+        entity.put()
+        ndb.get_context().clear_cache()
+
+    def test_compute_seconds_recorded(self):
+        dscache.get_or_compute('key', self.compute(), time=60)
+        self.assertTrue(dscache.build_ds_key('key').get().compute_seconds >= 0)
+
+    def test_refresh_ahead_near_timeout(self):
+        dscache.get_or_compute('key', self.compute('old'), time=60)
+        self.set_compute_seconds('key', 10 ** 6)
+        self.assertEqual('old', dscache.get_or_compute('key', self.compute('new'), time=60, refresh_ahead=1))
+        eventloop.run()
+        self.assertEqual(2, len(self.calls))
+        self.assertEqual('new', dscache.get('key'))
+        self.assertEqual(None, dscache.get(dscache._build_lease_key('key')))
+
+    def test_refresh_ahead_does_not_block(self):
+        dscache.get_or_compute('key', self.compute('old'), time=60)
+        self.set_compute_seconds('key', 10 ** 6)
+        value = ndb.Future()
+        self.assertEqual('old', dscache.get_or_compute('key', lambda: value, time=60, refresh_ahead=1))
+        value.set_result('new')
+        eventloop.run()
+        self.assertEqual('new', dscache.get('key'))
+
+    def test_no_refresh_far_from_timeout(self):
+        dscache.get_or_compute('key', self.compute('old'), time=3600)
+        self.set_compute_seconds('key', 0.001)
+        self.assertEqual('old', dscache.get_or_compute('key', self.compute('new'), time=3600, refresh_ahead=1))
+        self.assertEqual('old', dscache.get('key'))
+
+    def test_no_refresh_by_default(self):
+        dscache.get_or_compute('key', self.compute('old'), time=60)
+        self.set_compute_seconds('key', 10 ** 6)
+        dscache.get_or_compute('key', self.compute('new'), time=60)
+        self.assertEqual('old', dscache.get('key'))
+
+    def test_refresh_skipped_while_leased(self):
+        dscache.get_or_compute('key', self.compute('old'), time=60)
+        self.set_compute_seconds('key', 10 ** 6)
+        dscache.add(dscache._build_lease_key('key'), True)
+        self.assertEqual('old', dscache.get_or_compute('key', self.compute('new'), time=60, refresh_ahead=1))
+        self.assertEqual('old', dscache.get('key'))
+        self.assertEqual(1, len(self.calls))
+
+    def test_failed_refresh_keeps_value(self):
+        dscache.get_or_compute('key', self.compute('old'), time=60)
+        self.set_compute_seconds('key', 10 ** 6)
+        def fn():
+            raise ValueError()
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual('old', dscache.get_or_compute('key', fn, time=60, refresh_ahead=1))
+            eventloop.run()
+        self.assertEqual('old', dscache.get('key'))
+        # the lease is kept, so that later hits do not each retry the refresh
+        self.assertEqual(True, dscache.get(dscache._build_lease_key('key')))
+        self.assertEqual('old', dscache.get_or_compute('key', fn, time=60, refresh_ahead=1))
+
+    def test_revalidate_fresh_value(self):
+        self.assertEqual(('computed', False), dscache.get_or_revalidate('key', self.compute(), time=60))
+        self.assertEqual(('computed', False), dscache.get_or_revalidate('key', self.compute(), time=60))
+        self.assertEqual(1, len(self.calls))
+
+    def test_stale_value_served_while_revalidating(self):
+        dscache.set('key', 'old', time=-1)
+        self.assertEqual(('old', True), dscache.get_or_revalidate('key', self.compute('new'), time=60, stale_ttl=60))
+        eventloop.run()
+        self.assertEqual('new', dscache.get('key'))
+        self.assertEqual(None, dscache.get(dscache._build_lease_key('key')))
+
+    def test_revalidation_does_not_block(self):
+        dscache.set('key', 'old', time=-1)
+        value = ndb.Future()
+        self.assertEqual(('old', True), dscache.get_or_revalidate('key', lambda: value, time=60, stale_ttl=60))
+        value.set_result('new')
+        eventloop.run()
+        self.assertEqual('new', dscache.get('key'))
+
+    def test_failed_revalidation_keeps_lease(self):
+        dscache.set('key', 'old', time=-1)
+        def fn():
+            raise ValueError()
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(('old', True), dscache.get_or_revalidate('key', fn, time=60, stale_ttl=60))
+            eventloop.run()
+        self.assertEqual(True, dscache.get(dscache._build_lease_key('key')))
+        refreshes = []
+        self.assertEqual(('old', True), dscache.get_or_revalidate_async('key', fn, time=60, stale_ttl=60,
+                                                                         refreshes=refreshes).get_result())
+        self.assertEqual([None], [refresh.get_result() for refresh in refreshes])
+
+    def test_single_revalidation(self):
+        dscache.set('key', 'old', time=-1)
+        refreshes = []
+        futures = [dscache.get_or_revalidate_async('key', self.compute('new'), time=60, stale_ttl=60,
+                                                   refreshes=refreshes)
+                   for i in range(3)]
+        self.assertEqual([('old', True)] * 3, [future.get_result() for future in futures])
+        self.assertEqual(['new'], [refresh.get_result() for refresh in refreshes if refresh.get_result()])
+        self.assertEqual(1, len(self.calls))
+
+    def test_value_past_stale_ttl_not_served(self):
+        dscache.set('key', 'old', time=-3600)
+        self.assertEqual(('new', False), dscache.get_or_revalidate('key', self.compute('new'), time=60, stale_ttl=60))
+
+    def test_stale_if_error(self):
+        dscache.set('key', 'old', time=-1)
+        def fn():
+            raise ValueError()
+        self.assertEqual(('old', True), dscache.get_or_revalidate('key', fn, stale_if_error=True))
+        self.assertEqual('old', dscache.get_or_compute('key', fn, stale_if_error=True))
+        self.assertEqual(None, dscache.get(dscache._build_lease_key('key')))
+
+    def test_stale_if_error_without_value_raises(self):
+        def fn():
+            raise ValueError()
+        self.assertRaises(ValueError, dscache.get_or_revalidate, 'key', fn, stale_if_error=True)
+
+    def test_stale_if_error_respects_stale_ttl(self):
+        dscache.set('key', 'old', time=-3600)
+        def fn():
+            raise ValueError()
+        self.assertRaises(ValueError, dscache.get_or_compute, 'key', fn, stale_ttl=60, stale_if_error=True)
+
+    def test_client_revalidate(self):
+        dscache.set('key', 'old', time=-1)
+        self.assertEqual(('old', True), dscache.Client().get_or_revalidate('key', self.compute(), stale_ttl=60))
+
+    def test_multi_computes_missing_keys(self):
+        dscache.set('a', 'cached')
+        def fn(keys):
+            self.calls.append(keys)
+            return {key: key * 2 for key in keys}
+        self.assertEqual({'a': 'cached', 'b': 'bb', 'c': 'cc'}, dscache.get_or_compute_multi(['a', 'b', 'c'], fn))
+        self.assertEqual([['b', 'c']], self.calls)
+        self.assertEqual({'b': 'bb', 'c': 'cc'}, dscache.get_multi(['b', 'c']))
+        self.assertEqual({}, dscache.get_multi([dscache._build_lease_key('b'), dscache._build_lease_key('c')]))
+
+    def test_multi_falsy_values_are_hits(self):
+        dscache.set_multi({'a': 0, 'b': '', 'c': [], 'd': False})
+        def fn(keys):
+            self.calls.append(keys)
+            return {key: 'computed' for key in keys}
+        self.assertEqual({'a': 0, 'b': '', 'c': [], 'd': False}, dscache.get_or_compute_multi(['a', 'b', 'c', 'd'], fn))
+        self.assertEqual([], self.calls)
+
+    def test_multi_leased_key_serves_stale_value(self):
+        dscache.set('a', 'stale', time=-1)
+        dscache.add(dscache._build_lease_key('a'), True)
+        def fn(keys):
+            self.calls.append(keys)
+            return {key: 'computed' for key in keys}
+        self.assertEqual({'a': 'stale', 'b': 'computed'}, dscache.get_or_compute_multi(['a', 'b'], fn, wait=0))
+        self.assertEqual([['b']], self.calls)
+
 class DeleteTests(DatastoreTests):
 
     def test_item_deleted(self):
@@ -310,6 +968,30 @@ class DeleteTests(DatastoreTests):
         self.assertEqual(True, ret_val)
         self.assertEqual(None, client.get('a'))
 
+    def test_delete_lock_blocks_add(self):
+        dscache.set('a', 1)
+        self.assertEqual(True, dscache.delete('a', seconds=60))
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual(False, dscache.add('a', 2))
+        self.assertEqual(False, dscache.replace('a', 2))
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_delete_lock_allows_set(self):
+        dscache.delete('a', seconds=60)
+        self.assertEqual(True, dscache.set('a', 2))
+        self.assertEqual(2, dscache.get('a'))
+
+    def test_delete_lock_expires(self):
+        dscache.set('a', 1)
+        dscache.delete('a', seconds=-1)
+        self.assertEqual(True, dscache.add('a', 2))
+        self.assertEqual(2, dscache.get('a'))
+
+    def test_delete_lock_tombstone_vacuumed(self):
+        dscache.delete('a', seconds=-1)
+        self.assertEqual(1, Vacuum().run()[0])
+        self.assertEqual(0, _DSCache.query().count())
+
 class DeleteMultiTests(DatastoreTests):
 
     def test_single_item_deleted(self):
@@ -350,6 +1032,20 @@ class DeleteMultiTests(DatastoreTests):
         self.assertEqual(True, ret_val)
         self.assertEqual({'c': 3, 'd': 4}, dscache.get_multi(['c', 'd'], namespace='2'))
 
+    def test_more_than_500_items_deleted(self):
+        keys = [str(i) for i in range(1001)]
+        dscache.set_multi({key: 1 for key in keys})
+        ret_val = dscache.delete_multi(keys)
+        self.assertEqual(True, ret_val)
+        self.assertEqual({}, dscache.get_multi(keys))
+
+    def test_delete_lock(self):
+        dscache.set_multi({'a': 1, 'b': 2})
+        self.assertEqual(True, dscache.delete_multi(['a', 'b'], seconds=60))
+        self.assertEqual({}, dscache.get_multi(['a', 'b']))
+        self.assertEqual(['a', 'b'], sorted(dscache.add_multi({'a': 3, 'b': 4})))
+        self.assertEqual(['a'], dscache.replace_multi({'a': 3}))
+
     def test_multiple_items_deleted_Client(self):
         client = dscache.Client()
         client.set('a', 1)
@@ -398,29 +1094,598 @@ class AddTests(DatastoreTests):
         self.assertEqual(False, ret_val)
         self.assertEqual(1, client.get('a')) # yes, this is 1
 
+class LocalCacheTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.local_cache = dscache.enable_local_cache(max_items=3)
+
+    def tearDown(self):
+        dscache.disable_local_cache()
+        super().tearDown()
+
+    def test_get_served_from_local_cache(self):
+        dscache.set('a', 1)
+        dscache.build_ds_key('a').delete() # bypass dscache so only the local cache has the value
+        self.assertEqual(1, dscache.get('a'))
+        self.assertEqual(1, self.local_cache.hits)
+
+    def test_get_multi_served_from_local_cache(self):
+        dscache.set_multi({'a': 1, 'b': 2})
+        dscache.build_ds_key('a').delete()
+        dscache.set('c', 3)
+        result = dscache.get_multi(['a', 'b', 'c', 'x'])
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, result)
+        self.assertEqual(3, self.local_cache.hits)
+        self.assertEqual(1, self.local_cache.misses)
+
+    def test_miss_populates_local_cache(self):
+        dscache.set('a', 1)
+        self.local_cache.clear()
+        self.assertEqual(1, dscache.get('a'))
+        self.assertEqual(1, dscache.get('a'))
+        self.assertEqual(1, self.local_cache.misses)
+        self.assertEqual(1, self.local_cache.hits)
+
+    def test_expired_entity_not_served(self):
+        dscache.set('a', 1, time=-1)
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual(0, self.local_cache.hits)
+
+    def test_max_age_respected(self):
+        self.local_cache.max_age = -1
+        dscache.set('a', 1)
+        dscache.build_ds_key('a').delete()
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_delete_writes_through(self):
+        dscache.set('a', 1)
+        dscache.delete('a')
+        self.assertEqual(None, dscache.get('a'))
+        dscache.set_multi({'b': 1, 'c': 2})
+        dscache.delete_multi(['b', 'c'])
+        self.assertEqual({}, dscache.get_multi(['b', 'c']))
+
+    def test_add_writes_through(self):
+        dscache.add('a', 1)
+        dscache.build_ds_key('a').delete()
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_least_recently_used_evicted(self):
+        dscache.set_multi({'a': 1, 'b': 2, 'c': 3})
+        dscache.get('a')
+        dscache.set('d', 4)
+        self.assertEqual(3, len(self.local_cache))
+        self.assertEqual(None, self.local_cache.get(dscache.build_ds_key('b')))
+        self.assertNotEqual(None, self.local_cache.get(dscache.build_ds_key('a')))
+        self.assertEqual(1, self.local_cache.get_stats()['evictions'])
+
+    def test_max_bytes_respected(self):
+        self.local_cache.max_bytes = 2000
+        dscache.set('a', '*'*1024)
+        dscache.set('b', '*'*1024)
+        self.assertEqual(1, len(self.local_cache))
+        self.assertTrue(self.local_cache.bytes <= 2000)
+
+    def test_misses_not_remembered_by_default(self):
+        self.assertEqual(None, dscache.get('a'))
+        _DSCache(key=dscache.build_ds_key('a'), int_val=1, value_type='int').put()
+        self.assertEqual(1, dscache.get('a'))
+
+class NegativeCacheTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.local_cache = dscache.enable_local_cache(negative_ttl=60, max_negative_items=2)
+
+    def tearDown(self):
+        dscache.disable_local_cache()
+        super().tearDown()
+
+    def put_behind_cache(self, key, value):
+        """ Writes an entry as another instance would, bypassing this instance's local cache. """
+        _DSCache(key=dscache.build_ds_key(key), int_val=value, value_type='int').put()
+        ndb.get_context().clear_cache()
+
+    def test_miss_remembered(self):
+        self.assertEqual(None, dscache.get('a'))
+        self.put_behind_cache('a', 1)
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual({}, dscache.get_multi(['a']))
+        self.assertEqual(2, self.local_cache.get_stats()['negative_hits'])
+
+    def test_get_multi_remembers_misses(self):
+        dscache.set('a', 1)
+        self.assertEqual({'a': 1}, dscache.get_multi(['a', 'b']))
+        self.put_behind_cache('b', 2)
+        self.assertEqual({'a': 1}, dscache.get_multi(['a', 'b']))
+        self.assertEqual(1, self.local_cache.get_stats()['negative_items'])
+
+    def test_local_writes_forget_misses(self):
+        for key in ['a', 'b', 'c', 'd']:
+            dscache.get(key)
+        dscache.set('a', 1)
+        dscache.add('b', 2)
+        dscache.incr('c', initial_value=3)
+        dscache.set_multi({'d': 4})
+        self.assertEqual({'a': 1, 'b': 2, 'c': 4, 'd': 4}, dscache.get_multi(['a', 'b', 'c', 'd']))
+
+    def test_miss_expires(self):
+        dscache.get('a')
+        self.local_cache.negative_ttl = -1
+        dscache.get('b')
+        self.put_behind_cache('b', 2)
+        self.assertEqual(2, dscache.get('b'))
+
+    def test_bounded_separately(self):
+        dscache.set_multi({'x': 1, 'y': 2})
+        dscache.get_multi(['a', 'b', 'c'])
+        stats = self.local_cache.get_stats()
+        self.assertEqual(2, stats['negative_items'])
+        self.assertEqual(2, stats['items'])
+        self.put_behind_cache('a', 1)
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_failed_lookup_not_remembered(self):
+        self.assertEqual({}, dscache.get_multi(['a'], bad_option=True))
+        self.put_behind_cache('a', 1)
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_without_batching(self):
+        dscache.AUTO_BATCH_GETS = False
+        try:
+            dscache.get_multi(['a'])
+            self.put_behind_cache('a', 1)
+            self.assertEqual(None, dscache.get('a'))
+        finally:
+            dscache.AUTO_BATCH_GETS = True
+
+class AsyncTests(DatastoreTests):
+
+    def test_set_and_get_async(self):
+        future = dscache.set_async('a', 1)
+        self.assertEqual(True, future.get_result())
+        self.assertEqual(1, dscache.get_async('a').get_result())
+
+    def test_get_async_unknown_key_returns_none(self):
+        self.assertEqual(None, dscache.get_async('unknown').get_result())
+
+    def test_multi_async_operations_overlap(self):
+        futures = [dscache.set_multi_async({'a': 1, 'b': 2}), dscache.set_async('c', 3)]
+        self.assertEqual([[], True], [f.get_result() for f in futures])
+        result = dscache.get_multi_async(['a', 'b', 'c']).get_result()
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, result)
+
+    def test_delete_async(self):
+        dscache.set_multi({'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(True, dscache.delete_async('a').get_result())
+        self.assertEqual(True, dscache.delete_multi_async(['b', 'c']).get_result())
+        self.assertEqual({}, dscache.get_multi(['a', 'b', 'c']))
+
+    def test_add_async(self):
+        self.assertEqual(True, dscache.add_async('a', 1).get_result())
+        self.assertEqual(False, dscache.add_async('a', 2).get_result())
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_async_Client(self):
+        client = dscache.Client()
+        self.assertEqual(True, client.set_async('a', 1).get_result())
+        self.assertEqual(1, client.get_async('a').get_result())
+        self.assertEqual(True, client.add_async('b', 2).get_result())
+        self.assertEqual([], client.set_multi_async({'c': 3}).get_result())
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, client.get_multi_async(['a', 'b', 'c']).get_result())
+        self.assertEqual(True, client.delete_async('a').get_result())
+        self.assertEqual(True, client.delete_multi_async(['b', 'c']).get_result())
+        self.assertEqual({}, client.get_multi(['a', 'b', 'c']))
+
+class GetBatchingTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count', lambda service, call, request, response: self.calls.append(call), 'datastore_v3')
+        dscache.set_multi({'a': 1, 'b': 0, 'c': 'c'})
+        dscache.set('n', 'in namespace', namespace='ns')
+        ndb.get_context().clear_cache()
+        del self.calls[:]
+
+    def tearDown(self):
+        dscache.GET_BATCH_WINDOW = 0
+        dscache.AUTO_BATCH_GETS = True
+        super().tearDown()
+
+    def test_concurrent_gets_are_batched(self):
+        futures = [dscache.get_async(key) for key in ['a', 'b', 'c', 'a', 'unknown']]
+        futures.append(dscache.get_async('n', namespace='ns'))
+        self.assertEqual([1, 0, 'c', 1, None, 'in namespace'], [future.get_result() for future in futures])
+        self.assertEqual(['Get'], self.calls)
+
+    def test_sequential_gets(self):
+        self.assertEqual(1, dscache.get('a'))
+        self.assertEqual(0, dscache.get('b'))
+        self.assertEqual(None, dscache.get('unknown'))
+        self.assertEqual({'hits': 2, 'misses': 1}, {name: dscache.get_stats()[name] for name in ('hits', 'misses')})
+
+    def test_bad_key_fails_only_its_lookup(self):
+        futures = [dscache.get_async('a'), dscache.get_async('')]
+        self.assertEqual(1, futures[0].get_result())
+        self.assertRaises(ValueError, futures[1].get_result)
+
+    def test_bad_value_fails_only_its_lookup(self):
+        _DSCache(key=dscache.build_ds_key('bad'), value_type='unregistered', blob_val=b'x').put()
+        ndb.get_context().clear_cache()
+        bad = dscache.get_async('bad')
+        good = dscache.get_async('a')
+        self.assertEqual(1, good.get_result())
+        self.assertRaises(ValueError, bad.get_result)
+
+    def test_batch_window(self):
+        @ndb.tasklet
+        def get_later(key, delay):
+            yield ndb.sleep(delay)
+            value = yield dscache.get_async(key)
+            raise ndb.Return(value)
+
+        dscache.GET_BATCH_WINDOW = 0.1
+        futures = [get_later('a', 0), get_later('c', 0.01)]
+        self.assertEqual([1, 'c'], [future.get_result() for future in futures])
+        self.assertEqual(['Get'], self.calls)
+
+    def test_disabled(self):
+        dscache.AUTO_BATCH_GETS = False
+        futures = [dscache.get_async('a'), dscache.get_async('b')]
+        self.assertEqual([1, 0], [future.get_result() for future in futures])
+
 class AddMultiTests(DatastoreTests):
-    pass
+
+    def test_new_items_added(self):
+        result = dscache.add_multi({'a': 1, 'b': 2})
+        self.assertEqual([], result)
+        self.assertEqual({'a': 1, 'b': 2}, dscache.get_multi(['a', 'b']))
+
+    def test_existing_items_not_overwritten(self):
+        dscache.set('a', 1)
+        result = dscache.add_multi({'a': 2, 'b': 3})
+        self.assertEqual(['a'], result)
+        self.assertEqual({'a': 1, 'b': 3}, dscache.get_multi(['a', 'b']))
+
+    def test_expired_items_replaced(self):
+        dscache.set('a', 1, time=-1)
+        result = dscache.add_multi({'a': 2})
+        self.assertEqual([], result)
+        self.assertEqual(2, dscache.get('a'))
+
+    def test_key_prefix_and_namespace(self):
+        dscache.set('a', 1, namespace='1')
+        result = dscache.add_multi({'a': 2}, key_prefix='x', namespace='1')
+        self.assertEqual([], result)
+        self.assertEqual({'a': 2}, dscache.get_multi(['a'], key_prefix='x', namespace='1'))
+        self.assertEqual(1, dscache.get('a', namespace='1'))
+
+    def test_more_than_500_items_added(self):
+        dscache.set('0', 'existing')
+        mapping = {str(i): i + 1 for i in range(501)}
+        result = dscache.add_multi(mapping, max_concurrency=50)
+        self.assertEqual(['0'], result)
+        self.assertEqual(501, dscache.get('500'))
+
+    def test_existing_items_not_overwritten_Client(self):
+        client = dscache.Client()
+        client.set('a', 1)
+        result = client.add_multi({'a': 2, 'b': 3})
+        self.assertEqual(['a'], result)
+        self.assertEqual(['b'], client.add_multi_async({'b': 4, 'c': 5}).get_result())
 
 class ReplaceTests(DatastoreTests):
-    pass
+
+    def test_item_replaced(self):
+        dscache.set('a', 1)
+        self.assertEqual(True, dscache.replace('a', 2))
+        self.assertEqual(2, dscache.get('a'))
+
+    def test_unknown_item_not_replaced(self):
+        self.assertEqual(False, dscache.replace('a', 2))
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_expired_item_not_replaced(self):
+        dscache.set('a', 1, time=-1)
+        self.assertEqual(False, dscache.replace('a', 2))
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_item_replaced_Client(self):
+        client = dscache.Client()
+        client.set('a', 1)
+        self.assertEqual(True, client.replace('a', 2))
+        self.assertEqual(2, client.get('a'))
 
 class ReplaceMultiTests(DatastoreTests):
-    pass
+
+    def test_present_items_replaced(self):
+        dscache.set_multi({'a': 1, 'b': 1})
+        self.assertEqual(['c'], dscache.replace_multi({'a': 2, 'c': 2}))
+        self.assertEqual({'a': 2, 'b': 1}, dscache.get_multi(['a', 'b', 'c']))
+
+    def test_key_prefix_replace(self):
+        dscache.set_multi({'a': 1}, key_prefix='x')
+        self.assertEqual([], dscache.replace_multi({'a': 2}, key_prefix='x'))
+        self.assertEqual({'a': 2}, dscache.get_multi(['a'], key_prefix='x'))
 
 class IncrTests(DatastoreTests):
-    pass
+
+    def test_existing_value_incremented(self):
+        dscache.set('a', 1)
+        self.assertEqual(2, dscache.incr('a'))
+        self.assertEqual(7, dscache.incr('a', delta=5))
+        self.assertEqual(7, dscache.get('a'))
+
+    def test_missing_key_not_set(self):
+        self.assertEqual(None, dscache.incr('a'))
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_initial_value_used_for_missing_key(self):
+        self.assertEqual(11, dscache.incr('a', initial_value=10))
+        self.assertEqual(12, dscache.incr('a', initial_value=10))
+
+    def test_expired_key_treated_as_missing(self):
+        dscache.set('a', 5, time=-1)
+        self.assertEqual(None, dscache.incr('a'))
+        self.assertEqual(1, dscache.incr('a', initial_value=0))
+
+    def test_non_integer_value_returns_none(self):
+        dscache.set('a', 'abc')
+        self.assertEqual(None, dscache.incr('a'))
+        self.assertEqual('abc', dscache.get('a'))
+
+    def test_64_bit_wraparound(self):
+        self.assertEqual(2**64 - 1, dscache.incr('a', delta=2**64 - 2, initial_value=1))
+        self.assertEqual(1, dscache.incr('a', delta=2))
+
+    def test_negative_delta_rejected(self):
+        self.assertRaises(ValueError, dscache.incr, 'a', delta=-1)
+
+    def test_namespace_partitions(self):
+        dscache.set('a', 1, namespace='1')
+        self.assertEqual(None, dscache.incr('a', namespace='2'))
+        self.assertEqual(2, dscache.incr('a', namespace='1'))
+
+    def test_value_incremented_Client(self):
+        client = dscache.Client()
+        client.set('a', 1)
+        self.assertEqual(2, client.incr('a'))
+        self.assertEqual(3, client.incr_async('a').get_result())
 
 class DecrTests(DatastoreTests):
-    pass
+
+    def test_existing_value_decremented(self):
+        dscache.set('a', 10)
+        self.assertEqual(9, dscache.decr('a'))
+        self.assertEqual(4, dscache.decr('a', delta=5))
+        self.assertEqual(4, dscache.get('a'))
+
+    def test_missing_key_not_set(self):
+        self.assertEqual(None, dscache.decr('a'))
+
+    def test_initial_value_used_for_missing_key(self):
+        self.assertEqual(9, dscache.decr('a', initial_value=10))
+
+    def test_decrement_stops_at_zero(self):
+        dscache.set('a', 2)
+        self.assertEqual(0, dscache.decr('a', delta=5))
+
+    def test_value_decremented_Client(self):
+        client = dscache.Client()
+        client.set('a', 2)
+        self.assertEqual(1, client.decr('a'))
 
 class OffsetMultiTests(DatastoreTests):
-    pass
+
+    def test_offsets_applied(self):
+        dscache.set_multi({'a': 1, 'b': 10})
+        result = dscache.offset_multi({'a': 2, 'b': -3})
+        self.assertEqual({'a': 3, 'b': 7}, result)
+        self.assertEqual({'a': 3, 'b': 7}, dscache.get_multi(['a', 'b']))
+
+    def test_missing_and_non_integer_keys_return_none(self):
+        dscache.set_multi({'a': 1, 'b': 'x'})
+        result = dscache.offset_multi({'a': 1, 'b': 1, 'c': 1})
+        self.assertEqual({'a': 2, 'b': None, 'c': None}, result)
+
+    def test_initial_value_and_key_prefix(self):
+        result = dscache.offset_multi({'a': 1, 'b': 2}, key_prefix='x', initial_value=5)
+        self.assertEqual({'a': 6, 'b': 7}, result)
+        self.assertEqual({'a': 6, 'b': 7}, dscache.get_multi(['a', 'b'], key_prefix='x'))
+
+    def test_offsets_applied_Client(self):
+        client = dscache.Client()
+        self.assertEqual({'a': 1}, client.offset_multi({'a': 1}, initial_value=0))
+
+class ShardedCounterTests(DatastoreTests):
+
+    def test_unknown_counter_is_zero(self):
+        self.assertEqual(0, dscache.get_sharded('hits'))
+
+    def test_increments_summed_across_shards(self):
+        for _ in range(20):
+            self.assertEqual(True, dscache.incr_sharded('hits', shards=4))
+        dscache.incr_sharded('hits', delta=-5, shards=4)
+        self.assertEqual(15, dscache.get_sharded('hits', shards=4))
+
+    def test_namespace_partitions(self):
+        dscache.incr_sharded('hits', delta=3, namespace='1')
+        self.assertEqual(0, dscache.get_sharded('hits', namespace='2'))
+        self.assertEqual(3, dscache.get_sharded('hits', namespace='1'))
 
 class FlushAllTests(DatastoreTests):
-    pass
+
+    def test_everything_flushed(self):
+        dscache.set('a', 1)
+        dscache.set('b', 2, namespace='1')
+        self.assertEqual(True, dscache.flush_all())
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual(None, dscache.get('b', namespace='1'))
+
+    def test_writes_after_flush_visible(self):
+        dscache.set('a', 1)
+        dscache.flush_all()
+        dscache.set('a', 2)
+        self.assertEqual(2, dscache.get('a'))
+        dscache.flush_all()
+        self.assertEqual(True, dscache.add('a', 3))
+        self.assertEqual({'a': 3}, dscache.get_multi(['a']))
+
+    def test_namespace_flush_only_affects_namespace(self):
+        dscache.set('a', 1, namespace='1')
+        dscache.set('a', 2, namespace='2')
+        dscache.set('a', 3)
+        self.assertEqual(True, dscache.flush_all(namespace='1'))
+        self.assertEqual(None, dscache.get('a', namespace='1'))
+        self.assertEqual(2, dscache.get('a', namespace='2'))
+        self.assertEqual(3, dscache.get('a'))
+
+    def test_flush_seen_after_generation_cache_expires(self):
+        dscache.set('a', 1)
+        dscache.get('a')
+        # simulate another instance flushing, then this instance's cached generation going stale
+        dscache.flush_all()
+        dscache._generations.clear()
+        self.assertEqual(None, dscache.get('a'))
+
+    def test_counters_read_generation_outside_transactions(self):
+        cache_seconds = dscache.GENERATION_CACHE_SECONDS
+        dscache.GENERATION_CACHE_SECONDS = 0
+        try:
+            dscache.flush_all(namespace='1')
+            ndb.get_context().clear_cache()
+            with self.assertNoLogs(level='ERROR'):
+                self.assertEqual(2, dscache.incr('a', initial_value=1, namespace='1'))
+                self.assertEqual(True, dscache.incr_sharded('b', namespace='1'))
+            self.assertEqual(1, dscache.get_sharded('b', namespace='1'))
+        finally:
+            dscache.GENERATION_CACHE_SECONDS = cache_seconds
+
+    def test_unreadable_generation_fails_operations(self):
+        dscache.set('a', 'old')
+        dscache.flush_all()
+        dscache.set('a', 'new')
+        # a fresh instance, which cannot read the generation
+        dscache._generations.clear()
+        ndb.get_context().clear_cache()
+        failing = [True]
+        def fail_generation_gets(service, call, request, response):
+            if failing[0] and call == 'Get' and b'_DSCacheGeneration' in request.SerializeToString():
+                raise ValueError()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('fail', fail_generation_gets, 'datastore_v3')
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual({}, dscache.get_multi(['a']))
+        self.assertEqual(False, dscache.set('a', 'lost'))
+        self.assertEqual(None, dscache.incr('c', initial_value=1))
+        self.assertEqual('computed', dscache.get_or_compute('a', lambda: 'computed'))
+        self.assertEqual(None, dscache.Client(tiered=True).get('a'))
+        failing[0] = False
+        self.assertEqual('new', dscache.get('a'))
+
+    def test_flush_clears_local_cache(self):
+        dscache.enable_local_cache()
+        try:
+            dscache.set('a', 1)
+            dscache.flush_all()
+            self.assertEqual(0, len(dscache.get_local_cache()))
+            self.assertEqual(None, dscache.get('a'))
+        finally:
+            dscache.disable_local_cache()
+
+    def test_vacuum_sweeps_flushed_entries(self):
+        dscache.set('persist', 1)
+        dscache.set('x' * dscache.MAX_KEY_SIZE, 2)
+        dscache.set('a', 3, namespace='1')
+        dscache.incr('counter', initial_value=0)
+        dscache.flush_all()
+        dscache.set('persist', 4)
+        self.assertEqual((4, None, False), Vacuum().sweep_generations())
+        self.assertEqual(1, len(_DSCache.query().fetch(10, keys_only=True)))
+        self.assertEqual(4, dscache.get('persist'))
+
+    def test_vacuum_sweeps_flushed_namespace(self):
+        dscache.set('a', 1, namespace='1')
+        dscache.set('a', 2, namespace='11')
+        dscache.set('a', 3)
+        dscache.flush_all(namespace='1')
+        dscache.set('b', 4, namespace='1')
+        self.assertEqual(1, Vacuum().sweep_generations()[0])
+        self.assertEqual(2, dscache.get('a', namespace='11'))
+        self.assertEqual(3, dscache.get('a'))
+        self.assertEqual(4, dscache.get('b', namespace='1'))
+        self.assertEqual(0, Vacuum().sweep_generations()[0])
+
+    def test_vacuum_sweep_wsgi(self):
+        dscache.set('a', 1)
+        dscache.flush_all()
+        body = Vacuum()({'QUERY_STRING': 'sweep=generations'}, lambda status, headers: None)
+        self.assertEqual({'deleted': 1, 'cursor': None, 'more': False}, json.loads(b''.join(body)))
+
+    def test_everything_flushed_Client(self):
+        client = dscache.Client()
+        client.set('a', 1)
+        self.assertEqual(True, client.flush_all())
+        self.assertEqual(None, client.get('a'))
 
 class StatsTests(DatastoreTests):
-    pass
+
+    def test_memcache_keys_present(self):
+        stats = dscache.get_stats()
+        for name in ['hits', 'misses', 'byte_hits', 'items', 'bytes', 'oldest_item_age']:
+            self.assertTrue(name in stats, name)
+
+    def test_hits_and_misses_counted(self):
+        dscache.set('a', 'abc')
+        dscache.get('a')
+        dscache.get('x')
+        dscache.get_multi(['a', 'y', 'z'])
+        stats = dscache.get_stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+        self.assertEqual(6, stats['byte_hits'])
+
+    def test_writes_counted(self):
+        dscache.set('a', 'abc')
+        dscache.set_multi({'b': 'de', 'c': 1})
+        dscache.add('d', 'f')
+        dscache.add('d', 'g')
+        stats = dscache.get_stats()
+        self.assertEqual(4, stats['items'])
+        self.assertEqual(6, stats['bytes'])
+
+    def test_expired_counted(self):
+        dscache.set('a', 1, time=-1)
+        dscache.get('a')
+        dscache.get_multi(['a'])
+        stats = dscache.get_stats()
+        self.assertEqual(2, stats['expired'])
+        self.assertEqual(2, stats['misses'])
+
+    def test_latency_percentiles_recorded(self):
+        for _ in range(10):
+            dscache.get('a')
+        dscache.set_async('a', 1).get_result()
+        latency = dscache.get_stats()['latency']
+        self.assertEqual(10, latency['get']['count'])
+        self.assertEqual(1, latency['set']['count'])
+        self.assertTrue(latency['get']['p50'] <= latency['get']['p99'])
+
+    def test_errors_counted(self):
+        self.assertEqual(False, dscache.set('a', 1, bad_option=True))
+        self.assertEqual({'set': 1}, dscache.get_stats()['errors'])
+
+    def test_client_operations_counted(self):
+        client = dscache.Client()
+        client.set('a', 1)
+        client.gets('a')
+        client.cas('a', 2)
+        stats = client.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['latency']['gets']['count'])
+        self.assertEqual(1, stats['latency']['cas']['count'])
 
 class CasTests(DatastoreTests):
 
@@ -525,3 +1790,579 @@ class CasTests(DatastoreTests):
         self.assertFalse(result)
         value = self.client.gets('never-heard-of-you')
         self.assertEqual(value, None) # nothing was inserted into dscache
+
+    def test_gets_multi_returns_present_keys(self):
+        dscache.set_multi({'k1': 'v1', 'k2': 'v2'})
+        self.assertEqual({'k1': 'v1', 'k2': 'v2'}, self.client.gets_multi(['k1', 'k2', 'k3']))
+
+    def test_cas_multi_before_gets_multi(self):
+        dscache.set('k1', 'v1')
+        self.assertEqual(['k1'], self.client.cas_multi({'k1': 'v1cas'}))
+        self.assertEqual('v1', dscache.get('k1'))
+
+    def test_cas_multi_per_key_success(self):
+        dscache.set_multi({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
+        self.client.gets_multi(['k1', 'k2', 'k3'])
+        dscache.set('k2', 'v2a')
+        dscache.delete('k3')
+        self.assertEqual(['k2', 'k3'], sorted(self.client.cas_multi({'k1': 'v1cas', 'k2': 'v2cas', 'k3': 'v3cas'})))
+        self.assertEqual({'k1': 'v1cas', 'k2': 'v2a'}, dscache.get_multi(['k1', 'k2', 'k3']))
+
+    def test_cas_multi_key_prefix(self):
+        dscache.set_multi({'k1': 'v1'}, key_prefix='x')
+        self.client.gets_multi(['k1'], key_prefix='x')
+        self.assertEqual([], self.client.cas_multi({'k1': 'v1cas'}, key_prefix='x'))
+        self.assertEqual({'k1': 'v1cas'}, dscache.get_multi(['k1'], key_prefix='x'))
+
+    def test_gets_multi_then_cas(self):
+        dscache.set('key', 'value')
+        self.client.gets_multi(['key'])
+        self.assertTrue(self.client.cas('key', 'value2'))
+        self.assertEqual('value2', dscache.get('key'))
+
+    def test_cas_increments_version(self):
+        dscache.set('key', 'value')
+        version = dscache.build_ds_key('key').get().version
+        self.client.gets('key')
+        self.assertTrue(self.client.cas('key', 'value2'))
+        self.assertEqual(version + 1, dscache.build_ds_key('key').get().version)
+        self.assertFalse(self.client.cas('key', 'value3'))
+
+    def test_cas_legacy_entity(self):
+        _DSCache(key=dscache.build_ds_key('key'), str_val='value', cas_id=1234.5).put()
+        self.assertEqual('value', self.client.gets('key'))
+        self.assertTrue(self.client.cas('key', 'value2'))
+        self.assertEqual('value2', dscache.get('key'))
+
+    def test_cas_ids_bounded(self):
+        client = dscache.Client(max_cas_ids=2)
+        dscache.set_multi({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
+        client.gets('k1')
+        client.gets_multi(['k2', 'k3'])
+        self.assertFalse(client.cas('k1', 'v1cas'))
+        self.assertTrue(client.cas('k3', 'v3cas'))
+
+class WriteBehindTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.client = dscache.Client(write_behind=True)
+
+    def test_set_is_buffered_until_flush(self):
+        self.assertTrue(self.client.set('key', 'value'))
+        self.assertEqual(None, dscache.get('key'))
+        self.assertTrue(self.client.flush())
+        self.assertEqual('value', dscache.get('key'))
+
+    def test_reads_see_buffered_writes(self):
+        dscache.set_multi({'k1': 'v1', 'k2': 'v2', 'k3': 'v3'})
+        self.client.set('k1', 'new')
+        self.client.delete('k2')
+        self.assertEqual('new', self.client.get('k1'))
+        self.assertEqual(None, self.client.get('k2'))
+        self.assertEqual('new', self.client.get_async('k1').get_result())
+        self.assertEqual({'k1': 'new', 'k3': 'v3'}, self.client.get_multi(['k1', 'k2', 'k3']))
+
+    def test_buffered_falsy_values_match_get_multi(self):
+        self.client.set('w', 0)
+        self.assertEqual({}, self.client.get_multi(['w']))
+        self.client.flush()
+        self.assertEqual({}, self.client.get_multi(['w']))
+
+    def test_reads_see_writes_being_flushed(self):
+        dscache.set_multi({'a': 'old', 'b': 'old'})
+        client = dscache.Client(write_behind=True, max_buffered=2)
+        client.set('a', 'new')
+        client.set('b', 'new')
+        self.assertEqual(0, len(client._buffer))
+        self.assertEqual(['new', 'new'], [client.get('a'), client.get('b')])
+        self.assertEqual({'a': 'new', 'b': 'new'}, client.get_multi(['a', 'b']))
+        self.assertTrue(client.flush())
+        self.assertEqual('new', client.get('a'))
+
+    def test_last_write_per_key_wins(self):
+        self.client.set('key', 'v1')
+        self.client.delete('key')
+        self.client.set_multi({'key': 'v2'})
+        self.client.set_async('key', 'v3').get_result()
+        self.assertEqual(1, len(self.client._buffer))
+        self.client.flush()
+        self.assertEqual('v3', dscache.get('key'))
+
+    def test_buffered_delete(self):
+        dscache.set_multi({'k1': 'v1', 'k2': 'v2'})
+        self.assertTrue(self.client.delete_multi(['k1', 'k2']))
+        self.assertEqual('v1', dscache.get('k1'))
+        self.client.flush()
+        self.assertEqual({}, dscache.get_multi(['k1', 'k2']))
+
+    def test_flush_at_max_buffered(self):
+        client = dscache.Client(write_behind=True, max_buffered=2)
+        client.set('k1', 'v1')
+        client.set('k2', 'v2')
+        self.assertEqual(0, len(client._buffer))
+        client.flush()
+        self.assertEqual({'k1': 'v1', 'k2': 'v2'}, dscache.get_multi(['k1', 'k2']))
+
+    def test_flush_at_interval(self):
+        client = dscache.Client(write_behind=True, flush_interval=0)
+        client.set('key', 'value')
+        self.assertEqual(0, len(client._buffer))
+        client.flush()
+        self.assertEqual('value', dscache.get('key'))
+
+    def test_flush_groups_by_time_and_namespace(self):
+        self.client.set('k1', 'v1', time=-1)
+        self.client.set('k2', 'v2', namespace='ns')
+        self.client.set_multi({'k3': 'v3'}, key_prefix='p')
+        self.client.flush()
+        self.assertEqual(None, dscache.get('k1'))
+        self.assertEqual('v2', dscache.get('k2', namespace='ns'))
+        self.assertEqual('v3', dscache.get('pk3'))
+
+    def test_context_manager_flushes(self):
+        with dscache.Client(write_behind=True) as client:
+            client.set('key', 'value')
+        self.assertEqual('value', dscache.get('key'))
+
+    def test_other_operations_flush_first(self):
+        self.client.set('key', 1)
+        self.assertEqual(2, self.client.incr('key'))
+        self.assertEqual(2, dscache.get('key'))
+        self.client.set('other', 'value')
+        self.assertFalse(self.client.add('other', 'value2'))
+
+class TieredTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.client = dscache.Client(tiered=True)
+
+    def cached(self, key, namespace=None):
+        data = memcache.get(dscache._build_memcache_key(key, namespace=namespace))
+        return dscache._decode_memcache_value(data) if data else None
+
+    def test_set_writes_both_tiers(self):
+        self.assertTrue(self.client.set('key', {'a': (1, 2)}))
+        self.assertEqual({'a': (1, 2)}, self.cached('key'))
+        self.assertEqual({'a': (1, 2)}, dscache.get('key'))
+
+    def test_late_backfill_does_not_restore_old_value(self):
+        self.client.set('key', 1)
+        memcache.flush_all()
+        # a read looks up 1 in dscache, then a write replaces it before the read copies it to memcache
+        self.assertTrue(self.client.replace('key', 2))
+        dscache._memcache_write_async({dscache._build_memcache_key('key'): (1, 0)}, add=True).get_result()
+        self.assertEqual(None, self.cached('key'))
+        self.assertEqual(2, self.client.get('key'))
+
+    def test_late_set_through_does_not_overwrite_newer_value(self):
+        memcache_key = dscache._build_memcache_key('key')
+        # a set of 1 claims the key and writes dscache, then a set of 2 runs before it writes memcache
+        self.assertEqual({memcache_key}, dscache._memcache_claim_async([memcache_key]).get_result())
+        self.assertTrue(dscache.set('key', 1))
+        self.assertTrue(self.client.set('key', 2))
+        dscache._memcache_write_async({memcache_key: (1, 0)}).get_result()
+        self.assertEqual(None, self.cached('key'))
+        self.assertEqual(2, self.client.get('key'))
+
+    def test_backfill_does_not_overwrite_newer_value(self):
+        self.client.set('key', 2)
+        dscache._memcache_write_async({dscache._build_memcache_key('key'): (1, 0)}, add=True).get_result()
+        self.assertEqual(2, self.cached('key'))
+
+    def test_reads_record_latency(self):
+        self.client.set('key', 'value')
+        self.client.get('key')
+        self.client.get_multi(['key', 'other'])
+        latency = dscache.get_stats()['latency']
+        self.assertEqual(1, latency['get']['count'])
+        self.assertEqual(1, latency['get_multi']['count'])
+
+    def test_get_reads_memcache_first(self):
+        self.client.set('key', 'value')
+        dscache.build_ds_key('key').delete()
+        self.assertEqual('value', self.client.get('key'))
+
+    def test_miss_backfills_memcache(self):
+        dscache.set('key', 0, time=100)
+        dscache.set('other', 'value', namespace='ns')
+        self.assertEqual(None, self.cached('key'))
+        self.assertEqual(0, self.client.get('key'))
+        self.assertEqual(0, self.cached('key'))
+        self.assertEqual('value', self.client.get_async('other', namespace='ns').get_result())
+        self.assertEqual('value', self.cached('other', namespace='ns'))
+
+    def test_get_multi(self):
+        self.client.set('k1', 'v1')
+        dscache.set_multi({'k2': 'v2', 'k3': 0})
+        self.assertEqual({'k1': 'v1', 'k2': 'v2'}, self.client.get_multi(['k1', 'k2', 'k3', 'unknown']))
+        self.assertEqual('v2', self.cached('k2'))
+        self.assertEqual(0, self.cached('k3'))
+
+    def test_delete_removes_both_tiers(self):
+        self.client.set_multi({'k1': 'v1', 'k2': 'v2'}, key_prefix='p')
+        self.assertTrue(self.client.delete('pk1'))
+        self.assertTrue(self.client.delete_multi(['k2'], key_prefix='p'))
+        self.assertEqual(None, self.cached('pk1'))
+        self.assertEqual(None, self.cached('pk2'))
+        self.assertEqual({}, self.client.get_multi(['pk1', 'pk2']))
+
+    def test_other_writes_invalidate_memcache(self):
+        self.client.set('counter', 1)
+        self.assertEqual(2, self.client.incr('counter'))
+        self.assertEqual(None, self.cached('counter'))
+        self.assertEqual(2, self.client.get('counter'))
+        self.assertTrue(self.client.replace('counter', 5))
+        self.assertEqual(5, self.client.get('counter'))
+        self.client.gets('counter')
+        self.assertTrue(self.client.cas('counter', 6))
+        self.assertEqual(6, self.client.get('counter'))
+
+    def test_expired_set_is_not_cached(self):
+        self.client.set('key', 'old')
+        self.client.set('key', 'value', time=-1)
+        self.assertEqual(None, self.cached('key'))
+        self.assertEqual(None, self.client.get('key'))
+
+    def test_large_value_stays_in_dscache(self):
+        value = os.urandom(2 * 1024 * 1024)
+        self.client.set('small', 'value')
+        self.assertTrue(self.client.set('large', value))
+        self.assertEqual(None, self.cached('large'))
+        self.assertEqual('value', self.cached('small'))
+        self.assertEqual(value, self.client.get('large'))
+
+    def test_flush_all_hides_memcache_copies(self):
+        self.client.set('key', 'value')
+        self.assertTrue(self.client.flush_all())
+        self.assertEqual(None, self.client.get('key'))
+
+    def test_write_behind_flush_writes_through(self):
+        with dscache.Client(tiered=True, write_behind=True) as client:
+            client.set('key', 'value')
+            self.assertEqual(None, self.cached('key'))
+        self.assertEqual('value', self.cached('key'))
+
+    def test_memcache_time(self):
+        self.assertEqual(0, dscache._memcache_time(0))
+        self.assertEqual(1, dscache._memcache_time(0.2))
+        self.assertGreater(dscache._memcache_time(dscache.MEMCACHE_MAX_RELATIVE_TIME + 1), 1000000000)
+
+class BloomFilterTests(unittest.TestCase):
+
+    def test_added_items_are_present(self):
+        bloom = BloomFilter.for_capacity(1000, 0.01)
+        for i in range(1000):
+            bloom.add('key%d' % i)
+        self.assertTrue(all('key%d' % i in bloom for i in range(1000)))
+        false_positives = sum(1 for i in range(10000) if 'other%d' % i in bloom)
+        self.assertLess(false_positives, 300)
+
+    def test_update(self):
+        a, b = BloomFilter(1024, 3), BloomFilter(1024, 3)
+        a.add('a')
+        b.add('b')
+        a.update(b)
+        self.assertTrue('a' in a and 'b' in a)
+        self.assertRaises(ValueError, a.update, BloomFilter(2048, 3))
+
+class BloomTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        dscache.enable_bloom_filter(capacity=1000, shards=4, flush_interval=0)
+        self.calls = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'count', lambda service, call, request, response: self.calls.append(call), 'datastore_v3')
+
+    def tearDown(self):
+        dscache.disable_bloom_filter()
+        super().tearDown()
+
+    def lookups(self, fn, *args, **kwargs):
+        """ Returns the result of fn and whether it read the datastore, once the filter is loaded. """
+        dscache.get('warm-up')
+        ndb.get_context().clear_cache()
+        del self.calls[:]
+        result = fn(*args, **kwargs)
+        return result, 'Get' in self.calls
+
+    def test_unused_until_rebuilt(self):
+        dscache.set('key', 'value')
+        self.assertEqual((None, True), self.lookups(dscache.get, 'unknown'))
+        self.assertEqual(1, dscache.rebuild_bloom_filter())
+        self.assertEqual((None, False), self.lookups(dscache.get, 'unknown'))
+        self.assertEqual(('value', True), self.lookups(dscache.get, 'key'))
+
+    def test_get_multi_skips_absent_keys(self):
+        dscache.set_multi({'a': 1, 'b': 2})
+        dscache.rebuild_bloom_filter()
+        self.assertEqual(({}, False), self.lookups(dscache.get_multi, ['x', 'y']))
+        self.assertEqual(({'a': 1}, True), self.lookups(dscache.get_multi, ['a', 'x']))
+
+    def test_writes_after_rebuild(self):
+        dscache.rebuild_bloom_filter()
+        dscache.get('warm-up')
+        dscache.set('set', 1)
+        dscache.set_multi({'set_multi': 2})
+        dscache.add('add', 3)
+        dscache.incr('incr', initial_value=3)
+        expected = {'set': 1, 'set_multi': 2, 'add': 3, 'incr': 4}
+        self.assertEqual(expected, dscache.get_multi(list(expected)))
+        # another instance loads the writes from the shards
+        dscache._bloom_filters.clear()
+        self.assertEqual(expected, dscache.get_multi(list(expected)))
+
+    def test_failed_filter_update_is_retried(self):
+        dscache.rebuild_bloom_filter()
+        dscache.get('warm-up')
+        self.fail_shard_puts = True
+        def fail_shard_puts(service, call, request, response):
+            if self.fail_shard_puts and call == 'Put' and b'_DSCacheBloom' in request.SerializeToString():
+                raise ValueError()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('fail', fail_shard_puts, 'datastore_v3')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(True, dscache.set('set', 1))
+            self.assertEqual([], dscache.set_multi({'set_multi': 2}))
+            self.assertEqual(True, dscache.add('add', 3))
+            self.assertEqual([], dscache.add_multi({'add_multi': 4}))
+            self.assertEqual(6, dscache.incr('incr', initial_value=5))
+        expected = {'set': 1, 'set_multi': 2, 'add': 3, 'add_multi': 4, 'incr': 6}
+        self.assertEqual(expected, dscache.get_multi(list(expected)))
+        # the keys reach the shards with the next batch, and another instance loads them
+        self.fail_shard_puts = False
+        self.assertTrue(dscache.flush_bloom_filter())
+        dscache._bloom_filters.clear()
+        self.assertEqual(expected, dscache.get_multi(list(expected)))
+
+    def test_writes_are_batched(self):
+        dscache.enable_bloom_filter(capacity=1000, shards=4, flush_interval=60)
+        dscache.rebuild_bloom_filter()
+        dscache.get('warm-up')
+        del self.calls[:]
+        dscache.set('a', 1)
+        dscache.set_multi({'b': 2, 'c': 3})
+        self.assertEqual(['Put', 'Put'], [call for call in self.calls if call in ('Put', 'Commit')])
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dscache.get_multi(['a', 'b', 'c']))
+        # this instance still finds its keys once it reloads the shards
+        dscache._bloom_filters.clear()
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dscache.get_multi(['a', 'b', 'c']))
+        self.assertTrue(dscache.flush_bloom_filter())
+        dscache._bloom_pending.clear()
+        dscache._bloom_filters.clear()
+        self.assertEqual({'a': 1, 'b': 2, 'c': 3}, dscache.get_multi(['a', 'b', 'c']))
+
+    def test_leases_are_not_added(self):
+        dscache.enable_bloom_filter(capacity=1000, shards=4, flush_interval=60)
+        dscache.get_or_compute('key', lambda: 'value')
+        self.assertEqual({dscache.build_ds_key_name('key')}, dscache._bloom_pending[''][0])
+
+    def test_unfiltered_write_is_found_after_rebuild(self):
+        dscache.rebuild_bloom_filter()
+        _DSCache(key=dscache.build_ds_key('key'), str_val='value', value_type='str').put()
+        self.assertEqual(None, dscache.get('key'))
+        dscache.rebuild_bloom_filter()
+        self.assertEqual('value', dscache.get('key'))
+
+    def test_rebuild_namespace(self):
+        dscache.set('key', 'value', namespace='ns')
+        dscache.set('other', 'value')
+        dscache.set('x' * 600, 'hashed')
+        self.assertEqual(2, dscache.rebuild_bloom_filter(namespace='ns'))
+        self.assertEqual(3, dscache.rebuild_bloom_filter())
+        self.assertEqual('value', dscache.get('key', namespace='ns'))
+        self.assertEqual((None, False), self.lookups(dscache.get, 'other', namespace='ns'))
+
+    def test_incompatible_shards_are_not_used(self):
+        dscache.rebuild_bloom_filter()
+        _DSCacheBloom(key=dscache._build_bloom_keys(None, 4)[1], size=8, hashes=1, bits=b'\0').put()
+        dscache._bloom_filters.clear()
+        self.assertEqual((None, True), self.lookups(dscache.get, 'unknown'))
+
+class CircuitBreakerClassTests(unittest.TestCase):
+
+    def test_trips_after_threshold(self):
+        breaker = CircuitBreaker(failure_threshold=2, cooldown=60)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual({'state': 'open', 'trips': 1, 'short_circuits': 1}, breaker.get_stats())
+
+    def test_old_failures_are_forgotten(self):
+        breaker = CircuitBreaker(failure_threshold=2, window=-1)
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertTrue(breaker.is_closed())
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, slow_seconds=0.5)
+        breaker.record_call(0.1)
+        breaker.record_call(1)
+        self.assertTrue(breaker.is_closed())
+        breaker.record_call(1)
+        self.assertFalse(breaker.is_closed())
+
+    def test_half_open_probe_closes(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=60)
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+        breaker._opened_at -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_call(0)
+        self.assertTrue(breaker.is_closed())
+        self.assertTrue(breaker.allow())
+
+    def test_half_open_probe_failure_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=1, cooldown=0)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual('open', breaker.state)
+        self.assertEqual(2, breaker.trips)
+
+class CircuitBreakerTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        self.breaker = dscache.enable_circuit_breaker(failure_threshold=1, cooldown=60)
+
+    def tearDown(self):
+        dscache.disable_circuit_breaker()
+        super().tearDown()
+
+    def trip(self):
+        self.assertEqual(False, dscache.set('a', 1, bad_option=True))
+        self.assertEqual('open', self.breaker.state)
+
+    def test_errors_trip_breaker(self):
+        dscache.set('a', 1)
+        self.assertTrue(self.breaker.is_closed())
+        self.trip()
+
+    def test_open_breaker_short_circuits(self):
+        dscache.set('a', 1)
+        self.trip()
+        self.assertEqual(None, dscache.get('a'))
+        self.assertEqual({}, dscache.get_multi(['a']))
+        self.assertEqual(False, dscache.set('b', 2))
+        self.assertEqual(['b', 'c'], dscache.set_multi({'b': 2, 'c': 3}))
+        self.assertEqual(False, dscache.delete('a'))
+        self.assertEqual({'a': None}, dscache.offset_multi({'a': 1}))
+        self.assertEqual(6, self.breaker.short_circuits)
+        dscache.disable_circuit_breaker()
+        self.assertEqual(1, dscache.get('a'))
+        self.assertEqual(None, dscache.get('b'))
+
+    def test_open_breaker_computes_without_cache(self):
+        self.trip()
+        self.assertEqual('computed', dscache.get_or_compute('key', lambda: 'computed'))
+        self.assertEqual(('computed', False), dscache.get_or_revalidate('key', lambda: 'computed'))
+        self.assertEqual({'k': 'k'}, dscache.get_or_compute_multi(['k'], lambda keys: {key: key for key in keys}))
+        dscache.disable_circuit_breaker()
+        self.assertEqual(None, dscache.get('key'))
+
+    def test_probe_closes_breaker(self):
+        self.breaker.cooldown = 0
+        self.trip()
+        self.assertEqual(True, dscache.set('a', 1))
+        self.assertTrue(self.breaker.is_closed())
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_local_cache_hits_do_not_close_breaker(self):
+        dscache.enable_local_cache()
+        self.addCleanup(dscache.disable_local_cache)
+        dscache.set('key', 'value')
+        self.trip()
+        self.breaker._opened_at -= 60
+        self.assertEqual('value', dscache.get('key'))
+        self.assertEqual('half_open', self.breaker.state)
+
+    def test_open_breaker_short_circuits_client(self):
+        client = dscache.Client()
+        dscache.set('a', 1)
+        self.assertEqual(1, client.gets('a'))
+        self.trip()
+        self.assertEqual(None, client.gets('a'))
+        self.assertEqual({}, client.gets_multi(['a']))
+        self.assertEqual(False, client.cas('a', 2))
+        self.assertEqual(['a'], client.cas_multi({'a': 2}))
+        self.assertEqual(False, client.flush_all())
+        self.assertEqual(5, self.breaker.short_circuits)
+        dscache.disable_circuit_breaker()
+        self.assertEqual(1, dscache.get('a'))
+
+    def test_open_breaker_serves_memcache_tier(self):
+        client = dscache.Client(tiered=True)
+        client.set('a', 1)
+        dscache.set('b', 2)
+        self.trip()
+        self.assertEqual(1, client.get('a'))
+        self.assertEqual(None, client.get('b'))
+        self.assertEqual({'a': 1}, client.get_multi(['a', 'b']))
+        self.assertEqual(2, self.breaker.short_circuits)
+
+    def test_get_or_compute_probes_breaker(self):
+        self.breaker.cooldown = 0
+        self.trip()
+        self.assertEqual('computed', dscache.get_or_compute('key', lambda: 'computed'))
+        self.assertTrue(self.breaker.is_closed())
+        self.assertEqual('computed', dscache.get('key'))
+        self.trip()
+        self.assertEqual({'k': 'k'}, dscache.get_or_compute_multi(['k'], lambda keys: {key: key for key in keys}))
+        self.assertTrue(self.breaker.is_closed())
+        self.assertEqual('k', dscache.get('k'))
+
+    def test_failed_probe_computes_without_cache(self):
+        self.breaker.cooldown = 0
+        self.trip()
+        self.assertEqual('computed', dscache.get_or_compute('key', lambda: 'computed', bad_option=True))
+        self.assertEqual('open', self.breaker.state)
+        self.assertEqual({'k': 'k'}, dscache.get_or_compute_multi(['k'], lambda keys: {key: key for key in keys},
+                                                                  bad_option=True))
+        self.assertEqual('open', self.breaker.state)
+        dscache.disable_circuit_breaker()
+        self.assertEqual({}, dscache.get_multi(['key', 'k']))
+
+    def test_slow_calls_trip_breaker(self):
+        breaker = dscache.enable_circuit_breaker(failure_threshold=2, slow_seconds=0)
+        dscache.set('a', 1)
+        dscache.set('a', 1)
+        self.assertEqual('open', breaker.state)
+
+    def test_compute_errors_do_not_trip_breaker(self):
+        dscache.set('key', 'old', time=-1)
+        def fn():
+            raise ValueError()
+        self.assertEqual('old', dscache.get_or_compute('key', fn, stale_if_error=True))
+        self.assertTrue(self.breaker.is_closed())
+
+class DeadlineTests(DatastoreTests):
+
+    def setUp(self):
+        super().setUp()
+        # read the flush generation, which is cached and read without the deadline
+        dscache.get('warm')
+        self.deadlines = []
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'deadline', lambda service, call, request, response, rpc: self.deadlines.append(rpc.deadline),
+            'datastore_v3')
+
+    def test_client_deadline(self):
+        client = dscache.Client(deadline=0.5)
+        self.assertEqual(True, client.set('a', 1))
+        ndb.get_context().clear_cache()
+        self.assertEqual(1, client.get('a'))
+        self.assertEqual({'a': 1}, client.get_multi(['a']))
+        self.assertTrue(self.deadlines)
+        self.assertEqual({0.5}, frozenset(self.deadlines))
+
+    def test_call_deadline_wins(self):
+        dscache.Client(deadline=0.5).set('a', 1, deadline=2)
+        self.assertEqual({2}, frozenset(self.deadlines))
+
+    def test_no_deadline_by_default(self):
+        dscache.Client().set('a', 1)
+        self.assertNotIn(0.5, self.deadlines)